@@ -6,15 +6,12 @@ from iptools import IP_endpoint
 should_quit = None
 
 def main():
-    connections: list[Connection] = []
-
     def on_disconnect(server: Server, connection: Connection):
         print(f"client at {connection.remote_endpoint} disconnected.")
-        connections.remove(connection)
     
     def on_connect(server: Server, connection: Connection):
         print(f"client at {connection.remote_endpoint} connected.")
-        connections.append(connection)
+        server.create_group("all").join(connection)
 
     stun_hosts = [("stun.ekiga.net", 3478)]
     
@@ -23,6 +20,7 @@ def main():
     print(f"ExternalAddress: {server.get_external_endpoint()}")
     print(f"LANAddress: {server.get_lan_endpoint()}")
     print(f"LoopbackAddress: {server.get_loopback_endpoint()}")
+    everyone = server.create_group("all")
 
     def tick_func():
         while not server.closed:
@@ -46,11 +44,9 @@ def main():
                 server.hole_punch(endpoint, None)
             elif text.startswith("udp "):
                 text = text.removeprefix("udp ")
-                for connection in connections:
-                    connection.send_unreliable(text.encode())
+                everyone.send_unreliable(text.encode())
             else:
-                for connection in connections:
-                    connection.send_reliable(text.encode())
+                everyone.send_reliable(text.encode())
     except BaseException as e:
         print(f"\nException in main loop: {traceback.format_exc()}")
         server.close()
@@ -0,0 +1,74 @@
+from time import monotonic
+
+class ReceiveBudget:
+    # max_datagrams: int | None - the maximum number of reads (datagrams or tcp reads) handled in a single tick
+    # max_bytes: int | None - the maximum number of bytes handled in a single tick
+    # max_time: float | None - the maximum time (in seconds) spent receiving in a single tick
+    # datagrams: int - the number of reads handled so far this tick
+    # bytes: int - the number of bytes handled so far this tick
+    # deadline: float | None - the monotonic time at which this tick's budget runs out
+    # exhausted_ticks: int - the number of ticks that ran out of budget before all data was read
+    # _hit: bool - whether the budget has already been exhausted this tick
+    def __init__(self, max_datagrams: int | None = None, max_bytes: int | None = None, max_time: float | None = None):
+        self.max_datagrams = max_datagrams
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.datagrams = 0
+        self.bytes = 0
+        self.deadline: float | None = None
+        self.exhausted_ticks = 0
+        self._hit = False
+
+    def begin(self):
+        self.datagrams = 0
+        self.bytes = 0
+        self.deadline = None if self.max_time is None else monotonic() + self.max_time
+        self._hit = False
+
+    def consume(self, size: int):
+        self.datagrams += 1
+        self.bytes += size
+
+    def exhausted(self) -> bool:
+        if self._hit:
+            return True
+        if ((self.max_datagrams is not None and self.datagrams >= self.max_datagrams)
+                or (self.max_bytes is not None and self.bytes >= self.max_bytes)
+                or (self.deadline is not None and monotonic() >= self.deadline)):
+            self._hit = True
+            self.exhausted_ticks += 1
+        return self._hit
+
+
+class TokenBucket:
+    # rate: float - the number of tokens (bytes) added per second
+    # burst: float - the maximum number of tokens that can be saved up
+    # tokens: float - the current number of tokens (negative if data was taken on credit)
+    # last_update: float - the monotonic time the tokens were last refilled
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_update = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens > 0
+
+    # takes the tokens only if there are enough of them
+    def consume(self, amount: int) -> bool:
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    # takes the tokens even if it leaves the bucket in debt (for data that has already been read)
+    def force_consume(self, amount: int):
+        self._refill()
+        self.tokens -= amount
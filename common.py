@@ -2,6 +2,8 @@ from socket import *
 from iptools import *
 
 BUFSIZE = 2000
+MAX_DATAGRAM_SIZE = 65536 # datagrams are received whole (a smaller buffer would silently truncate them)
+MAX_UDP_PAYLOAD = 65507 # the largest udp datagram that can be sent over ipv4 (ipv6 allows 20 bytes more)
 DUMMY_ENDPOINT : unresolved_endpoint  = ("192.0.2.1", 2000)
 CONNECT_DESTINATION : unresolved_endpoint = ("255.255.255.255", 2000)
 IPV6_LOOPBACK : unresolved_endpoint = ("::1", 2000)
@@ -1,31 +1,171 @@
 from socket import socket
 from udpsocket import UdpSocket
+from budget import TokenBucket
+from relay import RELAY_HEADER
+from localtransport import LocalTransport
+from connectionid import data_header
+from fragment import Fragmenter, MAX_MESSAGE_SIZE
+from pathstats import PathStats, MAX_STATS_OVERHEAD
+from common import MAX_DATAGRAM_SIZE, MAX_UDP_PAYLOAD
+from typing import TYPE_CHECKING
 from iptools import *
 
+if TYPE_CHECKING:
+    from group import Group # group imports this module
+
 class Connection:
     # tcp_socket: socket - the socket of the tcp connection
     # udp_socket: UdpSocket - the socket of the udp connection
     # local_endpoint: IP_endpoint - the local endpoint of the sockets
     # remote_endpoint: IP_endpoint - the destination of the sockets
+    # udp_endpoint: IP_endpoint - the endpoint unreliable data is sent to (differs from remote_endpoint after the peer's NAT rebinds)
+    # connection_id: int | None - the id sent in front of unreliable packets so the peer can find this connection (None if not used)
+    # peer_connection_id: int | None - the id the peer sends in front of its unreliable packets (once learned)
+    # path_challenge: tuple[IP_endpoint, bytes, float] | None - the new udp endpoint being validated, the nonce sent to it and when
+    # migrations: int - the number of times the udp endpoint has changed
     # closed: bool - whether the connection has been closed
+    # rate_limiter: TokenBucket | None - limits the number of bytes received from the remote endpoint per second
+    # dropped_unreliable: int - the number of unreliable packets dropped for exceeding the rate limit
+    # throttled_reliable: int - the number of ticks reliable data was left unread for exceeding the rate limit
+    # groups: set[Group] - the groups this connection is a member of
+    # peer_id: str | None - the id of the peer, when the connection was made by hole punching with one
+    # fragmenter: Fragmenter | None - splits and reassembles unreliable messages larger than a packet (None if not used)
+    # path_stats: PathStats | None - the round trip time, jitter and loss measured on unreliable packets (None if not measured)
+    # message_header: bytes - the kind byte sent in front of the application's unreliable messages (empty unless the Server has a snapshot channel)
+    # direct: bool - whether unreliable data is sent straight to udp_endpoint through udp_socket
+    # relayed: bool - whether the connection goes through a relay server
+    direct = True
+    relayed = False
 
-    def __init__(self, tcp_socket: socket, udp_socket: UdpSocket):
+    def __init__(self, tcp_socket: socket, udp_socket: UdpSocket, local_endpoint: IP_endpoint | None = None, remote_endpoint: IP_endpoint | None = None):
         self.tcp_socket = tcp_socket
         self.udp_socket = udp_socket
-        self.local_endpoint = get_canonical_local_endpoint(tcp_socket)
-        self.remote_endpoint = get_canonical_remote_endpoint(tcp_socket)
+        self.local_endpoint = local_endpoint if local_endpoint is not None else get_canonical_local_endpoint(tcp_socket)
+        self.remote_endpoint = remote_endpoint if remote_endpoint is not None else get_canonical_remote_endpoint(tcp_socket)
+        self.udp_endpoint = self.remote_endpoint
+        self.connection_id: int | None = None
+        self.connection_header = b''
+        self.peer_connection_id: int | None = None
+        self.path_challenge: tuple[IP_endpoint, bytes, float] | None = None
+        self.migrations = 0
         self.closed = False
+        self.rate_limiter: TokenBucket | None = None
+        self.dropped_unreliable = 0
+        self.throttled_reliable = 0
+        self.groups: set['Group'] = set()
+        self.peer_id: str | None = None
+        self.fragmenter: Fragmenter | None = None
+        self.path_stats: PathStats | None = None
+        self.message_header = b''
     
     def close(self):
         self.closed = True
     
+    def set_connection_id(self, connection_id: int | None):
+        self.connection_id = connection_id
+        self.connection_header = b'' if connection_id is None else data_header(connection_id)
+    
+    def set_rate_limit(self, rate: float | None, burst: float | None = None):
+        if rate is None:
+            self.rate_limiter = None
+            return
+        self.rate_limiter = TokenBucket(rate, burst if burst is not None else rate)
+    
+    # returns whether an unreliable packet of the given size is within the rate limit (and counts it if it is not)
+    def _accept_unreliable(self, size: int) -> bool:
+        if self.rate_limiter is None or self.rate_limiter.consume(size):
+            return True
+        self.dropped_unreliable += 1
+        return False
+    
+    # returns whether reliable data can be read this tick (and counts it if it cannot)
+    def _can_receive_reliable(self) -> bool:
+        if self.rate_limiter is None or self.rate_limiter.available():
+            return True
+        self.throttled_reliable += 1
+        return False
     
     
     def send_unreliable(self, data: bytes):
+        self._send_message(self.message_header + data)
+    
+    # sends the data unless the send buffer is full, returning whether it was sent
+    def try_send_unreliable(self, data: bytes) -> bool:
+        return self._try_send_message(self.message_header + data)
+    
+    # sends each data as its own unreliable message (with UDP_SEGMENT, runs of equal sized packets take one syscall)
+    def send_unreliable_many(self, datas: list[bytes]):
+        if self.closed:
+            return
+        if self.message_header:
+            datas = [self.message_header + data for data in datas]
+        self._send_packets(self._prepare_packets(datas))
+    
+    # returns the largest unreliable message that can be sent to the connection (larger ones are dropped)
+    def max_unreliable_size(self) -> int:
+        return self._max_message_size() - len(self.message_header)
+    
+    # sending whole unreliable messages (with their kind byte, if any), as the snapshot channel does
+    def _send_message(self, data: bytes):
         if self.closed:
             return
+        if self.fragmenter is None and self.path_stats is None:
+            self._send_packet(data)
+        else:
+            self._send_packets(self._prepare_packets([data]))
+    
+    def _try_send_message(self, data: bytes) -> bool:
+        if self.closed:
+            return False
+        if self.fragmenter is None and self.path_stats is None:
+            return self._try_send_packet(data)
+        packets = self._prepare_packets([data])
+        return len(packets) > 0 and all(self._try_send_packet(packet) for packet in packets)
+    
+    def _max_message_size(self) -> int:
+        if self.fragmenter is not None:
+            return MAX_MESSAGE_SIZE
+        size = self._max_packet_size()
+        if self.path_stats is not None:
+            size -= MAX_STATS_OVERHEAD
+        return size
+    
+    # the largest packet (below fragmentation and the path statistics) that can be sent whole
+    def _max_packet_size(self) -> int:
+        return MAX_UDP_PAYLOAD - len(self.connection_header)
+    
+    # returns the packets to send the messages in (fragmented, then with the path statistics header)
+    def _prepare_packets(self, datas: list[bytes]) -> list[bytes]:
+        if self.fragmenter is not None:
+            datas = [packet for data in datas for packet in self.fragmenter.split(data)]
+        if self.path_stats is not None:
+            datas = self.path_stats.wrap_many(datas)
+        return datas
+    
+    # sends a packet of the fragmentation layer (e.g. an mtu probe), below fragmentation but above the path statistics
+    def _send_control(self, data: bytes):
+        if self.path_stats is not None:
+            data = self.path_stats.wrap_many([data])[0]
+        self._send_packet(data)
+    
+    # sending single packets (below fragmentation), overridden by the Connections that don't send straight to udp_endpoint
+    def _send_packet(self, data: bytes):
         try:
-            self.udp_socket.send_to(data, self.remote_endpoint)
+            if self.connection_id is None:
+                self.udp_socket.send_to(data, self.udp_endpoint)
+            else:
+                self.udp_socket.send_parts_to([self.connection_header, data], self.udp_endpoint)
+        except Exception:
+            self.close()
+    
+    def _try_send_packet(self, data: bytes) -> bool:
+        return self.udp_socket.try_send_parts_to([self.connection_header, data], self.udp_endpoint)
+    
+    def _send_packets(self, datas: list[bytes]):
+        try:
+            if self.connection_id is not None:
+                datas = [self.connection_header + data for data in datas]
+            self.udp_socket.send_all_to(datas, self.udp_endpoint)
         except Exception:
             self.close()
     
@@ -35,4 +175,62 @@ class Connection:
         try:
             self.tcp_socket.sendall(data)
         except Exception:
-            self.close()
\ No newline at end of file
+            self.close()
+
+class RelayedConnection(Connection):
+    # a Connection whose traffic goes through a relay server (for when hole punching fails)
+    # remote_endpoint: IP_endpoint - the endpoint of the peer (not the relay)
+    # relay_endpoint: IP_endpoint - the endpoint of the relay server
+    # session: int - the relay session id
+    # relay_header: bytes - the header sent in front of every unreliable packet
+    direct = False
+    relayed = True
+
+    def __init__(self, tcp_socket: socket, udp_socket: UdpSocket, remote_endpoint: IP_endpoint, relay_endpoint: IP_endpoint, session: int, side: int):
+        super().__init__(tcp_socket, udp_socket, remote_endpoint=remote_endpoint)
+        self.relay_endpoint = relay_endpoint
+        self.session = session
+        self.relay_header = RELAY_HEADER.pack(session, side)
+
+    def _max_packet_size(self) -> int:
+        return MAX_UDP_PAYLOAD - RELAY_HEADER.size
+
+    def _send_packet(self, data: bytes):
+        try:
+            self.udp_socket.send_parts_to([self.relay_header, data], self.relay_endpoint)
+        except Exception:
+            self.close()
+
+    def _try_send_packet(self, data: bytes) -> bool:
+        return self.udp_socket.try_send_parts_to([self.relay_header, data], self.relay_endpoint)
+
+    def _send_packets(self, datas: list[bytes]):
+        try:
+            self.udp_socket.send_all_to([self.relay_header + data for data in datas], self.relay_endpoint)
+        except Exception:
+            self.close()
+
+
+class LocalConnection(Connection):
+    # a Connection to a Server on the same host, using unix sockets instead of tcp and udp
+    # local_transport: LocalTransport - the unix datagram socket unreliable data is sent through
+    # remote_port: int - the port of the other Server
+    direct = False
+
+    def __init__(self, stream_socket: socket, udp_socket: UdpSocket, local_transport: LocalTransport, local_endpoint: IP_endpoint, remote_endpoint: IP_endpoint, remote_port: int):
+        super().__init__(stream_socket, udp_socket, local_endpoint, remote_endpoint)
+        self.local_transport = local_transport
+        self.remote_port = remote_port
+
+    def _max_packet_size(self) -> int:
+        return MAX_DATAGRAM_SIZE # what the receiving LocalTransport reads a datagram into
+
+    def _send_packet(self, data: bytes):
+        self.local_transport.send_to(data, self.remote_port)
+
+    def _try_send_packet(self, data: bytes) -> bool:
+        return self.local_transport.send_to(data, self.remote_port)
+
+    def _send_packets(self, datas: list[bytes]):
+        for data in datas:
+            self.local_transport.send_to(data, self.remote_port)
@@ -1,28 +1,216 @@
 from socket import socket
 from connection import Connection
 from common import BUFSIZE, debug_print
-from threading import Lock
+from threading import Lock, Thread, Event
+from collections import deque
+from selectors import DefaultSelector, EVENT_READ
+from time import sleep
 from udpsocket import UdpSocket
 from select import select
+from budget import ReceiveBudget
 from iptools import *
 
+SHARD_POLL_TIMEOUT = 0.05 # how long a worker waits for readiness before checking whether it has been closed
+SHARD_MAX_PENDING = 4 * 1024 * 1024 # a worker stops reading while this many bytes wait to be taken (tcp flow control does the rest)
+
+class ConnectionShard:
+    # a part of a ConnectionCollection's sockets, read by its own worker thread when the collection has more than one shard
+    # the worker only reads sockets and queues the data: budgets and rate limits are charged when the tick thread takes it
+    # lock: Lock - the lock for this shard (taken after the collection's lock)
+    # sockets: list[socket] - the sockets in this shard
+    # socket_connections: Dictionary[socket, Connection] - the dictionary of Connections from their tcp socket
+    # selector: DefaultSelector | None - the readiness set of the sockets (None if the shard has no worker)
+    # received: deque[tuple[bytes, Connection]] - data read by the worker that has not been taken yet, in order
+    # queued: dict[Connection, int] - the number of items in received from each Connection
+    # pending_bytes: int - the bytes in received
+    # throttled: set[Connection] - Connections over their rate limit at the last take (their sockets are taken out of the selector)
+    # ended: list[Connection] - Connections the worker found closed by the peer (yet to be disconnected by the collection)
+    # room: Event - set while pending_bytes is under SHARD_MAX_PENDING (the worker waits on it instead of reading)
+    # closed: bool
+    # thread: Thread | None - the worker
+    def __init__(self, threaded: bool):
+        self.lock = Lock()
+        self.sockets: list[socket] = []
+        self.socket_connections: dict[socket, Connection] = {}
+        self.selector = DefaultSelector() if threaded else None
+        self.received: deque[tuple[bytes, Connection]] = deque()
+        self.queued: dict[Connection, int] = {}
+        self.pending_bytes = 0
+        self.throttled: set[Connection] = set()
+        self.ended: list[Connection] = []
+        self.room = Event()
+        self.room.set()
+        self.closed = False
+        self.thread: Thread | None = None
+        if threaded:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add(self, connection: Connection):
+        with self.lock:
+            self.sockets.append(connection.tcp_socket)
+            self.socket_connections[connection.tcp_socket] = connection
+            if self.selector is not None:
+                self.selector.register(connection.tcp_socket, EVENT_READ)
+
+    def remove(self, socket: socket) -> Connection | None:
+        with self.lock:
+            connection = self.socket_connections.pop(socket, None)
+            if connection is None:
+                return None
+            self.sockets.remove(socket)
+            self._unregister(socket)
+            self.throttled.discard(connection)
+            return connection
+
+    def _unregister(self, socket: socket):
+        if self.selector is None:
+            return
+        try:
+            self.selector.unregister(socket)
+        except (KeyError, ValueError):
+            pass
+
+    def _register(self, socket: socket):
+        if self.selector is None:
+            return
+        try:
+            self.selector.register(socket, EVENT_READ)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    # returns the sockets of the ended Connections whose data has all been taken (the rest wait for their data to be taken)
+    def take_ended(self) -> list[socket]:
+        with self.lock:
+            done = [connection.tcp_socket for connection in self.ended if connection not in self.queued]
+            self.ended = [connection for connection in self.ended if connection in self.queued]
+            return done
+
+    def _dequeue(self, data: bytes, connection: Connection):
+        self.pending_bytes -= len(data)
+        count = self.queued[connection] - 1
+        if count == 0:
+            del self.queued[connection]
+        else:
+            self.queued[connection] = count
+
+    # takes the data read by the worker, in order, until the budget is exhausted
+    # the data of Connections over their rate limit stays queued (in order) until they are under it again
+    def take(self, budget: ReceiveBudget | None) -> list[tuple[bytes, Connection]]:
+        result: list[tuple[bytes, Connection]] = []
+        with self.lock:
+            received = self.received
+            held: deque[tuple[bytes, Connection]] = deque()
+            throttled: set[Connection] = set()
+            while received and (budget is None or not budget.exhausted()):
+                data, connection = received.popleft()
+                if connection.closed:
+                    self._dequeue(data, connection) # read before the connection was disconnected
+                    continue
+                if connection in throttled or not connection._can_receive_reliable():
+                    throttled.add(connection)
+                    held.append((data, connection))
+                    continue
+                self._dequeue(data, connection)
+                if budget is not None:
+                    budget.consume(len(data))
+                if connection.rate_limiter is not None:
+                    connection.rate_limiter.force_consume(len(data))
+                result.append((data, connection))
+            for data, connection in received:
+                if connection in self.throttled:
+                    throttled.add(connection) # not reached this take, so still throttled
+                held.append((data, connection))
+            self.received = held
+            if self.selector is not None:
+                ended = set(self.ended)
+                for connection in throttled.difference(self.throttled):
+                    self._unregister(connection.tcp_socket)
+                for connection in self.throttled.difference(throttled):
+                    if connection.tcp_socket in self.socket_connections and connection not in ended:
+                        self._register(connection.tcp_socket)
+            self.throttled = throttled
+            if self.pending_bytes < SHARD_MAX_PENDING:
+                self.room.set()
+        return result
+
+    def run(self):
+        while not self.closed:
+            with self.lock:
+                if self.pending_bytes >= SHARD_MAX_PENDING:
+                    self.room.clear()
+            if not self.room.wait(SHARD_POLL_TIMEOUT):
+                continue
+            try:
+                events = self.selector.select(SHARD_POLL_TIMEOUT)
+            except (OSError, ValueError):
+                sleep(SHARD_POLL_TIMEOUT) # the selector was closed, or a socket closed while being waited on
+                continue
+            if not events:
+                continue
+            with self.lock:
+                ready = [self.socket_connections.get(key.fileobj) for key, _ in events]
+                ready = [connection for connection in ready if connection is not None and connection not in self.throttled]
+            for connection in ready:
+                if connection.closed:
+                    continue
+                try:
+                    data = connection.tcp_socket.recv(BUFSIZE)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    data = b''
+                with self.lock:
+                    if data:
+                        self.received.append((data, connection))
+                        self.queued[connection] = self.queued.get(connection, 0) + 1
+                        self.pending_bytes += len(data)
+                    elif connection.tcp_socket in self.socket_connections:
+                        self._unregister(connection.tcp_socket) # stop waking up for a socket at its end
+                        self.ended.append(connection)
+
+    def close(self):
+        self.closed = True
+        self.room.set()
+        if self.thread is not None:
+            self.thread.join(SHARD_POLL_TIMEOUT * 4)
+        with self.lock:
+            if self.selector is not None:
+                self.selector.close()
+            self.sockets.clear()
+            self.socket_connections.clear()
+            self.received.clear()
+            self.queued.clear()
+            self.pending_bytes = 0
+            self.throttled.clear()
+            self.ended.clear()
+
+
 class ConnectionCollection:
     # connections: Dictionary[endpoint, Connection] - the dictionary of Connections from the remote endpoint
-    # sockets: set[socket] - a list of sockets to poll for reading
+    # shards: list[ConnectionShard] - the sockets split into shards (with one shard, it is read by receive instead of a worker)
+    # socket_shards: Dictionary[socket, ConnectionShard] - the shard of every tcp socket
+    # threaded: bool - whether every shard is read by its own worker thread
     # disconnections: list[Connection] - a list of connections that have recently disconnected but not been handled
     # lock: Lock - the lock for this connection collection
-    def __init__(self):
+    # next_socket: int - the index in connections to start reading from next (so that all sockets get a fair turn)
+    # next_shard: int - the shard to start taking data from next (so that all shards get a fair turn)
+    def __init__(self, shards: int = 1):
         self.connections :dict[IP_endpoint, Connection] = {}
-        self.sockets :list[socket] = []
+        self.threaded = shards > 1
+        self.shards = [ConnectionShard(self.threaded) for _ in range(max(1, shards))]
+        self.socket_shards :dict[socket, ConnectionShard] = {}
         self.disconnections :set[Connection] = set()
         self.lock = Lock()
+        self.next_socket = 0
+        self.next_shard = 0
 
     def __contains__(self, endpoint: IP_endpoint) -> bool:
         return endpoint in self.connections.keys()
-    
+
     def __getitem__(self, endpoint: IP_endpoint) -> Connection:
         return self.connections[endpoint]
-    
+
     def add_connection(self, socket: socket, udp_socket: UdpSocket) -> Connection | None:
         with self.lock:
             endpoint = get_canonical_remote_endpoint(socket)
@@ -30,67 +218,126 @@ class ConnectionCollection:
                 debug_print(f"connection already made!")
                 return None
             connection = Connection(socket, udp_socket)
-            self.connections[endpoint] = connection
-            self.sockets.append(socket)
-            udp_socket.add_keep_alive_target(endpoint)
+            self._add(connection)
             return connection
-    
+
+    # adds a connection that has already been created (e.g. one made through a relay)
+    def add(self, connection: Connection) -> bool:
+        with self.lock:
+            if connection.remote_endpoint in self:
+                debug_print(f"connection already made!")
+                return False
+            self._add(connection)
+            return True
+
+    def _add(self, connection: Connection):
+        self.connections[connection.remote_endpoint] = connection
+        shard = min(self.shards, key=lambda shard: len(shard.sockets))
+        shard.add(connection)
+        self.socket_shards[connection.tcp_socket] = shard
+        if connection.direct:
+            connection.udp_socket.add_keep_alive_target(connection.udp_endpoint)
+
     def _disconnect_socket(self, socket: socket):
-        endpoint = get_canonical_remote_endpoint(socket)
-        if endpoint in self:
-            connection = self.connections.pop(endpoint)
-            disconnect(connection)
-            self.sockets.remove(socket)
-            connection.udp_socket.remove_keep_alive_target(endpoint)
-            self.disconnections.add(connection)
+        shard = self.socket_shards.pop(socket, None)
+        if shard is None:
+            return
+        connection = shard.remove(socket)
+        if connection is None:
+            return
+        endpoint = connection.remote_endpoint
+        self.connections.pop(endpoint, None)
+        disconnect(connection)
+        if connection.direct:
+            connection.udp_socket.remove_keep_alive_target(connection.udp_endpoint)
+        self.disconnections.add(connection)
 
-    def _get_receive_exception_sockets(self) -> tuple[list[socket], list[socket]]:
+    def _get_receive_exception_sockets(self, sockets: list[socket]) -> tuple[list[socket], list[socket]]:
         try:
-            rlist, _, xlist = select(self.sockets, [], self.sockets, 0)
+            rlist, _, xlist = select(sockets, [], sockets, 0)
             return (rlist, xlist)
         except:
             return ([], [])
 
-    def receive(self) -> list[tuple[bytes, IP_endpoint]]:
+    # returns the data read, with the Connection it came from (which may have disconnected in the same call)
+    def receive(self, budget: ReceiveBudget | None = None) -> list[tuple[bytes, Connection]]:
         with self.lock:
             for connection in list(self.connections.values()):
                 if connection.closed:
                     self._disconnect_socket(connection.tcp_socket)
-            if len(self.sockets) == 0:
+            if self.threaded:
+                return self._take_received(budget)
+            sockets = self.shards[0].sockets
+            if len(sockets) == 0:
                 return []
-            result : list[tuple[bytes, IP_endpoint]] = []
-            rlist, xlist = self._get_receive_exception_sockets()
+            result : list[tuple[bytes, Connection]] = []
+            rlist, xlist = self._get_receive_exception_sockets(sockets)
             for socket in xlist:
                 self._disconnect_socket(socket)
-            for socket in rlist:
-                if socket in xlist:
+            if len(sockets) == 0:
+                return result
+            # read in round robin order, starting from where the last tick left off
+            connections = list(self.connections.values())
+            start = self.next_socket % len(connections)
+            order = connections[start:] + connections[:start]
+            self.next_socket = start + 1
+            ready = set(rlist).difference(xlist)
+            for index, connection in enumerate(order):
+                socket = connection.tcp_socket
+                if socket not in ready:
+                    continue
+                if budget is not None and budget.exhausted():
+                    self.next_socket = start + index
+                    break
+                if not connection._can_receive_reliable():
                     continue
                 try:
                     data = socket.recv(BUFSIZE)
                 except:
                     data : bytes = b''
                 if data:
-                    endpoint = get_canonical_remote_endpoint(socket)
-                    result.append((data, endpoint))
+                    if budget is not None:
+                        budget.consume(len(data))
+                    if connection.rate_limiter is not None:
+                        connection.rate_limiter.force_consume(len(data))
+                    result.append((data, connection))
                 else:
                     self._disconnect_socket(socket)
             return result
 
+    # merges the data read by the shard workers, taking from the shards in round robin order
+    def _take_received(self, budget: ReceiveBudget | None) -> list[tuple[bytes, Connection]]:
+        result : list[tuple[bytes, Connection]] = []
+        # a Connection the peer closed is only disconnected once all the data that arrived before the end of its stream
+        # was taken by an earlier tick (so, as when reading inline, its disconnect is never handled before its data)
+        for shard in self.shards:
+            for socket in shard.take_ended():
+                self._disconnect_socket(socket)
+        start = self.next_shard % len(self.shards)
+        self.next_shard = start + 1
+        for shard in self.shards[start:] + self.shards[:start]:
+            if budget is not None and budget.exhausted():
+                break
+            result.extend(shard.take(budget))
+        return result
+
     def take_disconnections(self) -> list[Connection]:
         with self.lock:
             disconnections = list(self.disconnections)
             self.disconnections.clear()
             return disconnections
-        
+
     def disconnect_all(self):
         with self.lock:
             for endpoint in self.connections.keys():
                 connection = self.connections[endpoint]
                 disconnect(connection)
-            
+            for shard in self.shards:
+                shard.close()
+
             self.connections.clear()
             self.disconnections.clear()
-            self.sockets.clear()
+            self.socket_shards.clear()
 
 def disconnect(connection: Connection):
     connection.closed = True
@@ -101,4 +348,4 @@ def disconnect(connection: Connection):
     try:
         connection.tcp_socket.close()
     except Exception:
-        pass
\ No newline at end of file
+        pass
@@ -0,0 +1,25 @@
+from struct import Struct
+from os import urandom
+
+# Connection ID header on unreliable packets (when a Server is created with connection_ids=True)
+# Every packet starts with CONNECTION_ID_HEADER (type, sender's connection id), so the receiver can find the
+# Connection even when the sender's NAT has changed its udp endpoint. Packets from a new endpoint are still
+# delivered, but unreliable data is only sent to the new endpoint once it has answered a PATH_CHALLENGE.
+CONNECTION_ID_HEADER = Struct("!BQ")
+PATH_NONCE = Struct("!8s")
+PACKET_DATA = 0
+PACKET_PATH_CHALLENGE = 1
+PACKET_PATH_RESPONSE = 2
+PATH_CHALLENGE_INTERVAL = 1
+
+def new_connection_id() -> int:
+    return int.from_bytes(urandom(CONNECTION_ID_HEADER.size - 1), "big")
+
+def new_path_nonce() -> bytes:
+    return urandom(PATH_NONCE.size)
+
+def data_header(connection_id: int) -> bytes:
+    return CONNECTION_ID_HEADER.pack(PACKET_DATA, connection_id)
+
+def path_packet(type: int, connection_id: int, nonce: bytes) -> bytes:
+    return CONNECTION_ID_HEADER.pack(type, connection_id) + PATH_NONCE.pack(nonce)
@@ -0,0 +1,206 @@
+from struct import Struct
+from itertools import count
+from os import urandom
+from time import monotonic
+
+# Fragmentation of unreliable messages (when a Server is created with fragmentation=True)
+# Every unreliable packet starts with a kind byte:
+# PACKET_WHOLE: the rest of the packet is a whole message
+# PACKET_FRAGMENT: FRAGMENT_HEADER (kind, message id, fragment index, fragment count), then a part of the message.
+#                  Every fragment of a message is the same size except the last, so they can be sent with UDP_SEGMENT.
+# PACKET_MTU_PROBE: MTU_PROBE_HEADER (kind, size), padded with zeros to size bytes
+# PACKET_MTU_ACK: MTU_PROBE_HEADER, telling the prober a probe of size bytes arrived
+PACKET_WHOLE = 0
+PACKET_FRAGMENT = 1
+PACKET_MTU_PROBE = 2
+PACKET_MTU_ACK = 3
+WHOLE_HEADER = bytes([PACKET_WHOLE])
+FRAGMENT_HEADER = Struct("!BIHH")
+MTU_PROBE_HEADER = Struct("!BH")
+# the largest packet sent before probing, leaving room for the ip and udp headers and a connection id or relay header
+# within the 1280 byte minimum ipv6 mtu
+DEFAULT_FRAGMENT_SIZE = 1200
+LOCAL_FRAGMENT_SIZE = 60000 # unix datagrams have no mtu, only the receive buffer size to stay under
+MTU_PROBE_SIZES = (1400, 1440, 8900) # ethernet (with and without a tunnel's overhead) and jumbo frames
+MTU_PROBE_INTERVAL = 0.5
+MTU_PROBE_ATTEMPTS = 3
+# once a larger size is found, a probe of that size is sent every MTU_CHECK_INTERVAL to confirm the path still carries it
+# (a route change or migration can silently drop every larger packet). After MTU_CHECK_ATTEMPTS unanswered in a row,
+# sent MTU_PROBE_INTERVAL apart, the size falls back to the size before probing and probing starts again.
+MTU_CHECK_INTERVAL = 5
+MTU_CHECK_ATTEMPTS = 3
+MAX_FRAGMENTS = 1024 # messages needing more fragments are dropped
+FRAGMENT_TIMEOUT = 1 # seconds a partial message is kept waiting for its missing fragments
+# the largest message sent (larger ones are not sent), so that any message sent fits in what the receiver keeps
+MAX_MESSAGE_SIZE = 1024 * 1024
+# the most memory partial messages can take per connection (the oldest are dropped first), room for a few whole messages
+MAX_PENDING_BYTES = 4 * MAX_MESSAGE_SIZE
+# the memory charged for a partial message besides its parts: a fixed cost, and a slot per fragment
+# (so a flood of tiny fragments with distinct message ids is bounded by MAX_PENDING_BYTES too)
+PARTIAL_MESSAGE_COST = 128
+FRAGMENT_SLOT_COST = 8
+
+# message ids are shared by every connection, so a message sent to a group is fragmented once for all of its members
+_message_ids = count(int.from_bytes(urandom(4), "big"))
+
+def next_message_id() -> int:
+    return next(_message_ids) & 0xFFFFFFFF
+
+# returns the packets to send the message in, each at most fragment_size bytes (none if the message is too large to send)
+def split_message(data: bytes, message_id: int, fragment_size: int) -> list[bytes]:
+    if len(data) > MAX_MESSAGE_SIZE:
+        return []
+    if len(data) + len(WHOLE_HEADER) <= fragment_size:
+        return [WHOLE_HEADER + data]
+    part_size = fragment_size - FRAGMENT_HEADER.size
+    fragments = (len(data) + part_size - 1) // part_size
+    if fragments > MAX_FRAGMENTS:
+        return []
+    view = memoryview(data)
+    return [FRAGMENT_HEADER.pack(PACKET_FRAGMENT, message_id, index, fragments) + view[index * part_size:(index + 1) * part_size]
+            for index in range(fragments)]
+
+
+class PartialMessage:
+    # parts: list[bytes | None] - the fragments received so far, by index
+    # missing: int - the number of fragments not yet received
+    # size: int - the memory charged for the message so far (the bytes received, and the cost of keeping the parts)
+    # start: float - when the first fragment arrived
+    def __init__(self, fragments: int, start: float):
+        self.parts: list[bytes | None] = [None] * fragments
+        self.missing = fragments
+        self.size = PARTIAL_MESSAGE_COST + FRAGMENT_SLOT_COST * fragments
+        self.start = start
+
+
+class Fragmenter:
+    # fragment_size: int - the largest packet sent to the connection (grows when an mtu probe is acknowledged)
+    # base_size: int - the fragment size before probing, which the path is assumed to always carry
+    # partial: dict[int, PartialMessage] - the messages being reassembled, by message id, oldest first
+    # pending_bytes: int - the memory charged for the partial messages
+    # probe_sizes: list[int] - the probe sizes yet to be acknowledged
+    # probes_sent: int - how many rounds of probes have been sent
+    # last_probe: float - when the last round of probes (or the last check) was sent
+    # unanswered: int - the checks of fragment_size sent since the last acknowledgement of that size
+    # black_holes: int - how many times fragment_size fell back to base_size because its checks went unanswered
+    # dropped_messages: int - messages dropped because a fragment did not arrive in time or memory ran out
+    # oversized: int - messages not sent because they were larger than MAX_MESSAGE_SIZE or needed more than MAX_FRAGMENTS fragments
+    def __init__(self, fragment_size: int = DEFAULT_FRAGMENT_SIZE):
+        self.fragment_size = fragment_size
+        self.base_size = fragment_size
+        self.partial: dict[int, PartialMessage] = {}
+        self.pending_bytes = 0
+        self.probe_sizes: list[int] = []
+        self.probes_sent = 0
+        self.last_probe = 0.0
+        self.unanswered = 0
+        self.black_holes = 0
+        self.dropped_messages = 0
+        self.oversized = 0
+
+    def split(self, data: bytes) -> list[bytes]:
+        packets = split_message(data, next_message_id(), self.fragment_size)
+        if not packets:
+            self.oversized += 1
+        return packets
+
+    # returns the message the packet completes (if any), replying to mtu probes through the connection
+    def receive(self, data: bytes, connection) -> bytes | None:
+        if not data:
+            return None
+        kind = data[0]
+        if kind == PACKET_WHOLE:
+            return data[len(WHOLE_HEADER):]
+        if kind == PACKET_FRAGMENT:
+            return self._receive_fragment(data)
+        if kind == PACKET_MTU_PROBE and len(data) >= MTU_PROBE_HEADER.size:
+            connection._send_control(MTU_PROBE_HEADER.pack(PACKET_MTU_ACK, len(data)))
+        elif kind == PACKET_MTU_ACK and len(data) >= MTU_PROBE_HEADER.size:
+            size = MTU_PROBE_HEADER.unpack_from(data)[1]
+            if size in self.probe_sizes:
+                self.fragment_size = max(self.fragment_size, size)
+                self.probe_sizes = [probe for probe in self.probe_sizes if probe > size]
+            if size >= self.fragment_size:
+                self.unanswered = 0
+        return None
+
+    def _receive_fragment(self, data: bytes) -> bytes | None:
+        if len(data) < FRAGMENT_HEADER.size:
+            return None
+        _, message_id, index, fragments = FRAGMENT_HEADER.unpack_from(data)
+        if index >= fragments or fragments > MAX_FRAGMENTS:
+            return None
+        now = monotonic()
+        self._expire(now)
+        message = self.partial.get(message_id)
+        if message is None:
+            message = PartialMessage(fragments, now)
+            self.partial[message_id] = message
+            self.pending_bytes += message.size
+        elif len(message.parts) != fragments or message.parts[index] is not None:
+            return None # malformed or duplicated
+        part = data[FRAGMENT_HEADER.size:]
+        message.parts[index] = part
+        message.missing -= 1
+        message.size += len(part)
+        self.pending_bytes += len(part)
+        if message.missing == 0:
+            del self.partial[message_id]
+            self.pending_bytes -= message.size
+            return b''.join(message.parts)
+        while self.pending_bytes > MAX_PENDING_BYTES and self.partial:
+            self._drop(next(iter(self.partial)))
+        return None
+
+    # drops the partial messages that have waited too long for a fragment (they are kept in arrival order)
+    def _expire(self, now: float):
+        while self.partial:
+            message_id, message = next(iter(self.partial.items()))
+            if now - message.start < FRAGMENT_TIMEOUT:
+                return
+            self._drop(message_id)
+
+    def _drop(self, message_id: int):
+        message = self.partial.pop(message_id)
+        self.pending_bytes -= message.size
+        self.dropped_messages += 1
+
+    def start_probing(self):
+        self.probe_sizes = [size for size in MTU_PROBE_SIZES if size > self.fragment_size]
+        self.probes_sent = 0
+        self.last_probe = 0.0
+        self.unanswered = 0
+
+    # goes back to base_size and probes again (e.g. when the connection has moved to another path)
+    def restart_probing(self):
+        self.fragment_size = self.base_size
+        self.start_probing()
+
+    # sends a round of probes, or a check of the probed size, if one is due
+    # returns False once there is nothing left to probe or check (no larger size than base_size was found)
+    def probe(self, connection, now: float) -> bool:
+        if self.probe_sizes and self.probes_sent < MTU_PROBE_ATTEMPTS:
+            if now - self.last_probe >= MTU_PROBE_INTERVAL:
+                for size in self.probe_sizes:
+                    self._send_probe(connection, size)
+                self.probes_sent += 1
+                self.last_probe = now
+            return True
+        self.probe_sizes = []
+        if self.fragment_size <= self.base_size:
+            return False
+        if now - self.last_probe < (MTU_CHECK_INTERVAL if self.unanswered == 0 else MTU_PROBE_INTERVAL):
+            return True
+        if self.unanswered >= MTU_CHECK_ATTEMPTS:
+            self.black_holes += 1
+            self.restart_probing()
+            return True
+        self._send_probe(connection, self.fragment_size)
+        self.unanswered += 1
+        self.last_probe = now
+        return True
+
+    def _send_probe(self, connection, size: int):
+        probe = bytearray(size)
+        MTU_PROBE_HEADER.pack_into(probe, 0, PACKET_MTU_PROBE, size)
+        connection._send_control(bytes(probe))
@@ -0,0 +1,122 @@
+from threading import Lock
+from connection import Connection
+from udpsocket import UdpSocket
+from fragment import next_message_id, split_message
+from iptools import *
+
+class Group:
+    # name: str - the name of the group on its Server
+    # udp_socket: UdpSocket - the udp socket shared by every member
+    # members: dict[Connection, None] - the connections in the group (used as an ordered set)
+    # lock: Lock
+    # closed: bool - True if the group has been removed from its Server
+    # message_header: bytes - the kind byte in front of the application's unreliable messages (the same for every Connection of the Server)
+    def __init__(self, name: str, udp_socket: UdpSocket, message_header: bytes = b''):
+        self.name = name
+        self.udp_socket = udp_socket
+        self.message_header = message_header
+        self.members: dict[Connection, None] = {}
+        self.lock = Lock()
+        self.closed = False
+
+    def __contains__(self, connection: Connection) -> bool:
+        return connection in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def get_members(self) -> list[Connection]:
+        with self.lock:
+            return list(self.members)
+
+    def join(self, connection: Connection) -> bool:
+        with self.lock:
+            if self.closed or connection.closed:
+                return False
+            self.members[connection] = None
+            connection.groups.add(self)
+            return True
+
+    def leave(self, connection: Connection):
+        with self.lock:
+            self.members.pop(connection, None)
+            connection.groups.discard(self)
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    # removes every member and stops the group taking new ones (closed is set under the lock, as join and the sends check it)
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self._clear()
+
+    def _clear(self):
+        for connection in self.members:
+            connection.groups.discard(self)
+        self.members.clear()
+
+    def send_unreliable(self, data: bytes):
+        with self.lock:
+            if self.closed:
+                return
+            direct = [connection for connection in self.members if not connection.closed and connection.direct]
+            indirect = [connection for connection in self.members if not connection.direct]
+        message = self.message_header + data
+        endpoints = [connection.udp_endpoint for connection in direct
+                     if connection.connection_id is None and connection.fragmenter is None and connection.path_stats is None]
+        identified = [(connection.connection_header, connection.udp_endpoint) for connection in direct
+                      if connection.connection_id is not None and connection.fragmenter is None and connection.path_stats is None]
+        wrapped = [connection for connection in direct if connection.fragmenter is not None or connection.path_stats is not None]
+        if endpoints:
+            self.udp_socket.send_to_many(message, endpoints)
+        if identified:
+            self.udp_socket.send_to_many_with_headers(message, identified)
+        if wrapped:
+            self.udp_socket.send_batch(_fragment_batch([message], wrapped))
+        for connection in indirect:
+            connection.send_unreliable(data)
+
+    # sends each data as its own unreliable message to every member, with the udp socket locked only once for all direct members
+    def send_unreliable_many(self, datas: list[bytes]):
+        with self.lock:
+            if self.closed:
+                return
+            direct = [connection for connection in self.members if not connection.closed and connection.direct]
+            indirect = [connection for connection in self.members if not connection.direct]
+        if direct:
+            messages = [self.message_header + data for data in datas] if self.message_header else datas
+            self.udp_socket.send_batch(_fragment_batch(messages, direct))
+        for connection in indirect:
+            connection.send_unreliable_many(datas)
+
+    def send_reliable(self, data: bytes):
+        with self.lock:
+            if self.closed:
+                return
+            members = list(self.members)
+        for connection in members:
+            connection.send_reliable(data)
+
+# returns the packets to send to each direct connection, fragmenting each data once per fragment size
+# (message ids are shared by every connection, so members with the same fragment size get the same packets)
+# and adding each connection's own path statistics and connection id headers
+def _fragment_batch(datas: list[bytes], connections: list[Connection]) -> list[tuple[list[bytes], IP_endpoint]]:
+    message_ids = [next_message_id() for _ in datas]
+    packets_by_size: dict[int, list[bytes]] = {}
+    batch: list[tuple[list[bytes], IP_endpoint]] = []
+    for connection in connections:
+        packets = datas
+        if connection.fragmenter is not None:
+            size = connection.fragmenter.fragment_size
+            packets = packets_by_size.get(size)
+            if packets is None:
+                packets = [packet for data, message_id in zip(datas, message_ids) for packet in split_message(data, message_id, size)]
+                packets_by_size[size] = packets
+        if connection.path_stats is not None:
+            packets = connection.path_stats.wrap_many(packets)
+        if connection.connection_id is not None:
+            packets = [connection.connection_header + packet for packet in packets]
+        batch.append((packets, connection.udp_endpoint))
+    return batch
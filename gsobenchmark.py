@@ -0,0 +1,60 @@
+from sys import argv
+from socket import *
+from threading import Thread
+from time import perf_counter
+from udpsocket import UdpSocket
+from socketoptions import SocketOptions
+
+def receive_thread(receiver: socket, counts: list[int], index: int):
+    buffer = memoryview(bytearray(65536))
+    try:
+        while True:
+            receiver.recv_into(buffer)
+            counts[index] += 1
+    except (timeout, OSError):
+        pass
+
+# sends datagrams_per_peer datagrams of the given size to every peer, returning (datagrams sent per second, datagrams received, gso sends)
+def bench(gso: bool, peers: int, datagrams_per_peer: int, size: int, rounds: int) -> tuple[float, int, int]:
+    sender = UdpSocket(("127.0.0.1", 0), [], AF_INET, SocketOptions(send_buffer=4 * 1024 * 1024, udp_gso=gso))
+    receivers = []
+    for _ in range(peers):
+        receiver = socket(AF_INET, SOCK_DGRAM)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.setsockopt(SOL_SOCKET, SO_RCVBUF, 8 * 1024 * 1024)
+        receiver.settimeout(0.5)
+        receivers.append(receiver)
+    counts = [0] * peers
+    threads = [Thread(target=receive_thread, args=(receiver, counts, i)) for i, receiver in enumerate(receivers)]
+    for thread in threads:
+        thread.start()
+
+    datas = [bytes(size)] * datagrams_per_peer
+    batch = [(datas, receiver.getsockname()) for receiver in receivers]
+    start = perf_counter()
+    for _ in range(rounds):
+        sender.send_batch(batch)
+    elapsed = perf_counter() - start
+    for thread in threads:
+        thread.join()
+    gso_sends = sender.gso_sends
+    sender.close()
+    for receiver in receivers:
+        receiver.close()
+    return peers * datagrams_per_peer * rounds / elapsed, sum(counts), gso_sends
+
+def main():
+    if len(argv) > 5:
+        print("Usage: python gsobenchmark.py [peers] [datagrams per peer] [size] [rounds]")
+        exit()
+    peers = int(argv[1]) if len(argv) >= 2 else 16
+    datagrams_per_peer = int(argv[2]) if len(argv) >= 3 else 32
+    size = int(argv[3]) if len(argv) >= 4 else 1200
+    rounds = int(argv[4]) if len(argv) >= 5 else 200
+    total = peers * datagrams_per_peer * rounds
+    for gso in (False, True):
+        pps, received, gso_sends = bench(gso, peers, datagrams_per_peer, size, rounds)
+        print(f"gso {'on ' if gso else 'off'}: {pps:,.0f} datagrams/s sent, {received}/{total} received, {gso_sends} segmented sends")
+
+if __name__ == "__main__":
+    main()
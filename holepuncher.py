@@ -3,6 +3,7 @@ import traceback
 from threading import Thread, Lock
 from common import make_socket_reusable, debug_print
 from iptools import IP_endpoint
+from socketoptions import SocketOptions
 
 HOLEPUNCH_TIMEOUT = 10
 
@@ -13,10 +14,12 @@ class HolePuncher:
     # hole_punchers: Dictionary[IP_endpoint, socket] - the dictionary of connecting TCP sockets and associated thread to the remote endpoint
     # hole_punch_fails: list[IP_endpoint] - a list of remote endpoints that could not be connected to (and have yet to be managed)
     # hole_punch_successes: list[socket] - a list of sockets that have succeeded in connecting (and have yet to be managed)
+    # options: SocketOptions | None - options applied to hole punching sockets before they connect
     
-    def __init__(self, local_endpoint: IP_endpoint, family: AddressFamily):
+    def __init__(self, local_endpoint: IP_endpoint, family: AddressFamily, options: SocketOptions | None = None):
         self.local_endpoint = local_endpoint
         self.family = family
+        self.options = options
         self.lock = Lock()
         self.hole_punchers:dict[IP_endpoint, socket] = {} 
         self.fails:set[IP_endpoint] = set()
@@ -98,6 +101,8 @@ class HolePuncher:
         if family == AF_INET6:
             hp_socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
         make_socket_reusable(hp_socket)
+        if self.options is not None:
+            self.options.apply_tcp(hp_socket)
         hp_socket.bind(local_endpoint) # bind the socket
         return hp_socket
 
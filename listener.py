@@ -1,42 +1,98 @@
 from socket import socket
+from select import select
 from threading import Lock
+from time import monotonic
+import sys
 import traceback
 from common import make_socket_reusable, debug_print
-from select import select
+from socketoptions import SocketOptions
 from iptools import *
 
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_ACCEPTS = 256 # the most connections accepted per tick (the rest wait in the accept queue for the next tick)
+ACCEPT_RATE_INTERVAL = 1
+
 class Listener:
     # listen: bool - whether the listener should actively listen (or merely keep the socket open)
     # listener_socket: socket - the socket used to listent to incoming tcp connections
     # local_endpoint: IP_endpoint - the endpoint the listener is bound to
+    # backlog: int - the length of the accept queue requested from listen() (the OS caps it at net.core.somaxconn)
+    # effective_backlog: int - the length of the accept queue after the OS's cap
+    # max_accepts: int - the most connections accepted by a single take_new_connections call
     # lock: Lock
-    def __init__(self, family: AddressFamily, listen: bool, port: int):
+    # accepted: int - the total number of connections accepted
+    # accept_rate: float - connections accepted per second, over the last ACCEPT_RATE_INTERVAL seconds
+    # largest_drain: int - the most connections accepted by a single take_new_connections call
+    # full_drains: int - how many take_new_connections calls found the accept queue full, or still not empty after
+    #                     accepting max_accepts (connects beyond the queue may have been dropped, get_listen_overflows counts them)
+    # capped_drains: int - how many take_new_connections calls stopped at max_accepts, leaving connections queued
+    # rate_start: float - when the current accept rate interval started
+    # rate_count: int - the connections accepted in the current accept rate interval
+    def __init__(self, family: AddressFamily, listen: bool, port: int, options: SocketOptions | None = None,
+                 backlog: int = DEFAULT_BACKLOG, max_accepts: int = DEFAULT_MAX_ACCEPTS):
         self.listen = listen
-        self.listener_socket = create_listener_socket(family, self.listen, port)
+        self.backlog = backlog
+        somaxconn = get_somaxconn()
+        self.effective_backlog = backlog if somaxconn is None else min(backlog, somaxconn)
+        self.max_accepts = max_accepts
+        self.listener_socket = create_listener_socket(family, self.listen, port, options, backlog)
         self.local_endpoint = get_canonical_local_endpoint(self.listener_socket)
         self.lock = Lock()
+        self.accepted = 0
+        self.accept_rate = 0.0
+        self.largest_drain = 0
+        self.full_drains = 0
+        self.capped_drains = 0
+        self.rate_start = monotonic()
+        self.rate_count = 0
     
     def get_local_endpoint(self) -> IP_endpoint:
         return self.local_endpoint
 
-    def _ready_to_accept(self) -> bool:
-        try:
-            rlist, _, _ = select([self.listener_socket], [], [], 0)
-            return len(rlist) > 0
-        except:
-            return False
-    
+    # accepts until the (non blocking) listener socket runs out of queued connections, or max_accepts are accepted
+    # the accepted sockets are made blocking (BSDs pass the listener's O_NONBLOCK on) and close on exec (python always
+    # accepts with SOCK_CLOEXEC)
     def take_new_connections(self) -> list[socket]:
         with self.lock:
             new_connections : list[socket] = []
-            while self._ready_to_accept():
-                print("accept")
-                try:
-                    sock, _ = self.listener_socket.accept()
+            backlogged = False
+            if self.listen:
+                while len(new_connections) < self.max_accepts:
+                    try:
+                        sock, _ = self.listener_socket.accept()
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        debug_print(f"Accept Exception: {traceback.format_exc()}")
+                        break
+                    sock.setblocking(True)
                     new_connections.append(sock)
-                except:
-                    break
+                else:
+                    backlogged = self._has_queued()
+                    if backlogged:
+                        self.capped_drains += 1
+            self._count_accepts(len(new_connections), backlogged)
             return new_connections
+
+    # whether connections are still waiting in the accept queue
+    def _has_queued(self) -> bool:
+        try:
+            rlist, _, _ = select([self.listener_socket], [], [], 0)
+            return len(rlist) > 0
+        except (OSError, ValueError):
+            return False
+
+    def _count_accepts(self, count: int, backlogged: bool):
+        self.accepted += count
+        self.rate_count += count
+        self.largest_drain = max(self.largest_drain, count)
+        if backlogged or count >= self.effective_backlog:
+            self.full_drains += 1
+        now = monotonic()
+        if now - self.rate_start >= ACCEPT_RATE_INTERVAL:
+            self.accept_rate = self.rate_count / (now - self.rate_start)
+            self.rate_start = now
+            self.rate_count = 0
     
     def close(self):
         with self.lock:
@@ -45,14 +101,44 @@ class Listener:
             except Exception:
                 debug_print(f"Listener Close Exception: {traceback.format_exc()}")
 
-def create_listener_socket(family: AddressFamily, listen: bool, port: int) -> socket:
+def create_listener_socket(family: AddressFamily, listen: bool, port: int, options: SocketOptions | None = None,
+                           backlog: int = DEFAULT_BACKLOG) -> socket:
     listener = socket(family, SOCK_STREAM)
     if family == AF_INET6:
         listener.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
     make_socket_reusable(listener)
+    if options is not None:
+        options.apply_listener(listener) # buffer sizes must be set before listen() to affect the window scale
     listener.bind(('', port)) # bind the socket
     if listen:
-        print("listening")
-        listener.listen(10)
-    print(listener)
+        listener.listen(backlog)
+    listener.setblocking(False)
+    debug_print(f"listener: {listener}")
     return listener
+
+# returns the largest accept queue the OS allows (net.core.somaxconn), or None if it is not known
+def get_somaxconn() -> int | None:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        with open("/proc/sys/net/core/somaxconn") as somaxconn:
+            return int(somaxconn.read())
+    except (OSError, ValueError):
+        return None
+
+# returns the number of times the OS has dropped a connection because an accept queue was full (summed over all
+# listeners on the host, as linux only counts them globally), or None if it is not available
+def get_listen_overflows() -> int | None:
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        with open("/proc/net/netstat") as netstat:
+            lines = netstat.read().splitlines()
+    except OSError:
+        return None
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith("TcpExt:"):
+            fields = dict(zip(names.split()[1:], values.split()[1:]))
+            if "ListenOverflows" in fields:
+                return int(fields["ListenOverflows"])
+    return None
@@ -0,0 +1,321 @@
+import socket as socket_module
+from socket import socket, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_SNDBUF, SO_RCVBUF
+from struct import Struct
+from ipaddress import ip_address, IPv6Address
+from threading import Thread, Lock
+from time import monotonic
+import os
+import sys
+import traceback
+from common import MAX_DATAGRAM_SIZE, debug_print
+from budget import ReceiveBudget
+from iptools import *
+
+# Same host transport over abstract namespace unix sockets (linux only)
+# Every Server listens for unix stream connections and receives unix datagrams at names derived from its port.
+# stream: the dialing side sends LOCAL_HELLO (magic, port, the address it dialed as 16 bytes, ipv4 mapped into ipv6);
+#         the accepting side replies one byte (LOCAL_ACCEPT or LOCAL_REJECT), and from then on the stream carries reliable data.
+#         The address is the one the dialing side was given for the accepting side, so the accepting side names the
+#         connection by the same (host) address its own hole punches and path cache use, rather than always by loopback.
+# datagram: unreliable data is sent from the sender's datagram socket straight to the receiver's datagram socket.
+# Abstract names have no permissions, so any local process could bind or reach them: every stream (on both ends) and
+# every datagram has its peer's credentials checked, and only processes of the same user are talked to.
+LOCAL_MAGIC = b"TUL2"
+LOCAL_HELLO = Struct("!4sH16s")
+LOCAL_ACCEPT = b'\x01'
+LOCAL_REJECT = b'\x00'
+LOCAL_HELLO_TIMEOUT = 5
+LOCAL_DATAGRAM_BUFFER = 1024 * 1024
+LOCAL_CREDENTIALS = Struct("=iII") # struct ucred (pid, uid, gid), from SO_PEERCRED and SCM_CREDENTIALS
+
+def local_transport_supported() -> bool:
+    return sys.platform.startswith("linux") and hasattr(socket_module, "AF_UNIX")
+
+def local_stream_name(port: int) -> bytes:
+    return b"\0tuserver-stream-%d" % port
+
+def local_datagram_name(port: int) -> bytes:
+    return b"\0tuserver-dgram-%d" % port
+
+def pack_local_hello(port: int, address: str) -> bytes:
+    ip = ip_address(address)
+    if ip.version == 4:
+        ip = IPv6Address(b'\0' * 10 + b'\xff\xff' + ip.packed)
+    return LOCAL_HELLO.pack(LOCAL_MAGIC, port, ip.packed)
+
+# returns the address in a hello (ipv4 addresses as dotted quads)
+def unpack_local_address(packed: bytes) -> str:
+    ip = IPv6Address(packed)
+    return str(ip.ipv4_mapped) if ip.ipv4_mapped is not None else ip.compressed
+
+# returns the uid of the process at the other end of a unix stream socket (None if it can't be found)
+def get_peer_uid(socket: socket) -> int | None:
+    try:
+        _, uid, _ = LOCAL_CREDENTIALS.unpack(socket.getsockopt(SOL_SOCKET, socket_module.SO_PEERCRED, LOCAL_CREDENTIALS.size))
+        return uid
+    except (OSError, AttributeError):
+        return None
+
+# returns the uid of the sender of a datagram, from the SCM_CREDENTIALS the kernel attaches with SO_PASSCRED
+def get_sender_uid(ancillary: list[tuple[int, int, bytes]]) -> int | None:
+    for level, type, data in ancillary:
+        if level == SOL_SOCKET and type == socket_module.SCM_CREDENTIALS and len(data) >= LOCAL_CREDENTIALS.size:
+            return LOCAL_CREDENTIALS.unpack_from(data)[1]
+    return None
+
+# returns the port of the Server a local datagram name belongs to
+def local_datagram_port(name: bytes | str) -> int | None:
+    if isinstance(name, str):
+        name = name.encode()
+    prefix = local_datagram_name(0)[:-1]
+    if not name.startswith(prefix):
+        return None
+    try:
+        return int(name[len(prefix):])
+    except ValueError:
+        return None
+
+# returns the addresses of this host (the ones a peer on this host could be given as its address)
+def get_host_addresses(family: AddressFamily) -> set[str]:
+    addresses: set[str] = set()
+    try:
+        for info in getaddrinfo(gethostname(), None):
+            endpoint = get_canonical_endpoint(info[-1], family)
+            if endpoint is not None:
+                addresses.add(endpoint[ADDRESS])
+    except Exception:
+        pass
+    return addresses
+
+def is_host_address(address: str, host_addresses: set[str]) -> bool:
+    try:
+        ip = ip_address(address)
+    except ValueError:
+        return False
+    mapped = getattr(ip, "ipv4_mapped", None)
+    return ip.is_loopback or (mapped is not None and mapped.is_loopback) or address in host_addresses
+
+
+class LocalTransport:
+    # port: int - the port of the Server the names are derived from
+    # listener: socket - the unix stream socket accepting local connections
+    # datagram_socket: socket - the unix datagram socket used for unreliable data
+    # hellos: dict[socket, tuple[bytearray, float]] - accepted sockets that have not finished their hello, and when they were accepted
+    # uid: int - the user whose processes are accepted as peers
+    # rejected: int - connections and datagrams refused because they came from another user's process
+    # send_lock: Lock
+    # closed: bool
+    def __init__(self, port: int):
+        self.port = port
+        self.uid = os.getuid()
+        self.rejected = 0
+        self.listener = socket(AF_UNIX, SOCK_STREAM)
+        self.datagram_socket = socket(AF_UNIX, SOCK_DGRAM)
+        try:
+            self.listener.bind(local_stream_name(port))
+            self.listener.listen(128)
+            self.listener.setblocking(False)
+            self.datagram_socket.bind(local_datagram_name(port))
+            self.datagram_socket.setblocking(False)
+            self.datagram_socket.setsockopt(SOL_SOCKET, socket_module.SO_PASSCRED, 1)
+            for option in (SO_SNDBUF, SO_RCVBUF):
+                self.datagram_socket.setsockopt(SOL_SOCKET, option, LOCAL_DATAGRAM_BUFFER)
+        except:
+            self.listener.close()
+            self.datagram_socket.close()
+            raise
+        self.hellos: dict[socket, tuple[bytearray, float]] = {}
+        self.send_lock = Lock()
+        self.closed = False
+
+    # returns the sockets that have completed their hello, with the port of the Server that dialed them and the address it dialed
+    def take_hellos(self) -> list[tuple[socket, int, str]]:
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                debug_print(f"Local Accept Exception: {traceback.format_exc()}")
+                break
+            if get_peer_uid(client) != self.uid:
+                debug_print(f"local connection from another user refused")
+                self.rejected += 1
+                try_close(client)
+                continue
+            client.setblocking(False)
+            self.hellos[client] = (bytearray(), monotonic())
+        result: list[tuple[socket, int, str]] = []
+        now = monotonic()
+        for client, (buffer, start) in list(self.hellos.items()):
+            try:
+                data = client.recv(LOCAL_HELLO.size - len(buffer))
+                if not data:
+                    raise ConnectionError("closed during hello")
+                buffer += data
+            except BlockingIOError:
+                if now - start > LOCAL_HELLO_TIMEOUT:
+                    self._drop_hello(client)
+                continue
+            except OSError:
+                self._drop_hello(client)
+                continue
+            if len(buffer) < LOCAL_HELLO.size:
+                continue
+            del self.hellos[client]
+            magic, port, address = LOCAL_HELLO.unpack(buffer)
+            if magic != LOCAL_MAGIC:
+                try_close(client)
+                continue
+            result.append((client, port, unpack_local_address(address)))
+        return result
+
+    def _drop_hello(self, client: socket):
+        self.hellos.pop(client, None)
+        try_close(client)
+
+    def receive(self, budget: ReceiveBudget | None = None) -> list[tuple[bytes, int | None]]:
+        result: list[tuple[bytes, int | None]] = []
+        ancillary_size = socket_module.CMSG_SPACE(LOCAL_CREDENTIALS.size)
+        while budget is None or not budget.exhausted():
+            try:
+                data, ancillary, _, name = self.datagram_socket.recvmsg(MAX_DATAGRAM_SIZE, ancillary_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                break
+            if budget is not None:
+                budget.consume(len(data))
+            if get_sender_uid(ancillary) != self.uid:
+                self.rejected += 1
+                continue
+            if data != b'':
+                result.append((data, local_datagram_port(name)))
+        return result
+
+    # returns whether the data was sent
+    def send_to(self, data: bytes, port: int) -> bool:
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                self.datagram_socket.sendto(data, local_datagram_name(port))
+                return True
+            except OSError:
+                return False # receiver full or gone: unreliable data is dropped
+
+    def close(self):
+        with self.send_lock:
+            self.closed = True
+            for client in self.hellos:
+                try_close(client)
+            self.hellos.clear()
+            try_close(self.listener)
+            try_close(self.datagram_socket)
+
+
+class LocalConnector:
+    # port: int - the port of the Server dialing
+    # lock: Lock
+    # dialers: dict[IP_endpoint, tuple[socket, float | None]] - the sockets dialing local Servers, with the timeout to hole punch with if dialing fails
+    # fails: dict[IP_endpoint, float | None] - endpoints with no local Server, and the timeout to hole punch them with (yet to be managed)
+    # successes: list[tuple[socket, IP_endpoint]] - sockets that have been accepted by the local Server at the endpoint (yet to be managed)
+    def __init__(self, port: int):
+        self.port = port
+        self.lock = Lock()
+        self.dialers: dict[IP_endpoint, tuple[socket, float | None]] = {}
+        self.fails: dict[IP_endpoint, float | None] = {}
+        self.successes: list[tuple[socket, IP_endpoint]] = []
+
+    # whether a connection to the Server at the port is being dialed (or has been, but is yet to be managed)
+    def is_dialing_port(self, port: int) -> bool:
+        with self.lock:
+            return (any(endpoint[PORT] == port for endpoint in self.dialers)
+                    or any(endpoint[PORT] == port for _, endpoint in self.successes))
+
+    def dial(self, endpoint: IP_endpoint, timeout: float | None):
+        with self.lock:
+            if endpoint in self.dialers:
+                return
+            self.fails.pop(endpoint, None)
+            try:
+                local_socket = socket(AF_UNIX, SOCK_STREAM)
+            except Exception:
+                self.fails[endpoint] = timeout
+                return
+            self.dialers[endpoint] = (local_socket, timeout)
+            Thread(target=self.dial_thread, args=(local_socket, endpoint), daemon=True).start()
+
+    def _on_success(self, endpoint: IP_endpoint):
+        with self.lock:
+            if endpoint in self.dialers:
+                local_socket, _ = self.dialers.pop(endpoint)
+                self.successes.append((local_socket, endpoint))
+
+    def _on_fail(self, endpoint: IP_endpoint, rejected: bool):
+        with self.lock:
+            if endpoint in self.dialers:
+                local_socket, timeout = self.dialers.pop(endpoint)
+                try_close(local_socket)
+                if not rejected: # a rejected dial means the other Server is dialing this one instead
+                    self.fails[endpoint] = timeout
+
+    def remove_dialer(self, endpoint: IP_endpoint):
+        with self.lock:
+            if endpoint in self.dialers:
+                local_socket, _ = self.dialers.pop(endpoint)
+                try_close(local_socket)
+            self.fails.pop(endpoint, None)
+
+    def take_successes(self) -> list[tuple[socket, IP_endpoint]]:
+        with self.lock:
+            successes = self.successes
+            self.successes = []
+            return successes
+
+    def take_fails(self) -> list[tuple[IP_endpoint, float | None]]:
+        with self.lock:
+            fails = list(self.fails.items())
+            self.fails.clear()
+            return fails
+
+    def clear(self):
+        with self.lock:
+            for local_socket, _ in self.dialers.values():
+                try_close(local_socket)
+            for local_socket, _ in self.successes:
+                try_close(local_socket)
+            self.dialers.clear()
+            self.successes.clear()
+            self.fails.clear()
+
+    def dial_thread(self, local_socket: socket, endpoint: IP_endpoint):
+        try:
+            local_socket.settimeout(LOCAL_HELLO_TIMEOUT)
+            local_socket.connect(local_stream_name(endpoint[PORT]))
+        except Exception:
+            debug_print(f"Local Connect Exception: {traceback.format_exc()}")
+            self._on_fail(endpoint, rejected=False)
+            return
+        if get_peer_uid(local_socket) != os.getuid():
+            # another user's process holds the name, so don't talk to it (hole punching the endpoint instead)
+            debug_print(f"local Server at {endpoint} belongs to another user")
+            self._on_fail(endpoint, rejected=False)
+            return
+        try:
+            local_socket.sendall(pack_local_hello(self.port, endpoint[ADDRESS]))
+            reply = local_socket.recv(1)
+            if reply != LOCAL_ACCEPT:
+                self._on_fail(endpoint, rejected=reply == LOCAL_REJECT)
+                return
+            local_socket.settimeout(None)
+            self._on_success(endpoint)
+        except Exception:
+            debug_print(f"Local Hello Exception: {traceback.format_exc()}")
+            self._on_fail(endpoint, rejected=False)
+
+def try_close(socket: socket):
+    try:
+        socket.close()
+    except Exception:
+        debug_print(f"Closing Local Socket Exception: {traceback.format_exc()}")
@@ -0,0 +1,43 @@
+from sys import argv
+from time import perf_counter
+from random import random, randrange
+import pickle
+import json
+from messages import MessageCodec
+
+def bench(name: str, count: int, func):
+    start = perf_counter()
+    func()
+    elapsed = perf_counter() - start
+    print(f"{name:<24} {elapsed * 1000:8.2f} ms  {count / elapsed / 1e6:6.2f} M msgs/s")
+
+def main():
+    if len(argv) > 2:
+        print("Usage: python messagebenchmark.py [batches]")
+        exit()
+    batches = int(argv[1]) if len(argv) == 2 else 2000
+    batch_size = 50
+    count = batches * batch_size
+
+    codec = MessageCodec()
+    Position = codec.message("Position", 1, [("entity", "I"), ("x", "f"), ("y", "f"), ("z", "f")])
+    Health = codec.message("Health", 2, [("entity", "I"), ("health", "H"), ("alive", "?")])
+    messages = [Position(randrange(1000), random(), random(), random()) if i % 2 == 0 else Health(randrange(1000), randrange(100), True)
+                for i in range(batch_size)]
+    dicts = [message._asdict() | {"id": message._message_type.id} for message in messages]
+
+    encoded = codec.encode_batch(messages)
+    pickled = pickle.dumps(dicts, protocol=pickle.HIGHEST_PROTOCOL)
+    jsoned = json.dumps(dicts).encode()
+    print(f"{batches} batches of {batch_size} messages")
+    print(f"bytes per batch: struct {len(encoded)}, pickle {len(pickled)}, json {len(jsoned)}")
+
+    bench("struct encode", count, lambda: [codec.encode_batch(messages) for _ in range(batches)])
+    bench("pickle encode", count, lambda: [pickle.dumps(dicts, protocol=pickle.HIGHEST_PROTOCOL) for _ in range(batches)])
+    bench("json encode", count, lambda: [json.dumps(dicts).encode() for _ in range(batches)])
+    bench("struct decode", count, lambda: [codec.decode_batch(encoded) for _ in range(batches)])
+    bench("pickle decode", count, lambda: [pickle.loads(pickled) for _ in range(batches)])
+    bench("json decode", count, lambda: [json.loads(jsoned) for _ in range(batches)])
+
+if __name__ == "__main__":
+    main()
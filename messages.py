@@ -0,0 +1,150 @@
+from struct import Struct
+from collections import namedtuple
+from collections.abc import Callable
+from weakref import WeakKeyDictionary
+from typing import Any
+from connection import Connection
+
+# every message starts with its id, in network byte order
+MESSAGE_HEADER = Struct("!H")
+
+class MessageType:
+    # id: int - the id written in front of every message of this type
+    # name: str
+    # fields: list[tuple[str, str]] - the (name, struct format) of every field, in order
+    # struct: Struct - the compiled codec for the fields (not including the header)
+    # full_struct: Struct - the compiled codec for the header and fields, used for encoding
+    # size: int - the size of an encoded message including the header
+    # cls: type - the namedtuple class decoded messages are returned as
+    def __init__(self, id: int, name: str, fields: list[tuple[str, str]]):
+        self.id = id
+        self.name = name
+        self.fields = fields
+        formats = "".join(format for _, format in fields)
+        self.struct = Struct("!" + formats)
+        self.full_struct = Struct("!H" + formats)
+        self.size = self.full_struct.size
+        self.cls = namedtuple(name, [field for field, _ in fields])
+        self.cls._message_type = self
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.cls(*args, **kwargs)
+
+
+class MessageCodec:
+    # types: dict[int, MessageType] - the dispatch table of message types by id
+    # handlers: dict[int, Callable] - the handler for each message id
+    # streams: WeakKeyDictionary[Connection, bytearray] - partial reliable messages that have been received for each Connection
+    def __init__(self):
+        self.types: dict[int, MessageType] = {}
+        self.handlers: dict[int, Callable[[Any, Any, Connection], None]] = {}
+        self.streams: WeakKeyDictionary[Connection, bytearray] = WeakKeyDictionary()
+
+    # declares a message type; fields are (name, struct format) pairs of fixed size (e.g. "I", "f", "16s")
+    def message(self, name: str, id: int, fields: list[tuple[str, str]]) -> MessageType:
+        if id in self.types:
+            raise ValueError(f"message id {id} is already used by {self.types[id].name}")
+        if not 0 <= id <= 0xFFFF:
+            raise ValueError(f"message id {id} does not fit in the header")
+        message_type = MessageType(id, name, fields)
+        self.types[id] = message_type
+        return message_type
+
+    # sets the handler(server, message, connection) called for every received message of the type
+    def on(self, message_type: MessageType, handler: Callable[[Any, Any, Connection], None]):
+        self.handlers[message_type.id] = handler
+
+    def encoded_size(self, messages: list[Any]) -> int:
+        return sum(message._message_type.size for message in messages)
+
+    # writes the message into buffer at offset, and returns the offset after it
+    def encode_into(self, buffer: bytearray | memoryview, offset: int, message: Any) -> int:
+        message_type: MessageType = message._message_type
+        message_type.full_struct.pack_into(buffer, offset, message_type.id, *message)
+        return offset + message_type.size
+
+    def encode(self, message: Any) -> bytearray:
+        buffer = bytearray(message._message_type.size)
+        self.encode_into(buffer, 0, message)
+        return buffer
+
+    # encodes all the messages into a single buffer (to be sent in one packet or one send)
+    def encode_batch(self, messages: list[Any]) -> bytearray:
+        types = [message._message_type for message in messages]
+        buffer = bytearray(sum(message_type.size for message_type in types))
+        offset = 0
+        for message_type, message in zip(types, messages):
+            message_type.full_struct.pack_into(buffer, offset, message_type.id, *message)
+            offset += message_type.size
+        return buffer
+
+    # decodes the messages in data, and returns the offset of the first message that is incomplete
+    def _decode(self, data: bytes | bytearray | memoryview, messages: list[Any]) -> int:
+        offset = 0
+        end = len(data)
+        header_size = MESSAGE_HEADER.size
+        unpack_header = MESSAGE_HEADER.unpack_from
+        types = self.types
+        append = messages.append
+        new = tuple.__new__
+        while end - offset >= header_size:
+            id = unpack_header(data, offset)[0]
+            message_type = types.get(id)
+            if message_type is None:
+                raise ValueError(f"unknown message id {id}")
+            if end - offset < message_type.size:
+                break
+            append(new(message_type.cls, message_type.struct.unpack_from(data, offset + header_size)))
+            offset += message_type.size
+        return offset
+
+    # decodes every message in data (which must only contain whole messages, e.g. an unreliable packet)
+    def decode_batch(self, data: bytes | bytearray | memoryview) -> list[Any]:
+        messages: list[Any] = []
+        if self._decode(data, messages) != len(data):
+            raise ValueError("incomplete message")
+        return messages
+
+    # decodes the messages in data received from the connection's reliable stream,
+    # keeping any incomplete message until the rest of it arrives
+    def decode_stream(self, data: bytes, connection: Connection) -> list[Any]:
+        messages: list[Any] = []
+        buffer = self.streams.get(connection)
+        if buffer:
+            buffer += data
+            consumed = self._decode(buffer, messages)
+            del buffer[:consumed]
+            return messages
+        consumed = self._decode(data, messages)
+        if consumed != len(data):
+            self.streams[connection] = bytearray(memoryview(data)[consumed:])
+        return messages
+
+    def send_reliable(self, connection: Connection, messages: list[Any]):
+        connection.send_reliable(self.encode_batch(messages))
+
+    def send_unreliable(self, connection: Connection, messages: list[Any]):
+        connection.send_unreliable(self.encode_batch(messages))
+
+    def dispatch(self, server: Any, messages: list[Any], connection: Connection):
+        for message in messages:
+            handler = self.handlers.get(message._message_type.id)
+            if handler is not None:
+                handler(server, message, connection)
+
+    # callbacks to be passed to Server as on_receive_reliable/on_receive_unreliable
+    def on_receive_reliable(self, server: Any, data: bytes, connection: Connection):
+        try:
+            messages = self.decode_stream(data, connection)
+        except ValueError:
+            self.streams.pop(connection, None)
+            connection.close() # the stream can no longer be framed
+            return
+        self.dispatch(server, messages, connection)
+
+    def on_receive_unreliable(self, server: Any, data: bytes, connection: Connection):
+        try:
+            messages = self.decode_batch(data)
+        except ValueError:
+            return # drop malformed packets
+        self.dispatch(server, messages, connection)
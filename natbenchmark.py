@@ -0,0 +1,77 @@
+from sys import argv
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+from time import perf_counter, sleep
+from statistics import median
+from tcpudpserver import Server, Connection, IPV4
+from natemulator import NatEmulator, NAT_TYPES
+
+def free_port() -> int:
+    s = socket(AF_INET, SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+# returns the time from starting the hole punch until both sides have received data from the other, or None if they never do
+def trial(nat_types: tuple[str, str], latency: float, loss: float, timeout: float) -> float | None:
+    emulator = NatEmulator(latency, loss, hold_timeout=timeout)
+    emulator_thread = Thread(target=emulator.run, daemon=True)
+    emulator_thread.start()
+    ports = [free_port(), free_port()]
+    for port, nat_type in zip(ports, nat_types):
+        emulator.add_client(str(port), port, nat_type)
+    stun_hosts = [emulator.get_stun_endpoint()]
+    received: dict[int, float] = {}
+
+    def on_connect(server: Server, connection: Connection):
+        connection.send_reliable(b"hello")
+
+    def on_receive_reliable(server: Server, data: bytes, connection: Connection):
+        received.setdefault(server.get_local_endpoint()[1], perf_counter())
+
+    servers = [Server(on_connect, lambda *_: None, on_receive_reliable, lambda *_: None, lambda *_: None,
+                      stun_hosts, IPV4, port=port, local_transport=False) for port in ports]
+    external_endpoints = [server.get_external_endpoint() for server in servers]
+    result = None
+    if None not in external_endpoints:
+        start = perf_counter()
+        servers[0].hole_punch(external_endpoints[1], timeout)
+        servers[1].hole_punch(external_endpoints[0], timeout)
+        while perf_counter() - start < timeout and len(received) < 2:
+            for server in servers:
+                server.tick()
+            sleep(0.001)
+        if len(received) == 2:
+            result = max(received.values()) - start
+    for server in servers:
+        server.close()
+    emulator.close()
+    return result
+
+def main():
+    if len(argv) > 5:
+        print("Usage: python natbenchmark.py [trials] [latency] [loss] [timeout]")
+        exit()
+    trials = int(argv[1]) if len(argv) >= 2 else 5
+    latency = float(argv[2]) if len(argv) >= 3 else 0.02
+    loss = float(argv[3]) if len(argv) >= 4 else 0.0
+    timeout = float(argv[4]) if len(argv) >= 5 else 5.0
+
+    rows = []
+    for first in NAT_TYPES:
+        for second in NAT_TYPES:
+            if NAT_TYPES.index(second) < NAT_TYPES.index(first):
+                continue
+            times = [trial((first, second), latency, loss, timeout) for _ in range(trials)]
+            successes = [t for t in times if t is not None]
+            rows.append((first, second, len(successes), median(successes) if successes else None))
+
+    print(f"\n{trials} trials per pair, latency {latency * 1000:.0f} ms, loss {loss:.0%}, timeout {timeout} s")
+    print(f"{'NAT A':<12} {'NAT B':<12} {'success':>8} {'median ms':>10}")
+    for first, second, successes, time in rows:
+        time_text = f"{time * 1000:10.1f}" if time is not None else f"{'-':>10}"
+        print(f"{first:<12} {second:<12} {successes:>3}/{trials:<4} {time_text}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+from sys import argv
+from socket import *
+from threading import Thread
+from random import random
+from time import monotonic
+from struct import Struct
+import heapq
+import selectors
+import traceback
+from common import make_socket_reusable, debug_print
+from iptools import *
+
+# Userspace NAT emulator for testing hole punching on one machine
+# Every client Server is registered with its (internal) port and a NAT type. Clients are only ever given
+# external endpoints on the emulator, so all their traffic to each other passes through it:
+# - udp sent to an external port is forwarded to the port's owner if the owner's NAT lets it in,
+#   from the external port the sender's NAT mapped it to
+# - tcp connections to an external port are held (like SYNs being retransmitted) until the owner's NAT lets
+#   them in, then joined to the owner's matching outgoing connection (simultaneous open) or to the owner's listener
+# - a STUN stand-in reports each client's mapped port
+# A userspace emulator cannot stop the kernel completing the tcp handshake, so a client's connect succeeds
+# straight away; whether the hole punch worked is seen by whether data ever flows (held connections are
+# closed after hold_timeout).
+FULL_CONE = "full_cone"
+RESTRICTED = "restricted"
+SYMMETRIC = "symmetric"
+NAT_TYPES = (FULL_CONE, RESTRICTED, SYMMETRIC)
+SYN_RETRY_INTERVAL = 1
+HOLD_TIMEOUT = 5
+STUN_BINDING_RESPONSE = Struct("!HH16s")
+STUN_MAPPED_ADDRESS = Struct("!HHBBH4s")
+
+class NatClient:
+    # name: str
+    # internal_port: int - the port the client is really bound to
+    # nat_type: str - FULL_CONE, RESTRICTED or SYMMETRIC
+    # mappings: dict[int, int] - the external port used for each destination port (keyed by 0 for cone NATs, which use one port for all)
+    # permissions: dict[int, set[int]] - the remote ports each external port has sent to (and so will accept from)
+    def __init__(self, name: str, internal_port: int, nat_type: str):
+        if nat_type not in NAT_TYPES:
+            raise ValueError(f"unknown NAT type {nat_type}")
+        self.name = name
+        self.internal_port = internal_port
+        self.nat_type = nat_type
+        self.mappings: dict[int, int] = {}
+        self.permissions: dict[int, set[int]] = {}
+
+    def mapping_key(self, destination_port: int) -> int:
+        return destination_port if self.nat_type == SYMMETRIC else 0
+
+    def permits(self, external_port: int, source_port: int) -> bool:
+        if external_port not in self.permissions:
+            return False # no mapping on this port
+        return self.nat_type == FULL_CONE or source_port in self.permissions[external_port]
+
+
+class HeldConnection:
+    # client: NatClient - the client that connected
+    # socket: socket - the accepted connection from the client
+    # destination_port: int - the external port the client connected to
+    # mapping_port: int - the external port the client's NAT sent the connection from
+    # deadline: float - when the connection is given up on
+    # arrived: bool - whether the connection has reached the destination's NAT (rather than still being delayed by latency)
+    def __init__(self, client: NatClient, socket: socket, destination_port: int, mapping_port: int, deadline: float):
+        self.client = client
+        self.socket = socket
+        self.destination_port = destination_port
+        self.mapping_port = mapping_port
+        self.deadline = deadline
+        self.arrived = False
+
+
+class NatEmulator:
+    # host: str - the address every socket is bound to
+    # latency: float - the one way delay (in seconds) added to udp packets and tcp connection setup
+    # loss: float - the probability a udp packet (or tcp connection attempt) is dropped
+    # hold_timeout: float - how long a tcp connection is held waiting to be let in
+    # selector: DefaultSelector
+    # stun_socket: socket - the udp socket of the STUN stand-in
+    # clients: dict[int, NatClient] - the clients by internal port
+    # owners: dict[int, NatClient] - the clients by external port
+    # listeners: dict[socket, int] - the tcp listener of each external port
+    # udp_sockets: dict[int, socket] - the udp socket of each external port
+    # held: list[HeldConnection] - tcp connections that have not been let in yet (or have not yet arrived)
+    # established: set[tuple[int, int]] - the pairs of external ports with a tcp connection between them
+    # timers: list[tuple[float, int, Callable]] - a heap of actions to run later
+    # timer_count: int
+    # forwarded: int - the number of udp packets forwarded
+    # dropped: int - the number of udp packets dropped (by loss or filtering)
+    # closed: bool
+    def __init__(self, latency: float = 0, loss: float = 0, hold_timeout: float = HOLD_TIMEOUT, host: str = "127.0.0.1"):
+        self.host = host
+        self.latency = latency
+        self.loss = loss
+        self.hold_timeout = hold_timeout
+        self.selector = selectors.DefaultSelector()
+        self.stun_socket = socket(AF_INET, SOCK_DGRAM)
+        self.stun_socket.bind((host, 0))
+        self.stun_socket.setblocking(False)
+        self.selector.register(self.stun_socket, selectors.EVENT_READ)
+        self.clients: dict[int, NatClient] = {}
+        self.owners: dict[int, NatClient] = {}
+        self.listeners: dict[socket, int] = {}
+        self.udp_sockets: dict[int, socket] = {}
+        self.held: list[HeldConnection] = []
+        self.established: set[tuple[int, int]] = set()
+        self.timers: list = []
+        self.timer_count = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.closed = False
+
+    def add_client(self, name: str, internal_port: int, nat_type: str) -> NatClient:
+        client = NatClient(name, internal_port, nat_type)
+        self.clients[internal_port] = client
+        return client
+
+    def get_stun_endpoint(self) -> IPv4_endpoint:
+        return self.stun_socket.getsockname()
+
+    def get_mapped_endpoint(self, client: NatClient, destination_port: int) -> IPv4_endpoint:
+        return (self.host, self._mapping(client, destination_port))
+
+    def _open_port(self) -> int:
+        listener = socket(AF_INET, SOCK_STREAM)
+        make_socket_reusable(listener)
+        listener.bind((self.host, 0))
+        port = listener.getsockname()[PORT]
+        listener.listen(128)
+        listener.setblocking(False)
+        udp_socket = socket(AF_INET, SOCK_DGRAM)
+        make_socket_reusable(udp_socket)
+        udp_socket.bind((self.host, port))
+        udp_socket.setblocking(False)
+        self.listeners[listener] = port
+        self.udp_sockets[port] = udp_socket
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.selector.register(udp_socket, selectors.EVENT_READ)
+        return port
+
+    def _mapping(self, client: NatClient, destination_port: int) -> int:
+        key = client.mapping_key(destination_port)
+        if key not in client.mappings:
+            port = self._open_port()
+            client.mappings[key] = port
+            client.permissions[port] = set()
+            self.owners[port] = client
+        return client.mappings[key]
+
+    # records the client sending to the destination, and returns the external port it is sent from
+    def _outbound(self, client: NatClient, destination_port: int) -> int:
+        port = self._mapping(client, destination_port)
+        client.permissions[port].add(destination_port)
+        return port
+
+    def _schedule(self, delay: float, action):
+        self.timer_count += 1
+        heapq.heappush(self.timers, (monotonic() + delay, self.timer_count, action))
+
+    def _receive_stun(self):
+        while True:
+            try:
+                data, endpoint = self.stun_socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            client = self.clients.get(endpoint[PORT])
+            if client is None or len(data) < 20 or random() < self.loss:
+                continue
+            port = self._outbound(client, self.get_stun_endpoint()[PORT])
+            attribute = STUN_MAPPED_ADDRESS.pack(0x0001, 8, 0, 0x01, port, inet_aton(self.host))
+            response = STUN_BINDING_RESPONSE.pack(0x0101, len(attribute), data[4:20]) + attribute
+            self._schedule(self.latency, lambda response=response, endpoint=endpoint: self._send(self.stun_socket, response, endpoint))
+            self._retry_held()
+
+    def _send(self, sending_socket: socket, data: bytes, endpoint: IPv4_endpoint):
+        try:
+            sending_socket.sendto(data, endpoint)
+        except OSError:
+            pass
+
+    def _receive_udp(self, udp_socket: socket, destination_port: int):
+        while True:
+            try:
+                data, endpoint = udp_socket.recvfrom(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            client = self.clients.get(endpoint[PORT])
+            owner = self.owners.get(destination_port)
+            if client is None or owner is None:
+                continue
+            port = self._outbound(client, destination_port)
+            self._retry_held()
+            if random() < self.loss or not owner.permits(destination_port, port):
+                self.dropped += 1
+                continue
+            self.forwarded += 1
+            target = (self.host, owner.internal_port)
+            self._schedule(self.latency, lambda data=data, sending_socket=self.udp_sockets[port], target=target: self._send(sending_socket, data, target))
+
+    def _accept(self, listener: socket, destination_port: int):
+        while True:
+            try:
+                connection, endpoint = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            client = self.clients.get(endpoint[PORT])
+            if client is None or destination_port not in self.owners:
+                connection.close()
+                continue
+            connection.setblocking(True)
+            # the connection leaves the client's NAT (creating its mapping) now, and arrives after the latency
+            mapping_port = self._outbound(client, destination_port)
+            held = HeldConnection(client, connection, destination_port, mapping_port, monotonic() + self.hold_timeout)
+            self.held.append(held)
+            self._schedule(self.latency, lambda held=held: self._connect(held))
+
+    # a tcp connection attempt arriving at its destination's NAT
+    def _connect(self, held: HeldConnection):
+        if held not in self.held:
+            return # already joined to the owner's connection
+        if monotonic() >= held.deadline:
+            self.held.remove(held)
+            close_socket(held.socket)
+            return
+        if random() < self.loss:
+            self._schedule(SYN_RETRY_INTERVAL, lambda: self._connect(held))
+            return
+        held.arrived = True
+        if self.owners[held.destination_port].permits(held.destination_port, held.mapping_port):
+            self.held.remove(held)
+            self._establish(held)
+
+    def _establish(self, held: HeldConnection):
+        owner = self.owners[held.destination_port]
+        ports = (min(held.mapping_port, held.destination_port), max(held.mapping_port, held.destination_port))
+        # simultaneous open: the owner is also connecting along the same pair of ports
+        for other in self.held:
+            if other.client is owner and other.destination_port == held.mapping_port and other.mapping_port == held.destination_port:
+                self.held.remove(other)
+                self.established.add(ports)
+                start_pipes(held.socket, other.socket, lambda: self.established.discard(ports))
+                return
+        if ports in self.established:
+            close_socket(held.socket) # the pair of ports is already in use
+            return
+        # otherwise the connection reaches the owner's listener, from the port the client's NAT mapped it to
+        try:
+            inbound = socket(AF_INET, SOCK_STREAM)
+            make_socket_reusable(inbound)
+            inbound.bind((self.host, held.mapping_port))
+            inbound.connect((self.host, owner.internal_port))
+        except OSError:
+            debug_print(f"NAT Emulator Connect Exception: {traceback.format_exc()}")
+            close_socket(held.socket)
+            return
+        self.established.add(ports)
+        start_pipes(held.socket, inbound, lambda: self.established.discard(ports))
+
+    def _retry_held(self):
+        now = monotonic()
+        for held in list(self.held):
+            if held not in self.held:
+                continue # joined to another connection during this loop
+            if now >= held.deadline:
+                self.held.remove(held)
+                close_socket(held.socket)
+            elif held.arrived and self.owners[held.destination_port].permits(held.destination_port, held.mapping_port):
+                self.held.remove(held)
+                self._establish(held)
+
+    def tick(self, timeout: float = 0.05):
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - monotonic()))
+        for key, _ in self.selector.select(timeout):
+            s = key.fileobj
+            if s is self.stun_socket:
+                self._receive_stun()
+            elif s in self.listeners:
+                self._accept(s, self.listeners[s])
+            else:
+                self._receive_udp(s, s.getsockname()[PORT])
+        now = monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, action = heapq.heappop(self.timers)
+            action()
+        self._retry_held()
+
+    def run(self):
+        while not self.closed:
+            self.tick()
+
+    def close(self):
+        self.closed = True
+        for held in self.held:
+            close_socket(held.socket)
+        self.held.clear()
+        for s in list(self.listeners.keys()) + list(self.udp_sockets.values()) + [self.stun_socket]:
+            close_socket(s)
+        self.selector.close()
+
+
+def close_socket(s: socket):
+    try:
+        s.close()
+    except OSError:
+        pass
+
+def pipe(source: socket, destination: socket):
+    buffer = memoryview(bytearray(65536))
+    try:
+        while (n := source.recv_into(buffer)) > 0:
+            destination.sendall(buffer[:n])
+    except OSError:
+        pass
+    try:
+        destination.shutdown(SHUT_WR)
+    except OSError:
+        pass
+
+def start_pipes(first: socket, second: socket, on_close):
+    def run(source: socket, destination: socket, other: Thread | None):
+        pipe(source, destination)
+        if other is not None:
+            other.join()
+            close_socket(first)
+            close_socket(second)
+            on_close()
+    forward = Thread(target=run, args=(first, second, None), daemon=True)
+    forward.start()
+    Thread(target=run, args=(second, first, forward), daemon=True).start()
+
+
+def main():
+    if len(argv) < 2:
+        print("Usage: python natemulator.py port:nat_type [port:nat_type ...]")
+        print(f"nat_type is one of {', '.join(NAT_TYPES)}")
+        exit()
+    emulator = NatEmulator()
+    for arg in argv[1:]:
+        port, nat_type = arg.split(":")
+        emulator.add_client(arg, int(port), nat_type)
+    print(f"STUN server: {emulator.get_stun_endpoint()}")
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
+    emulator.close()
+
+if __name__ == "__main__":
+    main()
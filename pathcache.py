@@ -0,0 +1,165 @@
+from struct import Struct, error as StructError
+from threading import Lock
+from time import time, monotonic
+import os
+import traceback
+from common import debug_print
+from iptools import *
+
+# On disk cache of the paths that worked before a restart
+# The file is PATH_CACHE_MAGIC followed by records of PATH_CACHE_RECORD (kind, timestamp, port, key length, address length),
+# each followed by its key and address:
+# PATH_EXTERNAL: the key is the local port, the address and port are the external endpoint STUN reported for it
+# PATH_PEER: the key is the peer id, the address and port are the endpoint the last connection to the peer was made to
+# Timestamps are wall clock times, so entries stay comparable across restarts.
+# A forgotten peer is kept as an entry with an empty address until it expires, so merging an older file can't bring it back.
+PATH_CACHE_MAGIC = b"TUP1"
+PATH_CACHE_RECORD = Struct("!BdHBB")
+PATH_EXTERNAL = 0
+PATH_PEER = 1
+DEFAULT_EXTERNAL_TTL = 60 # NATs drop idle udp mappings after a minute or two
+DEFAULT_PEER_TTL = 24 * 60 * 60
+DEFAULT_SAVE_INTERVAL = 5 # changes are written at most this often (and on flush), never while a Server holds its lock
+
+class PathCache:
+    # path: str - the file the cache is kept in
+    # external_ttl: float - seconds a cached external endpoint is trusted instead of asking STUN again
+    # peer_ttl: float - seconds a cached peer endpoint is tried before the endpoint the peer was looked up at
+    # externals: dict[int, tuple[str, int, float]] - the external (address, port, timestamp) by local port
+    # peers: dict[str, tuple[str, int, float]] - the (address, port, timestamp) last connected to, by peer id
+    # save_interval: float - the most seconds a change waits before flush_if_due writes it
+    # dirty_since: float | None - when the first change not yet written was made (None if there is none)
+    # lock: Lock - guards the entries (never held during file I/O)
+    # save_lock: Lock - held while the file is read and written, so only one flush runs at a time
+    def __init__(self, path: str, external_ttl: float = DEFAULT_EXTERNAL_TTL, peer_ttl: float = DEFAULT_PEER_TTL,
+                 save_interval: float = DEFAULT_SAVE_INTERVAL):
+        self.path = path
+        self.external_ttl = external_ttl
+        self.peer_ttl = peer_ttl
+        self.externals: dict[int, tuple[str, int, float]] = {}
+        self.peers: dict[str, tuple[str, int, float]] = {}
+        self.save_interval = save_interval
+        self.dirty_since: float | None = None
+        self.lock = Lock()
+        self.save_lock = Lock()
+        data = self._read_file()
+        with self.lock:
+            self._merge(data)
+
+    def get_external(self, local_port: int, family: AddressFamily) -> IP_endpoint | None:
+        with self.lock:
+            return self._get_fresh(self.externals, local_port, self.external_ttl, family)
+
+    def remember_external(self, local_port: int, endpoint: IP_endpoint):
+        with self.lock:
+            self.externals[local_port] = (endpoint[ADDRESS], endpoint[PORT], time())
+            self._mark_dirty()
+
+    def get_peer(self, peer_id: str, family: AddressFamily) -> IP_endpoint | None:
+        with self.lock:
+            return self._get_fresh(self.peers, peer_id, self.peer_ttl, family)
+
+    def remember_peer(self, peer_id: str, endpoint: IP_endpoint):
+        with self.lock:
+            self.peers[peer_id] = (endpoint[ADDRESS], endpoint[PORT], time())
+            self._mark_dirty()
+
+    # forgets the cached endpoint of the peer (if it is still the given endpoint)
+    def forget_peer(self, peer_id: str, endpoint: IP_endpoint | None = None):
+        with self.lock:
+            entry = self.peers.get(peer_id)
+            if entry is None or (endpoint is not None and (entry[0], entry[1]) != (endpoint[ADDRESS], endpoint[PORT])):
+                return
+            self.peers[peer_id] = ("", 0, time())
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        if self.dirty_since is None:
+            self.dirty_since = monotonic()
+
+    # writes the changes if the oldest has waited save_interval (called by the Server every tick, outside its lock)
+    def flush_if_due(self):
+        dirty_since = self.dirty_since
+        if dirty_since is not None and monotonic() - dirty_since >= self.save_interval:
+            self.flush()
+
+    # writes the changes now (merged with the file, as another process may share it)
+    def flush(self):
+        with self.save_lock:
+            with self.lock:
+                if self.dirty_since is None:
+                    return
+                self.dirty_since = None
+            data = self._read_file()
+            with self.lock:
+                self._merge(data)
+                records = self._serialize()
+            # write a new file and rename it over the old one, so a crash never leaves half a cache behind
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(temporary, "wb") as file:
+                    file.write(records)
+                os.replace(temporary, self.path)
+            except OSError:
+                debug_print(f"Path Cache Write Exception: {traceback.format_exc()}")
+
+    def _get_fresh(self, entries: dict, key, ttl: float, family: AddressFamily) -> IP_endpoint | None:
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        address, port, timestamp = entry
+        if time() - timestamp > ttl:
+            del entries[key]
+            return None
+        if address == "":
+            return None
+        return resolve_to_canonical_endpoint((address, port), family)
+
+    def _read_file(self) -> bytes | None:
+        try:
+            with open(self.path, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            debug_print(f"Path Cache Read Exception: {traceback.format_exc()}")
+            return None
+
+    # merges the file's entries, keeping the newer of each entry (another process may share the file)
+    def _merge(self, data: bytes | None):
+        if data is None or not data.startswith(PATH_CACHE_MAGIC):
+            return
+        offset = len(PATH_CACHE_MAGIC)
+        try:
+            while offset < len(data):
+                kind, timestamp, port, key_length, address_length = PATH_CACHE_RECORD.unpack_from(data, offset)
+                offset += PATH_CACHE_RECORD.size
+                key = data[offset:offset + key_length].decode()
+                offset += key_length
+                address = data[offset:offset + address_length].decode()
+                offset += address_length
+                if kind == PATH_EXTERNAL:
+                    entries, key = self.externals, int(key)
+                elif kind == PATH_PEER:
+                    entries = self.peers
+                else:
+                    continue
+                if key not in entries or entries[key][2] < timestamp:
+                    entries[key] = (address, port, timestamp)
+        except (StructError, ValueError):
+            debug_print(f"Path Cache Corrupt: {self.path}")
+
+    def _serialize(self) -> bytes:
+        now = time()
+        records = [PATH_CACHE_MAGIC]
+        for kind, entries, ttl in ((PATH_EXTERNAL, self.externals, self.external_ttl), (PATH_PEER, self.peers, self.peer_ttl)):
+            for key, (address, port, timestamp) in list(entries.items()):
+                if now - timestamp > ttl:
+                    del entries[key]
+                    continue
+                key_bytes = str(key).encode()[:255]
+                address_bytes = address.encode()
+                records.append(PATH_CACHE_RECORD.pack(kind, timestamp, port, len(key_bytes), len(address_bytes)))
+                records.append(key_bytes)
+                records.append(address_bytes)
+        return b''.join(records)
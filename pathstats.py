@@ -0,0 +1,171 @@
+from struct import Struct
+from array import array
+from threading import Lock
+from time import monotonic
+
+# Path statistics header on unreliable packets (when a Server is created with measure_paths=True)
+# Every packet starts with STATS_HEADER (flags, sequence). The sequence numbers let the receiver count lost packets.
+# FLAG_PING: STATS_PING (the sender's timestamp) follows, to be echoed back
+# FLAG_PONG: STATS_PONG (an echoed timestamp, and how long the echo was held) follows
+# FLAG_DATA: the rest of the packet is data (packets without it only carry a ping or pong)
+# Pings and pongs ride on the last packet of each send, and are only sent on their own when there is nothing to ride on.
+# Timestamps are in TIMESTAMP_UNIT and wrap around, only their differences are meaningful.
+STATS_HEADER = Struct("!BI")
+STATS_PING = Struct("!I")
+STATS_PONG = Struct("!IH")
+MAX_STATS_OVERHEAD = STATS_HEADER.size + STATS_PING.size + STATS_PONG.size # the most the header adds to a packet
+FLAG_DATA = 1
+FLAG_PING = 2
+FLAG_PONG = 4
+SEQUENCE_MASK = 0xFFFFFFFF
+TIMESTAMP_UNIT = 0.0001
+PING_INTERVAL = 1
+MAX_ECHO_DELAY = 1 # pings held longer than this without being echoed are not echoed (the hold would not fit)
+STATS_CHECK_INTERVAL = 0.05 # how often the Server sends the pings and pongs that found nothing to ride on
+LOSS_INTERVAL = 1 # seconds of packets each loss sample covers
+RTT_SAMPLES = 64
+LOSS_SAMPLES = 16
+
+def stats_timestamp(now: float) -> int:
+    return int(now / TIMESTAMP_UNIT) & SEQUENCE_MASK
+
+
+class PathStats:
+    # the estimates are plain attributes and the samples fixed size arrays, so they can be read from any thread without locking
+    # srtt: float | None - the smoothed round trip time in seconds (as in RFC 6298), None until the first sample
+    # rttvar: float - the round trip time variation in seconds
+    # jitter: float - the smoothed difference between consecutive round trip times in seconds
+    # loss: float - the fraction of the peer's packets lost over the last complete LOSS_INTERVAL
+    # rtt_samples: array[float] - the last RTT_SAMPLES round trip times (a ring, rtt_count % RTT_SAMPLES is the next slot)
+    # rtt_count: int - the number of round trip times measured
+    # loss_samples: array[float] - the last LOSS_SAMPLES loss fractions (a ring like rtt_samples)
+    # loss_count: int - the number of loss fractions measured
+    # sequence: int - the sequence of the next packet sent
+    # last_ping: float - when the last ping was sent
+    # echo: tuple[int, float] | None - the timestamp of the peer's last ping and when it arrived, until it is echoed
+    # highest: int | None - the highest sequence received
+    # interval_base: int - the first sequence of the current loss interval
+    # interval_received: int - the packets received in the current loss interval
+    # interval_start: float - when the current loss interval started
+    # lock: Lock
+    def __init__(self):
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        self.jitter = 0.0
+        self.loss = 0.0
+        self.rtt_samples = array("d", bytes(8 * RTT_SAMPLES))
+        self.rtt_count = 0
+        self.loss_samples = array("d", bytes(8 * LOSS_SAMPLES))
+        self.loss_count = 0
+        self.sequence = 0
+        self.last_ping = float("-inf")
+        self.echo: tuple[int, float] | None = None
+        self.highest: int | None = None
+        self.interval_base = 0
+        self.interval_received = 0
+        self.interval_start = monotonic()
+        self.lock = Lock()
+
+    # returns the round trip times measured, oldest first
+    def get_rtt_samples(self) -> list[float]:
+        return _ordered(self.rtt_samples, self.rtt_count)
+
+    # returns the loss fractions measured, oldest first
+    def get_loss_samples(self) -> list[float]:
+        return _ordered(self.loss_samples, self.loss_count)
+
+    # returns the packets with the header in front, with any ping or pong due riding on the last one
+    def wrap_many(self, packets: list[bytes]) -> list[bytes]:
+        now = monotonic()
+        with self.lock:
+            result = []
+            for packet in packets[:-1]:
+                result.append(STATS_HEADER.pack(FLAG_DATA, self.sequence) + packet)
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            if packets:
+                flags, extra = self._piggyback(now)
+                result.append(STATS_HEADER.pack(FLAG_DATA | flags, self.sequence) + extra + packets[-1])
+                self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            return result
+
+    # returns a packet carrying the ping or pong that is due, if any
+    def control_packet(self, now: float) -> bytes | None:
+        with self.lock:
+            flags, extra = self._piggyback(now)
+            if flags == 0:
+                return None
+            packet = STATS_HEADER.pack(flags, self.sequence) + extra
+            self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            return packet
+
+    def _piggyback(self, now: float) -> tuple[int, bytes]:
+        flags = 0
+        extra = b''
+        if now - self.last_ping >= PING_INTERVAL:
+            flags |= FLAG_PING
+            extra += STATS_PING.pack(stats_timestamp(now))
+            self.last_ping = now
+        if self.echo is not None:
+            timestamp, arrived = self.echo
+            self.echo = None
+            if now - arrived < MAX_ECHO_DELAY:
+                flags |= FLAG_PONG
+                extra += STATS_PONG.pack(timestamp, int((now - arrived) / TIMESTAMP_UNIT))
+        return flags, extra
+
+    # updates the estimates with a received packet, returning its data (None if it carried none)
+    def receive(self, data: bytes) -> bytes | None:
+        if len(data) < STATS_HEADER.size:
+            return None
+        now = monotonic()
+        flags, sequence = STATS_HEADER.unpack_from(data)
+        offset = STATS_HEADER.size
+        with self.lock:
+            self._count(sequence, now)
+            if flags & FLAG_PING and len(data) >= offset + STATS_PING.size:
+                self.echo = (STATS_PING.unpack_from(data, offset)[0], now)
+                offset += STATS_PING.size
+            if flags & FLAG_PONG and len(data) >= offset + STATS_PONG.size:
+                echoed, held = STATS_PONG.unpack_from(data, offset)
+                offset += STATS_PONG.size
+                elapsed = (stats_timestamp(now) - echoed) & SEQUENCE_MASK
+                if elapsed >= held:
+                    self._add_rtt((elapsed - held) * TIMESTAMP_UNIT)
+        if not flags & FLAG_DATA:
+            return None
+        return data[offset:]
+
+    def _count(self, sequence: int, now: float):
+        if self.highest is None:
+            self.highest = sequence
+            self.interval_base = sequence
+        elif (sequence - self.highest) & SEQUENCE_MASK < 0x80000000:
+            self.highest = sequence
+        self.interval_received += 1
+        if now - self.interval_start >= LOSS_INTERVAL:
+            expected = ((self.highest - self.interval_base) & SEQUENCE_MASK) + 1
+            self.loss = max(0.0, 1 - self.interval_received / expected)
+            self.loss_samples[self.loss_count % LOSS_SAMPLES] = self.loss
+            self.loss_count += 1
+            self.interval_base = (self.highest + 1) & SEQUENCE_MASK
+            self.interval_received = 0
+            self.interval_start = now
+
+    def _add_rtt(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+            previous = self.rtt_samples[(self.rtt_count - 1) % RTT_SAMPLES]
+            self.jitter += (abs(rtt - previous) - self.jitter) / 16
+        self.rtt_samples[self.rtt_count % RTT_SAMPLES] = rtt
+        self.rtt_count += 1
+
+def _ordered(ring: array, count: int) -> list[float]:
+    samples = ring.tolist()
+    if count <= len(samples):
+        return samples[:count]
+    start = count % len(samples)
+    return samples[start:] + samples[:start]
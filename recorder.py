@@ -0,0 +1,162 @@
+from struct import Struct
+from threading import Lock, Condition, Thread
+from time import monotonic
+from mmap import mmap, ACCESS_READ
+from collections.abc import Iterator
+import os
+import traceback
+from common import debug_print
+from connection import Connection
+
+# Traffic recordings (when a Server is created with a TrafficRecorder)
+# The file is RECORDING_MAGIC followed by records of RECORD_HEADER (kind, time, connection, length), each followed by length bytes.
+# Time is seconds since the recorder was created, connection numbers the Connections in the order they connected.
+# RECORD_CONNECT / RECORD_DISCONNECT: a Connection connected or disconnected (no payload)
+# RECORD_RELIABLE / RECORD_UNRELIABLE: data received from a Connection, as handed to the callback
+# RECORD_SIZE_ONLY is set on the kind of data records whose payload was left out (only its length was kept), which
+# can't be replayed faithfully.
+# Every recorder appends a RECORD_START first, so a file can hold several sessions, with times restarting at each.
+# Records are only ever appended, so a recording cut short by a crash is read up to its last whole record.
+RECORDING_MAGIC = b"TUREC1" # distinct from relay.RELAY_MAGIC, so a recording is never mistaken for relay traffic
+RECORD_HEADER = Struct("!BdII")
+RECORD_START = 0
+RECORD_CONNECT = 1
+RECORD_DISCONNECT = 2
+RECORD_RELIABLE = 3
+RECORD_UNRELIABLE = 4
+RECORD_SIZE_ONLY = 0x80
+RECORDER_FLUSH_SIZE = 256 * 1024 # the writer is woken once this many bytes of records are waiting
+RECORDER_FLUSH_INTERVAL = 1 # and writes what is waiting at least this often
+RECORDER_MAX_BUFFER = 64 * 1024 * 1024 # records are dropped while the writer is this far behind
+
+class TrafficRecorder:
+    # records are collected in memory on the tick thread, and written by a writer thread (so a tick never waits on the disk)
+    # path: str - the file records are appended to
+    # payloads: bool - whether the data is kept (False keeps only its length, so a recording holds no user data but can't be replayed)
+    # file: BufferedWriter - closed by the writer thread once the recorder is closed
+    # start: float - the monotonic time times are measured from
+    # connection_numbers: dict[Connection, int] - the number of every connected Connection
+    # next_number: int
+    # records: int - the number of records made
+    # dropped: int - the number of records dropped because the writer fell RECORDER_MAX_BUFFER bytes behind (or failed)
+    # buffer: bytearray - the records yet to be written
+    # failed: bool - whether writing failed (nothing more is recorded)
+    # closed: bool
+    # lock: Lock
+    # condition: Condition - wakes the writer when the buffer is full or the recorder closes
+    # thread: Thread - the writer
+    def __init__(self, path: str, payloads: bool = True):
+        self.path = path
+        self.payloads = payloads
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(RECORDING_MAGIC)
+        self.start = monotonic()
+        self.connection_numbers: dict[Connection, int] = {}
+        self.next_number = 0
+        self.records = 0
+        self.dropped = 0
+        self.buffer = bytearray()
+        self.failed = False
+        self.closed = False
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self._write(RECORD_START, 0.0, 0, b'')
+        self.thread = Thread(target=self.write_thread, daemon=True)
+        self.thread.start()
+
+    # records one tick's events, in the order the Server hands them to its callbacks
+    def record_tick(self, new_connections: list[Connection], disconnects: list[Connection],
+                    receive_unreliable: list[tuple[bytes, Connection]], receive_reliable: list[tuple[bytes, Connection]]):
+        with self.lock:
+            if self.closed:
+                return
+            now = monotonic() - self.start
+            for connection in new_connections:
+                self._write(RECORD_CONNECT, now, self._number(connection), b'')
+            for connection in disconnects:
+                self._write(RECORD_DISCONNECT, now, self._number(connection), b'')
+                self.connection_numbers.pop(connection, None)
+            for data, connection in receive_unreliable:
+                self._write_data(RECORD_UNRELIABLE, now, connection, data)
+            for data, connection in receive_reliable:
+                self._write_data(RECORD_RELIABLE, now, connection, data)
+            if len(self.buffer) >= RECORDER_FLUSH_SIZE:
+                self.condition.notify()
+
+    def _number(self, connection: Connection) -> int:
+        number = self.connection_numbers.get(connection)
+        if number is None:
+            number = self.next_number
+            self.next_number += 1
+            self.connection_numbers[connection] = number
+        return number
+
+    def _write_data(self, kind: int, now: float, connection: Connection, data: bytes):
+        if self.payloads:
+            self._write(kind, now, self._number(connection), data)
+        else:
+            self._write(kind | RECORD_SIZE_ONLY, now, self._number(connection), b'', len(data))
+
+    def _write(self, kind: int, now: float, number: int, data: bytes, length: int | None = None):
+        if self.failed or len(self.buffer) >= RECORDER_MAX_BUFFER:
+            self.dropped += 1
+            return
+        self.buffer += RECORD_HEADER.pack(kind, now, number, len(data) if length is None else length)
+        self.buffer += data
+        self.records += 1
+
+    # writes the buffer whenever it fills up, and at least every RECORDER_FLUSH_INTERVAL
+    def write_thread(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or len(self.buffer) >= RECORDER_FLUSH_SIZE, RECORDER_FLUSH_INTERVAL)
+                data = self.buffer
+                self.buffer = bytearray()
+                closing = self.closed
+            if data and not self.failed:
+                try:
+                    self.file.write(data)
+                    self.file.flush()
+                except OSError:
+                    debug_print(f"Recorder Write Exception: {traceback.format_exc()}")
+                    self.failed = True
+            if closing:
+                try:
+                    self.file.close()
+                except OSError:
+                    pass
+                return
+
+    # writes what is left and closes the file
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.connection_numbers.clear()
+            self.condition.notify()
+        self.thread.join()
+
+# yields the (kind, time, connection, payload) of every whole record in the recording, reading it through mmap
+# a payload is only valid until the next record is read (copy it to keep it), and is its length for size only records
+def read_recording(path: str) -> Iterator[tuple[int, float, int, memoryview | int]]:
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size < len(RECORDING_MAGIC):
+            return
+        with mmap(file.fileno(), 0, access=ACCESS_READ) as data:
+            if data[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+                raise ValueError(f"{path} is not a traffic recording")
+            offset = len(RECORDING_MAGIC)
+            while offset + RECORD_HEADER.size <= len(data):
+                kind, time, number, length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if kind & RECORD_SIZE_ONLY:
+                    yield kind & ~RECORD_SIZE_ONLY, time, number, length
+                    continue
+                if offset + length > len(data):
+                    return # cut short while being written
+                # released before moving on, as the mmap can't be closed while a view of it is alive
+                with memoryview(data)[offset:offset + length] as payload:
+                    yield kind, time, number, payload
+                offset += length
@@ -0,0 +1,323 @@
+from sys import argv
+from socket import *
+from struct import Struct
+from hashlib import sha256
+from hmac import new as hmac_new
+from os import urandom
+from time import monotonic
+import selectors
+import traceback
+from common import make_socket_reusable, debug_print
+from socketoptions import try_setsockopt
+from iptools import *
+
+# Relay protocol
+# tcp: the client sends RELAY_HELLO (magic, token). When a second client sends the same token, the relay
+#      replies RELAY_PAIRED (magic, session, side) to both, and from then on forwards the streams unchanged.
+# udp: every datagram starts with RELAY_HEADER (session, side). The relay learns each side's udp endpoint
+#      from the datagrams it sends, and forwards each datagram unchanged to the other side.
+RELAY_MAGIC = b"TUR1"
+RELAY_HELLO = Struct("!4s16s")
+RELAY_PAIRED = Struct("!4sQB")
+RELAY_HEADER = Struct("!QB")
+RELAY_PAIR_TIMEOUT = 30
+RELAY_BUFSIZE = 65536
+RELAY_UDP_BUFFER = 4 * 1024 * 1024
+
+# the token both sides of a relayed connection compute from their endpoints, so they are paired together
+# the secret is shared by the two peers (e.g. handed out with their endpoints) and never sent to the relay,
+# so nobody who only knows or guesses the endpoints can compute the token and take the place of a peer
+def relay_token(secret: bytes, endpoint: IP_endpoint, other_endpoint: IP_endpoint) -> bytes:
+    names = sorted(f"[{e[ADDRESS]}]:{e[PORT]}" for e in (get_canonical_ipv6(endpoint), get_canonical_ipv6(other_endpoint)))
+    return hmac_new(secret, "/".join(names).encode(), sha256).digest()[:16]
+
+
+class RelayPipe:
+    # source: socket - the socket data is read from
+    # destination: socket - the socket data is written to
+    # buffer: memoryview - a reusable buffer holding data that has been read but not yet written
+    # start: int - the start of the unwritten data in buffer
+    # end: int - the end of the unwritten data in buffer
+    def __init__(self, source: socket, destination: socket):
+        self.source = source
+        self.destination = destination
+        self.buffer = memoryview(bytearray(RELAY_BUFSIZE))
+        self.start = 0
+        self.end = 0
+
+    def pending(self) -> bool:
+        return self.start < self.end
+
+    # reads into the (empty) buffer, and returns the number of bytes read (0 if the source has closed)
+    def fill(self) -> int:
+        n = self.source.recv_into(self.buffer)
+        self.start, self.end = 0, n
+        return n
+
+    # writes as much of the pending data as the destination will take without blocking
+    def flush(self):
+        while self.pending():
+            try:
+                self.start += self.destination.send(self.buffer[self.start:self.end])
+            except BlockingIOError:
+                return
+
+
+class RelaySession:
+    # id: int - the session id used in udp headers
+    # sockets: list[socket] - the tcp socket of each side
+    # pipes: list[RelayPipe] - the pipe carrying data from each side to the other
+    # udp_endpoints: list[IP_endpoint | None] - the last udp endpoint seen from each side
+    def __init__(self, id: int, first: socket, second: socket):
+        self.id = id
+        self.sockets = [first, second]
+        self.pipes = [RelayPipe(first, second), RelayPipe(second, first)]
+        self.udp_endpoints: list[IP_endpoint | None] = [None, None]
+
+
+class RelayServer:
+    # family: AddressFamily
+    # listener: socket - the tcp socket accepting clients
+    # udp_socket: socket - the udp socket forwarding datagrams (bound to the same port as the listener)
+    # local_endpoint: IP_endpoint
+    # selector: DefaultSelector
+    # hellos: dict[socket, tuple[bytearray, float]] - clients that have not finished sending their hello, and when they connected
+    # waiting: dict[bytes, tuple[socket, float]] - clients waiting for their pair, by token
+    # sessions: dict[int, RelaySession] - the paired clients, by session id
+    # socket_sessions: dict[socket, RelaySession]
+    # udp_buffer: memoryview - the reusable buffer datagrams are received into
+    # forwarded_bytes: int - the number of tcp bytes forwarded
+    # forwarded_datagrams: int - the number of udp datagrams forwarded
+    # closed: bool
+    def __init__(self, family: AddressFamily, port: int):
+        self.family = family
+        self.listener = socket(family, SOCK_STREAM)
+        self.udp_socket = socket(family, SOCK_DGRAM)
+        for s in (self.listener, self.udp_socket):
+            if family == AF_INET6:
+                s.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
+            make_socket_reusable(s)
+            s.bind(("", port))
+            port = s.getsockname()[PORT]
+            s.setblocking(False)
+        self.listener.listen(128)
+        try_setsockopt(self.udp_socket, SOL_SOCKET, SO_RCVBUF, RELAY_UDP_BUFFER)
+        try_setsockopt(self.udp_socket, SOL_SOCKET, SO_SNDBUF, RELAY_UDP_BUFFER)
+        self.local_endpoint = get_canonical_local_endpoint(self.listener)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        self.hellos: dict[socket, tuple[bytearray, float]] = {}
+        self.waiting: dict[bytes, tuple[socket, float]] = {}
+        self.sessions: dict[int, RelaySession] = {}
+        self.socket_sessions: dict[socket, RelaySession] = {}
+        self.udp_buffer = memoryview(bytearray(RELAY_BUFSIZE))
+        self.forwarded_bytes = 0
+        self.forwarded_datagrams = 0
+        self.closed = False
+
+    def get_local_endpoint(self) -> IP_endpoint:
+        return self.local_endpoint
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                debug_print(f"Relay Accept Exception: {traceback.format_exc()}")
+                return
+            client.setblocking(False)
+            client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            self.hellos[client] = (bytearray(), monotonic())
+            self.selector.register(client, selectors.EVENT_READ)
+
+    def _read_hello(self, client: socket):
+        buffer, _ = self.hellos[client]
+        try:
+            data = client.recv(RELAY_HELLO.size - len(buffer))
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close_client(client)
+            return
+        buffer += data
+        if len(buffer) < RELAY_HELLO.size:
+            return
+        del self.hellos[client]
+        magic, token = RELAY_HELLO.unpack(buffer)
+        if magic != RELAY_MAGIC:
+            self._close_client(client)
+            return
+        if token not in self.waiting:
+            self.waiting[token] = (client, monotonic())
+            return
+        other, _ = self.waiting.pop(token)
+        self._pair(other, client)
+
+    def _pair(self, first: socket, second: socket):
+        id = int.from_bytes(urandom(8), "big")
+        while id in self.sessions:
+            id = int.from_bytes(urandom(8), "big")
+        session = RelaySession(id, first, second)
+        self.sessions[id] = session
+        for side, s in enumerate(session.sockets):
+            self.socket_sessions[s] = session
+            try:
+                s.sendall(RELAY_PAIRED.pack(RELAY_MAGIC, id, side)) # small enough to never block on a fresh socket
+            except OSError:
+                self._close_session(session)
+                return
+
+    def _update_events(self, session: RelaySession):
+        for side, s in enumerate(session.sockets):
+            # stop reading from a side until what it sent has been written, and only wait to write when there is data
+            events = 0
+            if not session.pipes[side].pending():
+                events |= selectors.EVENT_READ
+            if session.pipes[1 - side].pending():
+                events |= selectors.EVENT_WRITE
+            registered = s in self.selector.get_map()
+            if events == 0:
+                if registered:
+                    self.selector.unregister(s)
+            elif registered:
+                self.selector.modify(s, events)
+            else:
+                self.selector.register(s, events)
+
+    def _forward(self, client: socket, events: int):
+        session = self.socket_sessions[client]
+        side = session.sockets.index(client)
+        outgoing = session.pipes[side]
+        try:
+            if events & selectors.EVENT_WRITE:
+                session.pipes[1 - side].flush()
+            if events & selectors.EVENT_READ and not outgoing.pending():
+                n = outgoing.fill()
+                if n == 0:
+                    self._close_session(session)
+                    return
+                self.forwarded_bytes += n
+                outgoing.flush()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._close_session(session)
+            return
+        self._update_events(session)
+
+    def _forward_datagrams(self):
+        while True:
+            try:
+                n, endpoint = self.udp_socket.recvfrom_into(self.udp_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue # e.g. icmp port unreachable from a client that has gone
+            if n < RELAY_HEADER.size:
+                continue # keep alive
+            id, side = RELAY_HEADER.unpack_from(self.udp_buffer)
+            session = self.sessions.get(id)
+            if session is None or side > 1:
+                continue
+            session.udp_endpoints[side] = endpoint
+            other = session.udp_endpoints[1 - side]
+            if other is None:
+                continue
+            try:
+                self.udp_socket.sendto(self.udp_buffer[:n], other)
+                self.forwarded_datagrams += 1
+            except OSError:
+                continue
+
+    def _close_client(self, client: socket):
+        self.hellos.pop(client, None)
+        if client in self.selector.get_map():
+            self.selector.unregister(client)
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def _close_session(self, session: RelaySession):
+        if self.sessions.pop(session.id, None) is None:
+            return
+        for s in session.sockets:
+            self.socket_sessions.pop(s, None)
+            self._close_client(s)
+
+    def _expire(self):
+        now = monotonic()
+        for client, (_, start) in list(self.hellos.items()):
+            if now - start > RELAY_PAIR_TIMEOUT:
+                self._close_client(client)
+        for token, (client, start) in list(self.waiting.items()):
+            if now - start > RELAY_PAIR_TIMEOUT:
+                del self.waiting[token]
+                self._close_client(client)
+
+    def tick(self, timeout: float | None = 1):
+        for key, events in self.selector.select(timeout):
+            s = key.fileobj
+            if s.fileno() < 0:
+                continue # closed by an earlier event this tick
+            if s is self.listener:
+                self._accept()
+            elif s is self.udp_socket:
+                self._forward_datagrams()
+            elif s in self.hellos:
+                self._read_hello(s)
+            elif s in self.socket_sessions:
+                self._forward(s, events)
+            else:
+                # waiting for its pair: the only thing a waiting client can do is disconnect
+                self._close_waiting(s)
+        self._expire()
+
+    def _close_waiting(self, client: socket):
+        try:
+            if client.recv(1, MSG_PEEK) != b'':
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        for token, (waiting, _) in list(self.waiting.items()):
+            if waiting is client:
+                del self.waiting[token]
+        self._close_client(client)
+
+    def run(self):
+        while not self.closed:
+            self.tick()
+
+    def close(self):
+        self.closed = True
+        for session in list(self.sessions.values()):
+            self._close_session(session)
+        for client in list(self.hellos.keys()) + [client for client, _ in self.waiting.values()]:
+            self._close_client(client)
+        self.waiting.clear()
+        self.selector.close()
+        self.listener.close()
+        self.udp_socket.close()
+
+
+def main():
+    if len(argv) != 2:
+        print("Usage: python relay.py port")
+        exit()
+    relay = RelayServer(AF_INET6, int(argv[1]))
+    print(f"relaying on {relay.get_local_endpoint()}")
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        pass
+    relay.close()
+
+if __name__ == "__main__":
+    main()
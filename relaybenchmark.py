@@ -0,0 +1,95 @@
+from sys import argv
+from socket import *
+from threading import Thread
+from time import perf_counter
+from relay import RelayServer, RELAY_MAGIC, RELAY_HELLO, RELAY_PAIRED, RELAY_HEADER
+
+def pair(relay_endpoint: tuple[str, int]) -> list[tuple[socket, int, int]]:
+    token = b"relaybenchmark!!"
+    clients = [create_connection(relay_endpoint) for _ in range(2)]
+    for client in clients:
+        client.sendall(RELAY_HELLO.pack(RELAY_MAGIC, token))
+    result = []
+    for client in clients:
+        reply = b''
+        while len(reply) < RELAY_PAIRED.size:
+            reply += client.recv(RELAY_PAIRED.size - len(reply))
+        _, session, side = RELAY_PAIRED.unpack(reply)
+        result.append((client, session, side))
+    return result
+
+def bench_tcp(relay_endpoint: tuple[str, int], megabytes: int):
+    (sender, _, _), (receiver, _, _) = pair(relay_endpoint)
+    total = megabytes * 1024 * 1024
+    chunk = bytes(65536)
+
+    def send():
+        sent = 0
+        while sent < total:
+            sender.sendall(chunk)
+            sent += len(chunk)
+
+    buffer = memoryview(bytearray(65536))
+    start = perf_counter()
+    send_thread = Thread(target=send)
+    send_thread.start()
+    received = 0
+    while received < total:
+        received += receiver.recv_into(buffer)
+    elapsed = perf_counter() - start
+    send_thread.join()
+    print(f"tcp: {megabytes} MB in {elapsed:.2f} s = {megabytes / elapsed:.1f} MB/s")
+    sender.close()
+    receiver.close()
+
+def bench_udp(relay_endpoint: tuple[str, int], count: int, size: int):
+    (first, session, side), (second, _, other_side) = pair(relay_endpoint)
+    sender = socket(AF_INET, SOCK_DGRAM)
+    receiver = socket(AF_INET, SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 * 1024 * 1024)
+    receiver.settimeout(1)
+    # register the receiver's udp endpoint with the relay
+    receiver.sendto(RELAY_HEADER.pack(session, other_side), relay_endpoint)
+    packet = RELAY_HEADER.pack(session, side) + bytes(size)
+    sender.sendto(packet, relay_endpoint)
+    receiver.recv(65536)
+
+    buffer = memoryview(bytearray(65536))
+    received = 0
+    start = perf_counter()
+    def send():
+        for _ in range(count):
+            sender.sendto(packet, relay_endpoint)
+    send_thread = Thread(target=send)
+    send_thread.start()
+    last = start
+    try:
+        while received < count:
+            receiver.recv_into(buffer)
+            received += 1
+            last = perf_counter()
+    except timeout:
+        pass
+    elapsed = last - start
+    send_thread.join()
+    print(f"udp: {received}/{count} datagrams of {size} bytes in {elapsed:.2f} s = {received / elapsed:.0f} datagrams/s")
+    for s in (first, second, sender, receiver):
+        s.close()
+
+def main():
+    if len(argv) > 3:
+        print("Usage: python relaybenchmark.py [megabytes] [datagrams]")
+        exit()
+    megabytes = int(argv[1]) if len(argv) >= 2 else 256
+    datagrams = int(argv[2]) if len(argv) >= 3 else 100000
+    relay = RelayServer(AF_INET, 0)
+    relay_thread = Thread(target=relay.run, daemon=True)
+    relay_thread.start()
+    relay_endpoint = ("127.0.0.1", relay.get_local_endpoint()[1])
+    bench_tcp(relay_endpoint, megabytes)
+    bench_udp(relay_endpoint, datagrams, 1000)
+    relay.closed = True
+
+if __name__ == "__main__":
+    main()
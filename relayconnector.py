@@ -0,0 +1,118 @@
+from socket import socket, AddressFamily, SHUT_RDWR, SOCK_STREAM, AF_INET6, IPPROTO_IPV6, IPV6_V6ONLY
+import traceback
+from threading import Thread, Lock
+from common import debug_print
+from iptools import IP_endpoint
+from socketoptions import SocketOptions
+from relay import RELAY_MAGIC, RELAY_HELLO, RELAY_PAIRED, RELAY_PAIR_TIMEOUT
+
+class RelayConnector:
+    # relay_endpoint: IP_endpoint - the endpoint of the relay server
+    # family: AddressFamily
+    # options: SocketOptions | None - options applied to relay sockets before they connect
+    # lock: Lock
+    # connectors: Dictionary[IP_endpoint, socket] - the sockets connecting to the relay, by the remote endpoint they will be paired with
+    # fails: set[IP_endpoint] - remote endpoints that could not be paired through the relay (and have yet to be managed)
+    # successes: list[tuple[socket, IP_endpoint, int, int]] - paired sockets with their remote endpoint, session id and side (and have yet to be managed)
+    def __init__(self, relay_endpoint: IP_endpoint, family: AddressFamily, options: SocketOptions | None = None):
+        self.relay_endpoint = relay_endpoint
+        self.family = family
+        self.options = options
+        self.lock = Lock()
+        self.connectors: dict[IP_endpoint, socket] = {}
+        self.fails: set[IP_endpoint] = set()
+        self.successes: list[tuple[socket, IP_endpoint, int, int]] = []
+
+    def _on_success(self, endpoint: IP_endpoint, session: int, side: int):
+        with self.lock:
+            if endpoint in self.connectors.keys():
+                socket = self.connectors.pop(endpoint)
+                self.successes.append((socket, endpoint, session, side))
+
+    def _on_fail(self, endpoint: IP_endpoint):
+        with self.lock:
+            if endpoint in self.connectors.keys():
+                relay_socket = self.connectors.pop(endpoint)
+                try_close(relay_socket)
+                self.fails.add(endpoint)
+
+    def connect(self, endpoint: IP_endpoint, token: bytes, timeout: float | None):
+        with self.lock:
+            if endpoint in self.connectors:
+                debug_print(f"already connecting to relay!")
+                return
+            self.fails.discard(endpoint)
+            try:
+                relay_socket = socket(self.family, SOCK_STREAM)
+                if self.family == AF_INET6:
+                    relay_socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
+                if self.options is not None:
+                    self.options.apply_tcp(relay_socket)
+            except Exception:
+                self.fails.add(endpoint)
+                return
+            self.connectors[endpoint] = relay_socket
+            relay_thread = Thread(target=self.relay_thread, args=(relay_socket, endpoint, token, timeout), daemon=True)
+            relay_thread.start()
+
+    def remove_connector(self, endpoint: IP_endpoint):
+        with self.lock:
+            if endpoint in self.connectors.keys():
+                try_close(self.connectors.pop(endpoint))
+            self.fails.discard(endpoint)
+
+    def take_successes(self) -> list[tuple[socket, IP_endpoint, int, int]]:
+        with self.lock:
+            successes = self.successes
+            self.successes = []
+            return successes
+
+    def take_fails(self) -> list[IP_endpoint]:
+        with self.lock:
+            fails = list(self.fails)
+            self.fails.clear()
+            return fails
+
+    def clear(self):
+        with self.lock:
+            for relay_socket in self.connectors.values():
+                try_close(relay_socket)
+            for relay_socket, _, _, _ in self.successes:
+                try_close(relay_socket, shutdown=True)
+            self.connectors.clear()
+            self.successes.clear()
+            self.fails.clear()
+
+    def relay_thread(self, relay_socket: socket, endpoint: IP_endpoint, token: bytes, timeout: float | None):
+        try:
+            if timeout is None or timeout <= 0:
+                timeout = RELAY_PAIR_TIMEOUT
+            relay_socket.settimeout(timeout)
+            relay_socket.connect(self.relay_endpoint)
+            relay_socket.sendall(RELAY_HELLO.pack(RELAY_MAGIC, token))
+            reply = b''
+            while len(reply) < RELAY_PAIRED.size:
+                data = relay_socket.recv(RELAY_PAIRED.size - len(reply))
+                if not data:
+                    raise ConnectionError("relay closed before pairing")
+                reply += data
+            magic, session, side = RELAY_PAIRED.unpack(reply)
+            if magic != RELAY_MAGIC:
+                raise ConnectionError("invalid relay reply")
+            relay_socket.settimeout(None)
+            self._on_success(endpoint, session, side)
+        except Exception:
+            debug_print(f"Relay Connect Exception: {traceback.format_exc()}")
+            self._on_fail(endpoint)
+        debug_print("stopping relay thread")
+
+def try_close(socket: socket, shutdown: bool = False):
+    if shutdown:
+        try:
+            socket.shutdown(SHUT_RDWR)
+        except Exception:
+            debug_print(f"At shutdown Closing Relay Exception: {traceback.format_exc()}")
+    try:
+        socket.close()
+    except Exception:
+        debug_print(f"At close Closing Relay Exception: {traceback.format_exc()}")
@@ -0,0 +1,231 @@
+from sys import argv
+from threading import Thread, Lock
+from time import perf_counter, sleep
+from tcpudpserver import Server, Connection, IPV4
+from recorder import read_recording, RECORD_START, RECORD_CONNECT, RECORD_DISCONNECT, RECORD_RELIABLE, RECORD_UNRELIABLE
+
+TICK_INTERVAL = 0.001
+CONNECT_TIMEOUT = 5
+DRAIN_TIME = 0.5 # how long the clients still connected at the end stay connected, so the target reads everything before the disconnects
+
+class ReplayClient:
+    # one recorded connection, replayed from its own loopback Server (so the target sees it connect and disconnect)
+    # server: Server
+    # connection: Connection | None - the client's Connection to the target, once made
+    # ready: bool - whether the target has the connection too (unreliable data sent before would be dropped)
+    # waiting: list[tuple[int, bytes]] - the data (kind, data) recorded before the client was ready, sent in order once it is
+    # closing: bool - whether the recorded connection has disconnected (the client closes once waiting is sent)
+    # failed: bool - whether the client could not connect (its data is dropped)
+    def __init__(self, server: Server):
+        self.server = server
+        self.connection: Connection | None = None
+        self.ready = False
+        self.waiting: list[tuple[int, bytes]] = []
+        self.closing = False
+        self.failed = False
+
+
+class Replayer:
+    # opens and closes a client for every recorded connection at the recorded times, keeping each connection's data in order
+    # target: Server - the Server being replayed to (ticked by another thread)
+    # server_options: dict - passed to every client Server
+    # clients: dict[int, ReplayClient] - the clients of the current session, by recorded connection number
+    # open: list[ReplayClient] - the clients that are not closed yet (ticked by tick_thread)
+    # lock: Lock - taken by the replaying thread and the tick thread
+    # connected: int - the number of clients that connected
+    # failed: int - the number of clients that could not connect
+    # closed: bool
+    def __init__(self, target: Server, **server_options):
+        self.target = target
+        self.server_options = server_options
+        self.clients: dict[int, ReplayClient] = {}
+        self.open: list[ReplayClient] = []
+        self.lock = Lock()
+        self.connected = 0
+        self.failed = 0
+        self.closed = False
+        self.thread = Thread(target=self.tick_thread, daemon=True)
+        self.thread.start()
+
+    def connect(self, number: int) -> ReplayClient:
+        with self.lock:
+            old = self.clients.get(number)
+            if old is not None:
+                self._disconnect(old)
+            client = ReplayClient(Server(lambda server, connection: self._on_connect(client, connection),
+                                         lambda server, endpoint: self._on_fail(client),
+                                         lambda server, data, connection: None, lambda server, data, connection: None,
+                                         lambda server, connection: None, [], self.target.family, **self.server_options))
+            self.clients[number] = client
+            self.open.append(client)
+        client.server.hole_punch(self.target.get_loopback_endpoint(), CONNECT_TIMEOUT)
+        return client
+
+    def send(self, number: int, kind: int, data: bytes):
+        client = self.clients.get(number)
+        if client is None:
+            client = self.connect(number) # connected before the recording started
+        with self.lock:
+            if client.failed or client.closing:
+                return
+            if not client.ready:
+                client.waiting.append((kind, data))
+                return
+        _send(client.connection, kind, data)
+
+    def disconnect(self, number: int):
+        with self.lock:
+            client = self.clients.pop(number, None)
+            if client is not None:
+                self._disconnect(client)
+
+    # disconnects every client of the session (connection numbers restart with every session)
+    def end_session(self):
+        with self.lock:
+            for client in self.clients.values():
+                self._disconnect(client)
+            self.clients.clear()
+
+    def _disconnect(self, client: ReplayClient):
+        client.closing = True
+        if client.ready or client.failed:
+            self._close(client)
+
+    def _close(self, client: ReplayClient):
+        if client in self.open:
+            self.open.remove(client)
+        client.server.close()
+
+    def _on_connect(self, client: ReplayClient, connection: Connection):
+        with self.lock:
+            client.connection = connection
+            self.connected += 1
+
+    def _on_fail(self, client: ReplayClient):
+        with self.lock:
+            client.failed = True
+            client.waiting.clear()
+            self.failed += 1
+            self._close(client)
+
+    # sends what waited for the clients that became ready (closing those whose recorded connection has disconnected since)
+    def _flush_ready(self):
+        with self.lock:
+            ready = [client for client in self.open if not client.ready and client.connection is not None
+                     and client.connection.local_endpoint in self.target.connections]
+            for client in ready:
+                client.ready = True
+                for kind, data in client.waiting:
+                    _send(client.connection, kind, data)
+                client.waiting.clear()
+                if client.closing:
+                    self._close(client)
+
+    def tick_thread(self):
+        while not self.closed:
+            with self.lock:
+                servers = [client.server for client in self.open]
+            for server in servers:
+                server.tick()
+            self._flush_ready()
+            sleep(TICK_INTERVAL)
+
+    # waits for what is still waiting to be sent, then closes every client
+    def close(self):
+        sleep(DRAIN_TIME)
+        with self.lock:
+            self.closed = True
+            servers = [client.server for client in self.open]
+            self.open.clear()
+            self.clients.clear()
+        self.thread.join()
+        for server in servers:
+            server.close()
+
+def _send(connection: Connection, kind: int, data: bytes):
+    if kind == RECORD_RELIABLE:
+        connection.send_reliable(data)
+    elif kind == RECORD_UNRELIABLE:
+        connection.send_unreliable(data)
+
+def tick_thread(server: Server):
+    while not server.closed:
+        server.tick()
+        sleep(TICK_INTERVAL)
+
+# returns the number of data records in the recording whose payload was left out (replayed as zeros, which parsers reject)
+def count_size_only(path: str) -> int:
+    return sum(1 for kind, _, _, payload in read_recording(path)
+               if kind in (RECORD_RELIABLE, RECORD_UNRELIABLE) and isinstance(payload, int))
+
+# sends the data a Server recorded to the target again, at speed times the recorded pace (speed 0 sends as fast as possible)
+# every recorded connection gets its own loopback client, opened and closed when the recorded one connected and disconnected
+# returns (records, bytes, seconds, the most a send fell behind its schedule, clients connected, clients that failed to connect)
+def replay(path: str, target: Server, speed: float, **server_options) -> tuple[int, int, float, float, int, int]:
+    replayer = Replayer(target, **server_options)
+    records = 0
+    sent = 0
+    lag = 0.0
+    session_offset = 0.0 # the end of the previous sessions in the file, so they are replayed one after another
+    last_time = 0.0
+    start = perf_counter()
+    try:
+        for kind, time, number, payload in read_recording(path):
+            records += 1
+            if kind == RECORD_START:
+                replayer.end_session()
+                session_offset += last_time
+                last_time = 0.0
+                continue
+            last_time = time
+            if speed > 0:
+                due = start + (session_offset + time) / speed
+                delay = due - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            if kind == RECORD_CONNECT:
+                replayer.connect(number)
+            elif kind == RECORD_DISCONNECT:
+                replayer.disconnect(number)
+            else:
+                data = bytes(payload) # a copy of the mapped payload, or zeros the length of a size only record
+                replayer.send(number, kind, data)
+                sent += len(data)
+    finally:
+        elapsed = perf_counter() - start
+        replayer.close()
+    return records, sent, elapsed, lag, replayer.connected, replayer.failed
+
+def main():
+    if len(argv) < 2 or len(argv) > 3:
+        print("Usage: python replay.py recording [speed (0 for as fast as possible)]")
+        exit()
+    path = argv[1]
+    speed = float(argv[2]) if len(argv) >= 3 else 1
+    size_only = count_size_only(path)
+    if size_only:
+        print(f"WARNING: {size_only} data records of {path} were recorded without their payload (TrafficRecorder(payloads=False)).")
+        print("They are replayed as zeros of the recorded length, which the target's parsers will likely reject:")
+        print("the load is reproduced, but not what the target does with the data.")
+    received = [0, 0, 0]
+    def on_receive_reliable(server: Server, data: bytes, connection: Connection):
+        received[0] += len(data)
+    def on_receive_unreliable(server: Server, data: bytes, connection: Connection):
+        received[1] += 1
+        received[2] += len(data)
+    target = Server(lambda server, connection: None, lambda server, endpoint: None, on_receive_reliable, on_receive_unreliable,
+                    lambda server, connection: None, [], IPV4, local_transport=False)
+    target_thread = Thread(target=tick_thread, args=(target,), daemon=True)
+    target_thread.start()
+    # remote clients don't share the host, so keep the loopback clients off the local transport too
+    records, sent, elapsed, lag, connected, failed = replay(path, target, speed, local_transport=False)
+    target.close()
+    print(f"replayed {records} records ({sent} bytes) from {connected} clients in {elapsed:.2f} s, at most {lag * 1000:.1f} ms behind")
+    if failed:
+        print(f"{failed} clients could not connect, and their data was not sent")
+    print(f"target received {received[0]} reliable bytes and {received[1]} unreliable messages ({received[2]} bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import sys
+from sys import argv
+from socket import *
+from multiprocessing import Process, Event
+from time import perf_counter, sleep
+from os import cpu_count
+from connectioncollection import ConnectionCollection
+from udpsocket import UdpSocket
+
+def send_process(endpoint: tuple[str, int], connections: int, stop):
+    senders = [create_connection(endpoint) for _ in range(connections)]
+    chunk = bytes(65536)
+    for sender in senders:
+        sender.setblocking(False)
+    while not stop.is_set():
+        for sender in senders:
+            try:
+                sender.send(chunk)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                return
+
+# returns the bytes per second a collection with the given number of shards receives from connections busy senders
+def bench(shards: int, connections: int, senders: int, seconds: float) -> float:
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(connections)
+    udp_socket = UdpSocket(("127.0.0.1", 0), [], AF_INET)
+    collection = ConnectionCollection(shards)
+    stop = Event()
+    processes = [Process(target=send_process, args=(listener.getsockname(), connections // senders, stop)) for _ in range(senders)]
+    for process in processes:
+        process.start()
+    for _ in range(connections // senders * senders):
+        tcp_socket, _ = listener.accept()
+        collection.add_connection(tcp_socket, udp_socket)
+
+    received = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        datas = collection.receive()
+        if not datas:
+            sleep(0) # let the workers have the interpreter
+        for data, _ in datas:
+            received += len(data)
+    elapsed = perf_counter() - start
+    stop.set()
+    collection.disconnect_all()
+    for process in processes:
+        process.join()
+    listener.close()
+    udp_socket.close()
+    return received / elapsed
+
+def main():
+    if len(argv) > 4:
+        print("Usage: python shardbenchmark.py [connections] [sender processes] [seconds]")
+        exit()
+    connections = int(argv[1]) if len(argv) >= 2 else 256
+    senders = int(argv[2]) if len(argv) >= 3 else 4
+    seconds = float(argv[3]) if len(argv) >= 4 else 3
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)() # only free-threaded builds can turn it off
+    print(f"{connections} connections, {senders} sender processes, {cpu_count()} cpus, gil {'enabled' if gil else 'disabled'}")
+    base = None
+    shards = 1
+    while shards <= max(8, cpu_count() or 1):
+        rate = bench(shards, connections, senders, seconds)
+        base = base or rate
+        print(f"{shards:2} shard{'s' if shards > 1 else ' '}: {rate / 1024 / 1024:8.1f} MB/s ({rate / base:.2f}x)")
+        shards *= 2
+
+if __name__ == "__main__":
+    main()
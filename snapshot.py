@@ -0,0 +1,192 @@
+from struct import Struct
+from threading import Lock
+from weakref import WeakKeyDictionary
+from collections.abc import Callable
+from typing import Any
+import re
+from connection import Connection
+
+# Unreliable message kinds (when a Server is created with a SnapshotChannel)
+# Every unreliable message then starts with a kind byte (above fragmentation, so snapshots are fragmented like any message),
+# and the Server hands each message to its owner by that byte, never by guessing from the message's contents:
+# MESSAGE_APPLICATION: the rest of the message is the application's, handed to on_receive_unreliable
+# MESSAGE_SNAPSHOT: the message is a snapshot packet, handed to the SnapshotChannel
+MESSAGE_APPLICATION = 0
+MESSAGE_SNAPSHOT = 1
+APPLICATION_HEADER = bytes([MESSAGE_APPLICATION])
+
+# Snapshot packets (sent unreliably)
+# every packet starts with SNAPSHOT_HEADER (MESSAGE_SNAPSHOT, kind, sequence, baseline sequence)
+# SNAPSHOT_FULL: the rest of the packet is the snapshot
+# SNAPSHOT_DELTA: the rest is the snapshot's length (SNAPSHOT_LENGTH), then runs of DELTA_RUN (offset, length) each
+#                 followed by the bytes that replace the baseline's at offset. Bytes past the runs are the baseline's.
+# SNAPSHOT_ACK: tells the sender the snapshot with the sequence was received, so it can be used as a baseline
+SNAPSHOT_HEADER = Struct("!BBII")
+SNAPSHOT_LENGTH = Struct("!H")
+DELTA_RUN = Struct("!HH")
+SNAPSHOT_FULL = 0
+SNAPSHOT_DELTA = 1
+SNAPSHOT_ACK = 2
+SNAPSHOT_RING = 32 # the number of recent snapshots kept per connection (on both sides)
+# the largest snapshot the delta format can describe (a connection may allow less, see SnapshotChannel.max_snapshot_size)
+MAX_SNAPSHOT_SIZE = 0xFFFF
+
+_CHANGED = re.compile(rb"[^\x00]+")
+
+# returns the runs that turn baseline into snapshot (runs closer than a run header are merged, as that is smaller)
+def encode_delta(baseline: bytes, snapshot: bytes) -> bytes:
+    common = min(len(baseline), len(snapshot))
+    parts = [SNAPSHOT_LENGTH.pack(len(snapshot))]
+    runs: list[list[int]] = []
+    if common > 0:
+        difference = (int.from_bytes(baseline[:common], "big") ^ int.from_bytes(snapshot[:common], "big")).to_bytes(common, "big")
+        for match in _CHANGED.finditer(difference):
+            if runs and match.start() - runs[-1][1] <= DELTA_RUN.size:
+                runs[-1][1] = match.end()
+            else:
+                runs.append([match.start(), match.end()])
+    if len(snapshot) > common:
+        if runs and common - runs[-1][1] <= DELTA_RUN.size:
+            runs[-1][1] = len(snapshot)
+        else:
+            runs.append([common, len(snapshot)])
+    for start, end in runs:
+        parts.append(DELTA_RUN.pack(start, end - start))
+        parts.append(snapshot[start:end])
+    return b''.join(parts)
+
+def apply_delta(baseline: bytes, delta: bytes | memoryview) -> bytes:
+    length = SNAPSHOT_LENGTH.unpack_from(delta)[0]
+    snapshot = bytearray(baseline[:length])
+    snapshot.extend(bytes(length - len(snapshot)))
+    offset = SNAPSHOT_LENGTH.size
+    while offset < len(delta):
+        start, size = DELTA_RUN.unpack_from(delta, offset)
+        offset += DELTA_RUN.size
+        if start + size > length or offset + size > len(delta):
+            raise ValueError("delta run out of bounds")
+        snapshot[start:start + size] = delta[offset:offset + size]
+        offset += size
+    return bytes(snapshot)
+
+
+class SnapshotState:
+    # sequence: int - the sequence of the last snapshot sent
+    # sent: dict[int, bytes] - the last SNAPSHOT_RING snapshots sent, by sequence
+    # acked: int - the sequence of the newest sent snapshot the peer has acknowledged (0 if none)
+    # pending: bytes | None - the newest packet that could not be sent because the send buffer was full
+    # received: dict[int, bytes] - the last SNAPSHOT_RING snapshots received, by sequence
+    # latest: int - the sequence of the newest snapshot received
+    def __init__(self):
+        self.sequence = 0
+        self.sent: dict[int, bytes] = {}
+        self.acked = 0
+        self.pending: bytes | None = None
+        self.received: dict[int, bytes] = {}
+        self.latest = 0
+
+
+class SnapshotChannel:
+    # passed to a Server as snapshot_channel, which hands it the MESSAGE_SNAPSHOT messages of every Connection
+    # on_snapshot(server, snapshot, connection) - called with every snapshot newer than the last one received from the connection
+    # states: WeakKeyDictionary[Connection, SnapshotState] - the snapshot history of each Connection
+    # lock: Lock
+    # full_sent: int - the number of snapshots sent whole
+    # delta_sent: int - the number of snapshots sent as deltas
+    # dropped: int - the number of snapshot packets replaced by a newer one before the send buffer had room for them
+    def __init__(self, on_snapshot: Callable[[Any, bytes, Connection], None]):
+        self.on_snapshot = on_snapshot
+        self.states: WeakKeyDictionary[Connection, SnapshotState] = WeakKeyDictionary()
+        self.lock = Lock()
+        self.full_sent = 0
+        self.delta_sent = 0
+        self.dropped = 0
+
+    def _get_state(self, connection: Connection) -> SnapshotState:
+        state = self.states.get(connection)
+        if state is None:
+            state = SnapshotState()
+            self.states[connection] = state
+        return state
+
+    # sends the snapshot as a delta against the last one the peer acknowledged (or whole if it has acknowledged none)
+    # if the send buffer is full, the packet replaces any older one waiting and is sent by a later send or flush
+    # raises ValueError if the snapshot is larger than max_snapshot_size (it could never be sent whole)
+    def send(self, connection: Connection, snapshot: bytes):
+        limit = self.max_snapshot_size(connection)
+        if len(snapshot) > limit:
+            raise ValueError(f"snapshot of {len(snapshot)} bytes is larger than the {limit} the connection can send")
+        snapshot = bytes(snapshot) # kept as a baseline, so it must not change
+        with self.lock:
+            state = self._get_state(connection)
+            state.sequence += 1
+            state.sent[state.sequence] = snapshot
+            state.sent.pop(state.sequence - SNAPSHOT_RING, None)
+            baseline = state.sent.get(state.acked)
+            packet = None
+            if baseline is not None:
+                delta = encode_delta(baseline, snapshot)
+                if len(delta) < len(snapshot):
+                    packet = SNAPSHOT_HEADER.pack(MESSAGE_SNAPSHOT, SNAPSHOT_DELTA, state.sequence, state.acked) + delta
+                    self.delta_sent += 1
+            if packet is None:
+                packet = SNAPSHOT_HEADER.pack(MESSAGE_SNAPSHOT, SNAPSHOT_FULL, state.sequence, 0) + snapshot
+                self.full_sent += 1
+            if state.pending is not None:
+                self.dropped += 1
+            state.pending = packet
+            self._send_pending(connection, state)
+
+    # retries the packets that found the send buffer full
+    def flush(self):
+        with self.lock:
+            for connection, state in list(self.states.items()):
+                if state.pending is not None:
+                    self._send_pending(connection, state)
+
+    def _send_pending(self, connection: Connection, state: SnapshotState):
+        if connection.closed:
+            state.pending = None
+        elif connection._try_send_message(state.pending):
+            state.pending = None
+
+    # returns the largest snapshot that can be sent to the connection (a whole snapshot must fit in one unreliable message)
+    def max_snapshot_size(self, connection: Connection) -> int:
+        return min(MAX_SNAPSHOT_SIZE, connection._max_message_size() - SNAPSHOT_HEADER.size)
+
+    def remove(self, connection: Connection):
+        with self.lock:
+            self.states.pop(connection, None)
+
+    # called by the Server with every MESSAGE_SNAPSHOT message it receives (on the thread calling tick, outside the Server's lock)
+    def receive(self, server: Any, data: bytes, connection: Connection):
+        if len(data) < SNAPSHOT_HEADER.size:
+            return
+        _, kind, sequence, baseline_sequence = SNAPSHOT_HEADER.unpack_from(data)
+        body = memoryview(data)[SNAPSHOT_HEADER.size:]
+        with self.lock:
+            state = self._get_state(connection)
+            if kind == SNAPSHOT_ACK:
+                if state.acked < sequence <= state.sequence:
+                    state.acked = sequence
+                return
+            if sequence <= state.latest:
+                return # older than a snapshot already delivered
+            if kind == SNAPSHOT_FULL:
+                snapshot = bytes(body)
+            elif kind == SNAPSHOT_DELTA:
+                baseline = state.received.get(baseline_sequence)
+                if baseline is None:
+                    return # the sender only uses baselines still in both rings, so this packet is malformed
+                try:
+                    snapshot = apply_delta(baseline, body)
+                except Exception:
+                    return # drop malformed packets
+            else:
+                return
+            state.latest = sequence
+            state.received[sequence] = snapshot
+            for old in [old for old in state.received if old <= sequence - SNAPSHOT_RING]:
+                del state.received[old]
+        connection._send_message(SNAPSHOT_HEADER.pack(MESSAGE_SNAPSHOT, SNAPSHOT_ACK, sequence, 0))
+        self.on_snapshot(server, snapshot, connection)
@@ -0,0 +1,99 @@
+import socket as socket_module
+from socket import *
+from struct import Struct
+import sys
+from common import debug_print
+
+# SO_RXQ_OVFL is linux only and is not exported by the socket module
+SO_RXQ_OVFL = 40
+RXQ_OVFL_COUNTER = Struct("=I")
+# UDP_SEGMENT (generic segmentation offload, linux 4.18+) is not exported by the socket module either
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_SEGMENT_SIZE = Struct("=H")
+UDP_MAX_SEGMENTS = 64
+UDP_MAX_PAYLOAD = 65507 # the largest udp payload over ipv4, the total size of one segmented send must stay under it
+# linux values of the path mtu discovery options (not exported by the socket module on every version)
+IP_MTU_DISCOVER = 10
+IPV6_MTU_DISCOVER = 23
+IP_PMTUDISC_PROBE = 3
+
+class SocketOptions:
+    # recv_buffer: int | None - the size to set SO_RCVBUF to (None to leave the OS default)
+    # send_buffer: int | None - the size to set SO_SNDBUF to (None to leave the OS default)
+    # tcp_nodelay: bool - whether to disable Nagle's algorithm on tcp connections
+    # tos: int | None - the IP_TOS / IPV6_TCLASS byte (DSCP << 2) to mark packets with (None to leave unmarked)
+    # count_kernel_drops: bool - whether to enable SO_RXQ_OVFL on the udp socket to count packets dropped by the kernel
+    # defer_accept: int | None - seconds the listener waits for the first data before a connection is accepted (TCP_DEFER_ACCEPT, linux only)
+    #                            only useful when the connecting side always speaks first, as silent connections are accepted late
+    # udp_gso: bool - whether to send runs of equal sized datagrams to one endpoint in a single UDP_SEGMENT sendmsg (linux only)
+    def __init__(self, recv_buffer: int | None = None, send_buffer: int | None = None, tcp_nodelay: bool = False,
+                 tos: int | None = None, count_kernel_drops: bool = False, defer_accept: int | None = None,
+                 udp_gso: bool = False):
+        self.recv_buffer = recv_buffer
+        self.send_buffer = send_buffer
+        self.tcp_nodelay = tcp_nodelay
+        self.tos = tos
+        self.count_kernel_drops = count_kernel_drops
+        self.defer_accept = defer_accept
+        self.udp_gso = udp_gso
+
+    def apply_udp(self, socket: socket):
+        self._apply_common(socket)
+        if self.count_kernel_drops and kernel_drops_supported():
+            try_setsockopt(socket, SOL_SOCKET, SO_RXQ_OVFL, 1)
+
+    def apply_tcp(self, socket: socket):
+        self._apply_common(socket)
+        if self.tcp_nodelay:
+            try_setsockopt(socket, IPPROTO_TCP, TCP_NODELAY, 1)
+
+    def apply_listener(self, socket: socket):
+        self.apply_tcp(socket)
+        if self.defer_accept is not None and hasattr(socket_module, "TCP_DEFER_ACCEPT"):
+            try_setsockopt(socket, IPPROTO_TCP, socket_module.TCP_DEFER_ACCEPT, self.defer_accept)
+
+    def _apply_common(self, socket: socket):
+        if self.recv_buffer is not None:
+            try_setsockopt(socket, SOL_SOCKET, SO_RCVBUF, self.recv_buffer)
+        if self.send_buffer is not None:
+            try_setsockopt(socket, SOL_SOCKET, SO_SNDBUF, self.send_buffer)
+        if self.tos is not None:
+            if socket.family == AF_INET6:
+                try_setsockopt(socket, IPPROTO_IPV6, IPV6_TCLASS, self.tos)
+            # also set IP_TOS, as ipv4 mapped traffic on a dual stack socket uses it
+            try_setsockopt(socket, IPPROTO_IP, IP_TOS, self.tos)
+
+def kernel_drops_supported() -> bool:
+    return sys.platform.startswith("linux") and hasattr(socket, "recvmsg")
+
+# whether the kernel accepts UDP_SEGMENT on the socket
+def udp_gso_supported(socket: socket) -> bool:
+    if not sys.platform.startswith("linux") or not hasattr(socket, "sendmsg"):
+        return False
+    try:
+        socket.getsockopt(SOL_UDP, UDP_SEGMENT)
+        return True
+    except OSError:
+        return False
+
+# sets the don't fragment bit on every packet and stops the kernel from fragmenting them itself,
+# so a packet too large for the path is dropped (which is what path mtu probing needs to see)
+def set_dont_fragment(socket: socket):
+    if not sys.platform.startswith("linux"):
+        return
+    if socket.family == AF_INET6:
+        try_setsockopt(socket, IPPROTO_IPV6, IPV6_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    try_setsockopt(socket, IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+
+def try_setsockopt(socket: socket, level: int, option: int, value: int) -> bool:
+    try:
+        socket.setsockopt(level, option, value)
+        return True
+    except (OSError, AttributeError, NameError):
+        debug_print(f"could not set socket option {level}:{option} to {value}")
+        return False
+
+# returns the actual (recv, send) buffer sizes of the socket
+def get_buffer_sizes(socket: socket) -> tuple[int, int]:
+    return (socket.getsockopt(SOL_SOCKET, SO_RCVBUF), socket.getsockopt(SOL_SOCKET, SO_SNDBUF))
@@ -1,12 +1,25 @@
 from socket import socket
 from threading import Lock
+from time import monotonic
 from holepuncher import HolePuncher
-from listener import Listener
-from connection import Connection
+from listener import Listener, DEFAULT_BACKLOG, DEFAULT_MAX_ACCEPTS, get_listen_overflows
+from connection import Connection, RelayedConnection, LocalConnection
 from collections.abc import Callable
 from udpsocket import UdpSocket
-from common import CONNECT_DESTINATION, IPV6_LOOPBACK, IPV4_LOOPBACK, make_socket_reusable
+from common import CONNECT_DESTINATION, IPV6_LOOPBACK, IPV4_LOOPBACK, make_socket_reusable, debug_print
 from connectioncollection import ConnectionCollection
+from budget import ReceiveBudget
+from socketoptions import SocketOptions, set_dont_fragment
+from fragment import Fragmenter, DEFAULT_FRAGMENT_SIZE, LOCAL_FRAGMENT_SIZE
+from pathstats import PathStats, STATS_CHECK_INTERVAL
+from pathcache import PathCache
+from recorder import TrafficRecorder
+from snapshot import SnapshotChannel, MESSAGE_APPLICATION, MESSAGE_SNAPSHOT, APPLICATION_HEADER
+from group import Group
+from relayconnector import RelayConnector
+from relay import RELAY_HEADER, relay_token
+from connectionid import *
+from localtransport import LocalTransport, LocalConnector, LOCAL_ACCEPT, LOCAL_REJECT, local_transport_supported, get_host_addresses, is_host_address, try_close
 from iptools import *
 
 # Hole Punch Server using TCP UDP connections
@@ -19,13 +32,41 @@ class Server:
     # listener: Listener - the object managing accepting new connections passively
     # udp_socket: UdpSocket - the UDP socket attached to the same port as the listener
     # local_endpoint: IP_endpoint - the endpoint the listener is bound to
-    # connections: ConnectionCollection - the collection of Connections
+    # connections: ConnectionCollection - the collection of Connections (split into receive_shards shards, each read by its own thread when more than one)
     # lock: Lock
     # closed: bool - True if the Server has closed
+    # receive_budget: ReceiveBudget | None - limits how much data is read in a single tick (None for no limit)
+    # receive_rate: float | None - the default rate limit (bytes per second) applied to each new Connection
+    # receive_burst: float | None - the default burst size (bytes) of each new Connection's rate limit
+    # socket_options: SocketOptions | None - buffer sizes, TCP_NODELAY and TOS applied to the udp socket and every tcp connection
+    # groups: dict[str, Group] - the groups of Connections, by name
+    # udp_first: bool - whether unreliable data is read before reliable data this tick (alternates every tick)
+    # relay_endpoint: IP_endpoint | None - the relay server to fall back to when hole punching fails (None for no fallback)
+    # relayconnector: RelayConnector | None - used to pair with peers through the relay server
+    # relay_secret: bytes | None - the secret mixed into relay tokens when no secret is given for the peer (None to only relay with one)
+    # relay_secrets: dict[IP_endpoint, bytes] - the secrets given for the endpoints being hole punched, for falling back to the relay
+    # relay_sessions: dict[int, RelayedConnection] - the relayed Connections, by relay session id
+    # local_transport: LocalTransport | None - the unix sockets used to talk to Servers on the same host (None if unavailable)
+    # localconnector: LocalConnector | None - used to dial Servers on the same host
+    # local_peers: dict[int, LocalConnection] - the Connections to Servers on the same host, by their port
+    # host_addresses: set[str] - the addresses of this host, used to tell whether a peer is on the same host
+    # use_connection_ids: bool - whether unreliable packets carry connection ids, so peers can change udp endpoint without reconnecting
+    # connection_ids: dict[int, Connection] - the direct Connections, by the connection id their peer sends
+    # path_cache: PathCache | None - remembers the external endpoint and the endpoints peers were last reached at across restarts
+    # peer_attempts: dict[IP_endpoint, tuple[str, bool]] - the peer id being hole punched at each endpoint, and whether the endpoint came from the path cache
+    # fragmentation: bool - whether unreliable messages larger than a packet are fragmented (every unreliable packet then carries a kind byte)
+    # mtu_probing: bool - whether each Connection probes for a larger fragment size than DEFAULT_FRAGMENT_SIZE
+    # probing: dict[Connection, None] - the Connections probing their path mtu, or checking that their path still carries the size found
+    # measure_paths: bool - whether unreliable packets carry sequence numbers and pings, to measure each Connection's rtt, jitter and loss
+    # measured: dict[Connection, None] - the Connections with path statistics
+    # next_stats_check: float - when to next send the pings and pongs that found no packet to ride on
+    # recorder: TrafficRecorder | None - records the events handed to the callbacks every tick, for replaying later (None for no recording)
+    # snapshot_channel: SnapshotChannel | None - receives the MESSAGE_SNAPSHOT messages (every unreliable message then carries a kind byte)
+    # message_header: bytes - the kind byte in front of the application's unreliable messages (empty without a snapshot channel)
 
     # Callbacks:
     # on_connect(Server, Connection) - when the Server creates a new Connection
-    # on_hole_punch_fail(Server, IP_endpoint) - when a hole punch times out or otherwise fails
+    # on_hole_punch_fail(Server, IP_endpoint) - when a hole punch times out or otherwise fails (and relaying fails, if there is a relay)
     # on_receive_reliable(Server, data, Connection) - when reliable data is received from a Connection
     # on_receive_unreliable(Server, data, Connection) - when unreliable data is received from a Connection
     # on_disconnect(Server, Connection) - when a Connection disconnects
@@ -37,16 +78,79 @@ class Server:
                  stun_hosts: list[unresolved_endpoint],
                  family: AddressFamily,
                  listen: bool = True,
-                 port: int = 0):
+                 port: int = 0,
+                 receive_budget: ReceiveBudget | None = None,
+                 receive_rate: float | None = None,
+                 receive_burst: float | None = None,
+                 socket_options: SocketOptions | None = None,
+                 relay: unresolved_endpoint | None = None,
+                 relay_secret: bytes | None = None,
+                 local_transport: bool = True,
+                 connection_ids: bool = False,
+                 backlog: int = DEFAULT_BACKLOG,
+                 max_accepts: int = DEFAULT_MAX_ACCEPTS,
+                 path_cache: PathCache | None = None,
+                 fragmentation: bool = False,
+                 mtu_probing: bool = False,
+                 measure_paths: bool = False,
+                 receive_shards: int = 1,
+                 recorder: TrafficRecorder | None = None,
+                 snapshot_channel: SnapshotChannel | None = None):
         # create a TCP socket that will listen for incoming connections
         self.family = family
-        self.listener = Listener(family, listen, port)
+        self.socket_options = socket_options
+        self.listener = Listener(family, listen, port, socket_options, backlog, max_accepts)
         self.local_endpoint = self.listener.get_local_endpoint()
-        self.udp_socket = UdpSocket(self.local_endpoint, stun_hosts, family)
-        self.holepuncher = HolePuncher(self.local_endpoint, family)
-        self.connections = ConnectionCollection()
+        self.path_cache = path_cache
+        self.peer_attempts: dict[IP_endpoint, tuple[str, bool]] = {}
+        # a cached external endpoint saves the STUN round trips on restart (only meaningful on a fixed port)
+        cached_external = None
+        if path_cache is not None and port != 0:
+            cached_external = path_cache.get_external(port, family)
+        self.udp_socket = UdpSocket(self.local_endpoint, stun_hosts, family, socket_options, cached_external)
+        if path_cache is not None and port != 0 and cached_external is None and self.udp_socket.external_endpoint is not None:
+            path_cache.remember_external(port, self.udp_socket.external_endpoint)
+            path_cache.flush()
+        self.holepuncher = HolePuncher(self.local_endpoint, family, socket_options)
+        self.connections = ConnectionCollection(receive_shards)
         self.lock = Lock()
         self.closed = False
+        self.receive_budget = receive_budget
+        self.receive_rate = receive_rate
+        self.receive_burst = receive_burst
+        self.udp_first = True
+        self.groups: dict[str, Group] = {}
+        self.relay_endpoint = None if relay is None else resolve_to_canonical_endpoint(relay, family)
+        self.relayconnector = None if self.relay_endpoint is None else RelayConnector(self.relay_endpoint, family, socket_options)
+        self.relay_sessions: dict[int, RelayedConnection] = {}
+        self.relay_secret = relay_secret
+        self.relay_secrets: dict[IP_endpoint, bytes] = {}
+        if self.relay_endpoint is not None:
+            self.udp_socket.add_keep_alive_target(self.relay_endpoint)
+        self.use_connection_ids = connection_ids
+        self.connection_ids: dict[int, Connection] = {}
+        self.fragmentation = fragmentation
+        self.mtu_probing = fragmentation and mtu_probing
+        self.probing: dict[Connection, None] = {}
+        self.measure_paths = measure_paths
+        self.measured: dict[Connection, None] = {}
+        self.next_stats_check = monotonic()
+        self.recorder = recorder
+        self.snapshot_channel = snapshot_channel
+        self.message_header = b'' if snapshot_channel is None else APPLICATION_HEADER
+        if self.mtu_probing:
+            set_dont_fragment(self.udp_socket.socket)
+        self.local_transport: LocalTransport | None = None
+        self.localconnector: LocalConnector | None = None
+        self.local_peers: dict[int, LocalConnection] = {}
+        self.host_addresses: set[str] = set()
+        if local_transport and local_transport_supported():
+            try:
+                self.local_transport = LocalTransport(self.local_endpoint[PORT])
+                self.localconnector = LocalConnector(self.local_endpoint[PORT])
+                self.host_addresses = get_host_addresses(family)
+            except OSError:
+                self.local_transport = None # another Server on this port already owns the names
 
         self.on_connect = on_connect
         self.on_hole_punch_fail = on_hole_punch_fail
@@ -54,22 +158,93 @@ class Server:
         self.on_receive_unreliable = on_receive_unreliable
         self.on_disconnect = on_disconnect
 
-    def hole_punch(self, endpoint: unresolved_endpoint, timeout: float | None) -> bool:
+    # peer_id identifies the peer across restarts: the endpoint that connects is remembered in the path cache,
+    # and the endpoint remembered from last time is hole punched alongside the given one
+    # relay_secret is the secret shared with the peer for falling back to the relay (instead of the Server's relay_secret)
+    def hole_punch(self, endpoint: unresolved_endpoint, timeout: float | None, peer_id: str | None = None,
+                   relay_secret: bytes | None = None) -> bool:
         with self.lock:
             if self.closed:
                 return False
             ip_endpoint = resolve_to_canonical_endpoint(endpoint, self.family)
             if ip_endpoint is None:
                 return False
-            self.holepuncher.hole_punch(ip_endpoint, timeout)
+            if relay_secret is not None:
+                self.relay_secrets[ip_endpoint] = relay_secret
+            if peer_id is not None:
+                if self.path_cache is not None:
+                    cached = self.path_cache.get_peer(peer_id, self.family)
+                    if cached is not None and cached != ip_endpoint and cached not in self.connections:
+                        self.peer_attempts[cached] = (peer_id, True)
+                        if relay_secret is not None:
+                            self.relay_secrets[cached] = relay_secret
+                        self._hole_punch(cached, timeout)
+                self.peer_attempts[ip_endpoint] = (peer_id, False)
+            self._hole_punch(ip_endpoint, timeout)
             return True
 
+    # hole punches the endpoint the peer was last connected at (returns False if the path cache has no fresh endpoint for it)
+    def reconnect(self, peer_id: str, timeout: float | None) -> bool:
+        with self.lock:
+            if self.closed or self.path_cache is None:
+                return False
+            cached = self.path_cache.get_peer(peer_id, self.family)
+            if cached is None:
+                return False
+            if cached not in self.connections:
+                self.peer_attempts[cached] = (peer_id, True)
+                self._hole_punch(cached, timeout)
+            return True
+
+    def _hole_punch(self, endpoint: IP_endpoint, timeout: float | None):
+        if self._is_on_host(endpoint):
+            # try the same host fast path first (falling back to hole punching if there is no Server there)
+            if endpoint not in self.connections:
+                self.localconnector.dial(endpoint, timeout)
+            return
+        self.holepuncher.hole_punch(endpoint, timeout)
+
+    def _is_on_host(self, endpoint: IP_endpoint) -> bool:
+        return (self.local_transport is not None and endpoint[PORT] != self.local_endpoint[PORT]
+                and is_host_address(endpoint[ADDRESS], self.host_addresses))
+
     def stop_hole_punch(self, endpoint: unresolved_endpoint):
         with self.lock:
             ip_endpoint = resolve_to_canonical_endpoint(endpoint, self.family)
             if ip_endpoint is None:
                 return
             self.holepuncher.remove_hole_puncher(ip_endpoint)
+            self.peer_attempts.pop(ip_endpoint, None)
+            self.relay_secrets.pop(ip_endpoint, None)
+            if self.relayconnector is not None:
+                self.relayconnector.remove_connector(ip_endpoint)
+            if self.localconnector is not None:
+                self.localconnector.remove_dialer(ip_endpoint)
+
+    # connects to the peer through the relay server (the peer must also relay_connect or fail to hole punch to this Server)
+    # both peers must use the same relay_secret (the Server's relay_secret if None)
+    # returns False without connecting if there is no secret, or STUN did not find the endpoint the peer sees this Server at
+    def relay_connect(self, endpoint: unresolved_endpoint, timeout: float | None = None, relay_secret: bytes | None = None) -> bool:
+        with self.lock:
+            if self.closed or self.relayconnector is None:
+                return False
+            ip_endpoint = resolve_to_canonical_endpoint(endpoint, self.family)
+            if ip_endpoint is None:
+                return False
+            return self._relay_connect(ip_endpoint, timeout, relay_secret if relay_secret is not None else self.relay_secret)
+
+    def _relay_connect(self, endpoint: IP_endpoint, timeout: float | None, secret: bytes | None) -> bool:
+        if secret is None:
+            debug_print(f"no relay secret for {endpoint}, not relaying")
+            return False
+        # both peers must compute the same token, so use the endpoint the peer sees this Server at
+        # (without it, as when STUN fails, the peer's token can't be matched, so don't wait at the relay for nothing)
+        own_endpoint = self.get_external_endpoint()
+        if own_endpoint is None:
+            debug_print(f"external endpoint unknown, not relaying to {endpoint}")
+            return False
+        self.relayconnector.connect(endpoint, relay_token(secret, own_endpoint, endpoint), timeout)
+        return True
 
     def get_local_endpoint(self) -> IP_endpoint:
         return self.local_endpoint
@@ -108,12 +283,232 @@ class Server:
         except Exception:
             return None
 
+    def create_group(self, name: str) -> Group:
+        with self.lock:
+            group = self.groups.get(name)
+            if group is None:
+                group = Group(name, self.udp_socket, self.message_header)
+                self.groups[name] = group
+            return group
+
+    def get_group(self, name: str) -> Group | None:
+        with self.lock:
+            return self.groups.get(name)
+
+    def remove_group(self, name: str):
+        with self.lock:
+            group = self.groups.pop(name, None)
+        if group is not None:
+            group.close()
+
+    def get_kernel_drops(self) -> int:
+        return self.udp_socket.kernel_drops
+
+    # connections accepted per second by the listener, over the last ACCEPT_RATE_INTERVAL seconds
+    def get_accept_rate(self) -> float:
+        return self.listener.accept_rate
+
+    # connections the OS dropped because an accept queue was full (on linux, summed over every listener on the host),
+    # or None if the OS doesn't report it
+    def get_listen_overflows(self) -> int | None:
+        return get_listen_overflows()
+
     def _manage_new_connection(self, socket: socket)-> Connection | None:
+        if self.socket_options is not None:
+            self.socket_options.apply_tcp(socket)
         connection = self.connections.add_connection(socket, self.udp_socket)
         if connection is None:
             return None
         self.holepuncher.remove_hole_puncher(connection.remote_endpoint)
+        connection.set_rate_limit(self.receive_rate, self.receive_burst)
+        connection.message_header = self.message_header
+        if self.use_connection_ids:
+            connection.set_connection_id(new_connection_id())
+        self._set_up_fragmentation(connection, DEFAULT_FRAGMENT_SIZE)
+        self._set_up_path_stats(connection)
         return connection
+
+    def _manage_new_relayed_connection(self, socket: socket, endpoint: IP_endpoint, session: int, side: int) -> Connection | None:
+        connection = RelayedConnection(socket, self.udp_socket, endpoint, self.relay_endpoint, session, side)
+        if not self.connections.add(connection):
+            try:
+                socket.close()
+            except Exception:
+                pass
+            return None
+        self.holepuncher.remove_hole_puncher(endpoint)
+        connection.set_rate_limit(self.receive_rate, self.receive_burst)
+        connection.message_header = self.message_header
+        self.relay_sessions[session] = connection
+        connection._send_packet(b'') # let the relay learn our udp endpoint
+        self._set_up_fragmentation(connection, DEFAULT_FRAGMENT_SIZE)
+        self._set_up_path_stats(connection)
+        return connection
+
+    def _manage_new_local_connection(self, socket: socket, endpoint: IP_endpoint, port: int) -> Connection | None:
+        local_endpoint = get_canonical_endpoint(("127.0.0.1", self.local_endpoint[PORT]), self.family)
+        connection = LocalConnection(socket, self.udp_socket, self.local_transport, local_endpoint, endpoint, port)
+        if port in self.local_peers or not self.connections.add(connection):
+            try:
+                socket.close()
+            except Exception:
+                pass
+            return None
+        self.holepuncher.remove_hole_puncher(endpoint)
+        connection.set_rate_limit(self.receive_rate, self.receive_burst)
+        connection.message_header = self.message_header
+        self.local_peers[port] = connection
+        self._set_up_fragmentation(connection, LOCAL_FRAGMENT_SIZE)
+        self._set_up_path_stats(connection)
+        return connection
+
+    def _set_up_path_stats(self, connection: Connection):
+        if not self.measure_paths:
+            return
+        connection.path_stats = PathStats()
+        self.measured[connection] = None
+
+    # sends the pings and pongs that had no outgoing packet to ride on
+    def _send_path_stats(self, now: float):
+        self.next_stats_check = now + STATS_CHECK_INTERVAL
+        for connection in self.measured:
+            if connection.closed:
+                continue
+            packet = connection.path_stats.control_packet(now)
+            if packet is not None:
+                connection._send_packet(packet)
+
+    def _set_up_fragmentation(self, connection: Connection, fragment_size: int):
+        if not self.fragmentation:
+            return
+        connection.fragmenter = Fragmenter(fragment_size)
+        if self.mtu_probing and fragment_size == DEFAULT_FRAGMENT_SIZE:
+            connection.fragmenter.start_probing()
+            self.probing[connection] = None
+
+    # decides whether to accept a connection dialed by the Server on this host at the port, which dialed this one at the address
+    def _manage_local_hello(self, socket: socket, port: int, address: str) -> Connection | None:
+        # when both Servers dial each other, only the one dialed by the lower port is kept
+        if port in self.local_peers or (self.local_endpoint[PORT] < port and self.localconnector.is_dialing_port(port)):
+            try:
+                socket.send(LOCAL_REJECT)
+            except OSError:
+                pass
+            try_close(socket)
+            return None
+        try:
+            socket.setblocking(True)
+            socket.send(LOCAL_ACCEPT)
+        except OSError:
+            try_close(socket)
+            return None
+        # name the peer by the host address it was given for this Server (as both sides were likely given the same one),
+        # so the endpoint matches this Server's own hole punches of it and its path cache entries
+        endpoint = None
+        if is_host_address(address, self.host_addresses):
+            endpoint = get_canonical_endpoint((address, port) if ":" not in address else (address, port, 0, 0), self.family)
+        if endpoint is None:
+            endpoint = get_canonical_endpoint(("127.0.0.1", port), self.family)
+        return self._manage_new_local_connection(socket, endpoint, port)
+
+    # returns whether a failed hole punch should be reported (only the last of a peer's endpoints to fail is)
+    def _peer_attempt_failed(self, endpoint: IP_endpoint) -> bool:
+        attempt = self.peer_attempts.pop(endpoint, None)
+        if attempt is None:
+            return True
+        peer_id, cached = attempt
+        if cached and self.path_cache is not None:
+            self.path_cache.forget_peer(peer_id, endpoint)
+        return all(other_id != peer_id for other_id, _ in self.peer_attempts.values())
+
+    def _peer_connected(self, connection: Connection):
+        attempt = self.peer_attempts.pop(connection.remote_endpoint, None)
+        if attempt is None:
+            return
+        peer_id, _ = attempt
+        connection.peer_id = peer_id
+        if self.path_cache is not None and not connection.relayed:
+            self.path_cache.remember_peer(peer_id, connection.remote_endpoint)
+        # stop hole punching the peer's other endpoints
+        for endpoint, (other_id, _) in list(self.peer_attempts.items()):
+            if other_id == peer_id:
+                del self.peer_attempts[endpoint]
+                self.holepuncher.remove_hole_puncher(endpoint)
+                if self.localconnector is not None:
+                    self.localconnector.remove_dialer(endpoint)
+
+    # returns the Connection an unreliable packet with a connection id header belongs to, and its data
+    # (path challenges and responses are handled here, and return no Connection)
+    def _get_identified_packet(self, data: bytes, endpoint: IP_endpoint) -> tuple[Connection | None, bytes]:
+        if len(data) < CONNECTION_ID_HEADER.size:
+            return None, data
+        type, peer_id = CONNECTION_ID_HEADER.unpack_from(data)
+        data = data[CONNECTION_ID_HEADER.size:]
+        connection = self.connection_ids.get(peer_id)
+        if connection is None:
+            # the first packet from a peer is trusted by its endpoint
+            if endpoint not in self.connections:
+                return None, data
+            connection = self.connections[endpoint]
+            if not connection.direct or connection.connection_id is None or connection.peer_connection_id is not None:
+                return None, data
+            connection.peer_connection_id = peer_id
+            self.connection_ids[peer_id] = connection
+        if connection.closed:
+            return None, data
+        if type == PACKET_PATH_CHALLENGE and len(data) >= PATH_NONCE.size:
+            nonce = PATH_NONCE.unpack_from(data)[0]
+            self.udp_socket.send_to(path_packet(PACKET_PATH_RESPONSE, connection.connection_id, nonce), endpoint)
+            return None, data
+        if type == PACKET_PATH_RESPONSE and len(data) >= PATH_NONCE.size:
+            challenge = connection.path_challenge
+            if challenge is not None and challenge[0] == endpoint and challenge[1] == PATH_NONCE.unpack_from(data)[0]:
+                self._migrate(connection, endpoint)
+            return None, data
+        if type != PACKET_DATA:
+            return None, data
+        if endpoint != connection.udp_endpoint:
+            self._challenge_path(connection, endpoint)
+        return connection, data
+
+    # checks that the peer really is at the new endpoint before sending to it
+    def _challenge_path(self, connection: Connection, endpoint: IP_endpoint):
+        now = monotonic()
+        challenge = connection.path_challenge
+        if challenge is not None and challenge[0] == endpoint and now - challenge[2] < PATH_CHALLENGE_INTERVAL:
+            return
+        nonce = new_path_nonce()
+        connection.path_challenge = (endpoint, nonce, now)
+        self.udp_socket.send_to(path_packet(PACKET_PATH_CHALLENGE, connection.connection_id, nonce), endpoint)
+
+    def _migrate(self, connection: Connection, endpoint: IP_endpoint):
+        self.udp_socket.replace_keep_alive_target(connection.udp_endpoint, endpoint)
+        connection.udp_endpoint = endpoint
+        connection.path_challenge = None
+        connection.migrations += 1
+        # the new path may not carry the size probed on the old one
+        if self.mtu_probing and connection.fragmenter is not None:
+            connection.fragmenter.restart_probing()
+            self.probing[connection] = None
+
+    # adds a received unreliable message to the list of its owner, by its kind byte when the Server has a snapshot channel
+    def _add_unreliable(self, data: bytes, connection: Connection, receive_unreliable: list[tuple[bytes, Connection]],
+                        receive_snapshots: list[tuple[bytes, Connection]]):
+        if self.snapshot_channel is None:
+            receive_unreliable.append((data, connection))
+        elif not data:
+            return
+        elif data[0] == MESSAGE_APPLICATION:
+            receive_unreliable.append((data[1:], connection))
+        elif data[0] == MESSAGE_SNAPSHOT:
+            receive_snapshots.append((data, connection))
+
+    # returns the relayed Connection an unreliable packet from the relay server belongs to, and its data
+    def _get_relayed_packet(self, data: bytes) -> tuple[Connection | None, bytes]:
+        if len(data) < RELAY_HEADER.size:
+            return None, data
+        session, _ = RELAY_HEADER.unpack_from(data)
+        return self.relay_sessions.get(session), data[RELAY_HEADER.size:]
     
     def tick(self):
         try:
@@ -122,12 +517,22 @@ class Server:
             disconnects: list[Connection] = []
             receive_unreliable: list[tuple[bytes, Connection]] = []
             receive_reliable: list[tuple[bytes, Connection]] = []
+            receive_snapshots: list[tuple[bytes, Connection]] = []
             with self.lock:
                 if self.closed:
                     return
-                # first manage all hole punch failures
+                # first manage all hole punch failures (falling back to the relay if there is one)
                 for endpoint in self.holepuncher.take_fails():
-                    hole_punch_fails.append(endpoint)
+                    secret = self.relay_secrets.pop(endpoint, self.relay_secret)
+                    if not self._peer_attempt_failed(endpoint):
+                        continue
+                    if self.relayconnector is None or endpoint in self.connections or not self._relay_connect(endpoint, None, secret):
+                        hole_punch_fails.append(endpoint)
+                if self.relayconnector is not None:
+                    hole_punch_fails.extend(self.relayconnector.take_fails())
+                if self.localconnector is not None:
+                    for endpoint, timeout in self.localconnector.take_fails():
+                        self.holepuncher.hole_punch(endpoint, timeout)
                 
                 # next manage all successful connections
                 for socket in self.holepuncher.take_successes():
@@ -138,25 +543,111 @@ class Server:
                     connection = self._manage_new_connection(socket)
                     if connection is not None:
                         new_connections.append(connection)
+                if self.relayconnector is not None:
+                    for socket, endpoint, session, side in self.relayconnector.take_successes():
+                        connection = self._manage_new_relayed_connection(socket, endpoint, session, side)
+                        if connection is not None:
+                            new_connections.append(connection)
+                if self.local_transport is not None:
+                    for socket, endpoint in self.localconnector.take_successes():
+                        connection = self._manage_new_local_connection(socket, endpoint, endpoint[PORT])
+                        if connection is not None:
+                            new_connections.append(connection)
+                    for socket, port, address in self.local_transport.take_hellos():
+                        connection = self._manage_local_hello(socket, port, address)
+                        if connection is not None:
+                            new_connections.append(connection)
+                for connection in new_connections:
+                    self.relay_secrets.pop(connection.remote_endpoint, None)
+                    self._peer_connected(connection)
+                now = monotonic()
+                if self.measured and now >= self.next_stats_check:
+                    self._send_path_stats(now)
+                if self.probing:
+                    for connection in list(self.probing):
+                        if connection.closed or not connection.fragmenter.probe(connection, now):
+                            del self.probing[connection]
                 
                 # next read new data (but don't manage yet)
-                unreliable_data = self.udp_socket.receive()
-                reliable_data = self.connections.receive()
+                # alternate which is read first so neither can starve the other when the budget runs out
+                if self.receive_budget is not None:
+                    self.receive_budget.begin()
+                local_data: list[tuple[bytes, int | None]] = []
+                if self.udp_first:
+                    unreliable_data = self.udp_socket.receive(self.receive_budget)
+                    if self.local_transport is not None:
+                        local_data = self.local_transport.receive(self.receive_budget)
+                    reliable_data = self.connections.receive(self.receive_budget)
+                else:
+                    reliable_data = self.connections.receive(self.receive_budget)
+                    unreliable_data = self.udp_socket.receive(self.receive_budget)
+                    if self.local_transport is not None:
+                        local_data = self.local_transport.receive(self.receive_budget)
+                self.udp_first = not self.udp_first
 
                 # manage all disconnections
                 for connection in self.connections.take_disconnections():
+                    for group in list(connection.groups):
+                        group.leave(connection)
+                    if connection.relayed:
+                        self.relay_sessions.pop(connection.session, None)
+                    if isinstance(connection, LocalConnection):
+                        self.local_peers.pop(connection.remote_port, None)
+                    if connection.peer_connection_id is not None:
+                        self.connection_ids.pop(connection.peer_connection_id, None)
+                    self.probing.pop(connection, None)
+                    self.measured.pop(connection, None)
+                    if self.snapshot_channel is not None:
+                        self.snapshot_channel.remove(connection)
                     disconnects.append(connection)
                 
                 # manage new data
                 for data, endpoint in unreliable_data:
-                    if endpoint is None or endpoint not in self.connections:
+                    if endpoint is not None and endpoint == self.relay_endpoint:
+                        connection, data = self._get_relayed_packet(data)
+                        if connection is None or connection.closed or data == b'':
+                            continue
+                    elif endpoint is None:
+                        continue
+                    elif self.use_connection_ids:
+                        connection, data = self._get_identified_packet(data, endpoint)
+                        if connection is None or data == b'':
+                            continue
+                    elif endpoint not in self.connections:
+                        continue
+                    else:
+                        connection = self.connections[endpoint]
+                    if not connection._accept_unreliable(len(data)):
+                        continue
+                    if connection.path_stats is not None:
+                        data = connection.path_stats.receive(data)
+                        if data is None:
+                            continue
+                    if connection.fragmenter is not None:
+                        data = connection.fragmenter.receive(data, connection)
+                        if data is None:
+                            continue
+                    self._add_unreliable(data, connection, receive_unreliable, receive_snapshots)
+                for data, port in local_data:
+                    connection = self.local_peers.get(port)
+                    if connection is None or connection.closed or not connection._accept_unreliable(len(data)):
                         continue
-                    connection = self.connections[endpoint]
-                    receive_unreliable.append((data, connection))
-                for data, endpoint in reliable_data:
-                    connection = self.connections[endpoint]
+                    if connection.path_stats is not None:
+                        data = connection.path_stats.receive(data)
+                        if data is None:
+                            continue
+                    if connection.fragmenter is not None:
+                        data = connection.fragmenter.receive(data, connection)
+                        if data is None:
+                            continue
+                    self._add_unreliable(data, connection, receive_unreliable, receive_snapshots)
+                for data, connection in reliable_data:
                     receive_reliable.append((data, connection))
             # end of lock
+            if self.path_cache is not None:
+                self.path_cache.flush_if_due()
+            if self.recorder is not None and (new_connections or disconnects or receive_unreliable or receive_reliable):
+                self.recorder.record_tick(new_connections, disconnects, receive_unreliable, receive_reliable)
             for endpoint in hole_punch_fails:
                 self.on_hole_punch_fail(self, endpoint)
             for connection in new_connections:
@@ -165,6 +656,8 @@ class Server:
                 self.on_disconnect(self, connection)
             for data, connection in receive_unreliable:
                 self.on_receive_unreliable(self, data, connection)
+            for data, connection in receive_snapshots:
+                self.snapshot_channel.receive(self, data, connection)
             for data, connection in receive_reliable:
                 self.on_receive_reliable(self, data, connection)
         except:
@@ -179,5 +672,23 @@ class Server:
             self.closed = True
             self.listener.close()
             self.holepuncher.clear()
+            if self.relayconnector is not None:
+                self.relayconnector.clear()
+            self.relay_sessions.clear()
+            self.relay_secrets.clear()
+            self.connection_ids.clear()
+            self.peer_attempts.clear()
+            self.probing.clear()
+            self.measured.clear()
+            if self.local_transport is not None:
+                self.localconnector.clear()
+                self.local_transport.close()
+            self.local_peers.clear()
             self.udp_socket.close()
             self.connections.disconnect_all()
+            for group in self.groups.values():
+                group.close()
+            self.groups.clear()
+        # write what the path cache learned (outside the lock, like every write of it)
+        if self.path_cache is not None:
+            self.path_cache.flush()
@@ -0,0 +1,27 @@
+from socket import create_connection
+from time import monotonic, sleep
+import pytest
+from tcpudpserver import Server, IPV4
+
+# a peer that sends and then closes straight away must have its data delivered before its disconnect
+@pytest.mark.parametrize("shards", [1, 2])
+def test_send_then_close(shards: int):
+    for _ in range(3):
+        events = []
+        server = Server(lambda server, connection: events.append("connect"), lambda server, endpoint: None,
+                        lambda server, data, connection: events.append(data), lambda server, data, connection: None,
+                        lambda server, connection: events.append("disconnect"),
+                        [], IPV4, local_transport=False, receive_shards=shards)
+        try:
+            client = create_connection(("127.0.0.1", server.get_local_endpoint()[1]))
+            client.sendall(b"goodbye")
+            client.close()
+            end = monotonic() + 5
+            while "disconnect" not in events and monotonic() < end:
+                server.tick()
+                sleep(0.001)
+            assert not server.closed
+            assert events[0] == "connect" and events[-1] == "disconnect"
+            assert b''.join(event for event in events if isinstance(event, bytes)) == b"goodbye"
+        finally:
+            server.close()
@@ -1,10 +1,24 @@
+import socket as socket_module
 from socket import socket, AddressFamily
-from common import make_socket_reusable, BUFSIZE, DUMMY_ENDPOINT
+from common import make_socket_reusable, MAX_DATAGRAM_SIZE, DUMMY_ENDPOINT
 from select import select
 from threading import Lock, Timer
+from collections import deque
 from stun import get_ip_info
+from budget import ReceiveBudget
+from errno import EIO, ENOPROTOOPT, EOPNOTSUPP
+from socketoptions import SocketOptions, SO_RXQ_OVFL, RXQ_OVFL_COUNTER, kernel_drops_supported, get_buffer_sizes
+from socketoptions import SOL_UDP, UDP_SEGMENT, UDP_SEGMENT_SIZE, UDP_MAX_SEGMENTS, UDP_MAX_PAYLOAD, udp_gso_supported
 from iptools import *
 
+# windows has no per call non blocking flag, so try_send_parts_to may block there
+SEND_DONTWAIT = getattr(socket_module, "MSG_DONTWAIT", 0)
+# with a receive budget, datagrams are queued by source endpoint and the endpoints are served in round robin order,
+# so one endpoint flooding the socket only fills its own queue instead of using up every tick's budget
+UDP_READ_LIMIT = 1024 # the most datagrams read from the kernel by one receive
+UDP_QUEUE_LIMIT = 64 # the most datagrams queued for one endpoint (more are dropped as they are read)
+UDP_MAX_QUEUED = 4096 # the most datagrams queued for all endpoints (the rest wait in the kernel buffer)
+
 class UdpSocket:
     # socket: socket - the udp socket to be used
     # local_endpoint: IP_endpoint - the endpoint the udp socket is bound to
@@ -13,10 +27,29 @@ class UdpSocket:
     # send_lock: Lock
     # keep_alive_targets: set[endpoint] - Udp packets will be sent to these endpoints every 10 seconds to keep udp connections alive
     # closed: bool
-    def __init__(self, local_endpoint: IP_endpoint, stun_hosts: list[unresolved_endpoint], family: AddressFamily):
-        self.socket = create_udp_socket(local_endpoint, family)
+    # count_kernel_drops: bool - whether packets are read with recvmsg to track the SO_RXQ_OVFL counter
+    # kernel_drops: int - the number of packets the kernel has dropped because the receive buffer was full (updated when the next packet is read)
+    # use_gso: bool - whether runs of equal sized datagrams to one endpoint are sent with a single UDP_SEGMENT sendmsg
+    #                 (turned off for good if the kernel or the network device turns out not to support it)
+    # gso_sends: int - the number of sendmsg calls that carried more than one datagram
+    # receive_buffer: memoryview - the buffer every datagram is received into before being copied out at its size
+    # queues: dict[IP_endpoint | None, deque[bytes]] - the datagrams read but not yet received, by source, in the order the sources are served next
+    # queued: int - the number of datagrams in queues
+    # queue_drops: int - the number of datagrams dropped because their source's queue was full
+    # external_endpoint is used instead of asking the stun hosts when it is known (e.g. from a PathCache)
+    def __init__(self, local_endpoint: IP_endpoint, stun_hosts: list[unresolved_endpoint], family: AddressFamily,
+                 options: SocketOptions | None = None, external_endpoint: IP_endpoint | None = None):
+        self.socket = create_udp_socket(local_endpoint, family, options)
+        self.count_kernel_drops = options is not None and options.count_kernel_drops and kernel_drops_supported()
+        self.kernel_drops = 0
+        self.use_gso = options is not None and options.udp_gso and udp_gso_supported(self.socket)
+        self.gso_sends = 0
+        self.receive_buffer = memoryview(bytearray(MAX_DATAGRAM_SIZE))
+        self.queues: dict[IP_endpoint | None, deque[bytes]] = {}
+        self.queued = 0
+        self.queue_drops = 0
         self.local_endpoint = local_endpoint
-        self.external_endpoint = get_ip_info(self.socket, stun_hosts)
+        self.external_endpoint = external_endpoint if external_endpoint is not None else get_ip_info(self.socket, stun_hosts)
         
         self.keep_alive_targets: set[IP_endpoint] = set()
         dummy_endpoint = resolve_to_canonical_endpoint(DUMMY_ENDPOINT, self.socket.family)
@@ -37,17 +70,64 @@ class UdpSocket:
     
     def get_external_endpoint(self) -> IP_endpoint | None:
         return self.external_endpoint
+    
+    def get_buffer_sizes(self) -> tuple[int, int]:
+        return get_buffer_sizes(self.socket)
+
+    def _receive_packet(self) -> tuple[bytes, IP_endpoint]:
+        if not self.count_kernel_drops:
+            size, endpoint = self.socket.recvfrom_into(self.receive_buffer)
+            return bytes(self.receive_buffer[:size]), endpoint
+        size, ancdata, _, endpoint = self.socket.recvmsg_into([self.receive_buffer], CMSG_SPACE(RXQ_OVFL_COUNTER.size))
+        for level, type, value in ancdata:
+            if level == SOL_SOCKET and type == SO_RXQ_OVFL and len(value) >= RXQ_OVFL_COUNTER.size:
+                self.kernel_drops = RXQ_OVFL_COUNTER.unpack_from(value)[0]
+        return bytes(self.receive_buffer[:size]), endpoint
+
+    def receive(self, budget: ReceiveBudget | None = None) -> list[tuple[bytes, IP_endpoint | None]]:
+        if budget is None:
+            result = self._take_queued(None)
+            result.extend(self._read(None))
+            return result
+        for data, endpoint in self._read(UDP_READ_LIMIT):
+            queue = self.queues.get(endpoint)
+            if queue is None:
+                queue = deque()
+                self.queues[endpoint] = queue
+            if len(queue) >= UDP_QUEUE_LIMIT:
+                self.queue_drops += 1
+                continue
+            queue.append(data)
+            self.queued += 1
+        return self._take_queued(budget)
 
-    def receive(self) -> list[tuple[bytes, IP_endpoint | None]]:
+    # returns up to limit datagrams read from the kernel, in arrival order (all that are ready if limit is None)
+    def _read(self, limit: int | None) -> list[tuple[bytes, IP_endpoint | None]]:
         result: list[tuple[bytes, IP_endpoint | None]] = []
-        while self._ready_to_receive():
+        while (limit is None or (len(result) < limit and self.queued + len(result) < UDP_MAX_QUEUED)) and self._ready_to_receive():
             try:
-                data, endpoint = self.socket.recvfrom(BUFSIZE)
+                data, endpoint = self._receive_packet()
                 if data != b'':
                     result.append((data, get_canonical_endpoint(endpoint, self.socket.family)))
             except:
                 break
         return result
+
+    # takes the queued datagrams one source at a time until the budget is exhausted
+    # (a source goes to the back of the order once served, so the next tick starts with the sources this one didn't reach)
+    def _take_queued(self, budget: ReceiveBudget | None) -> list[tuple[bytes, IP_endpoint | None]]:
+        result: list[tuple[bytes, IP_endpoint | None]] = []
+        while self.queues and (budget is None or not budget.exhausted()):
+            endpoint = next(iter(self.queues))
+            queue = self.queues.pop(endpoint)
+            data = queue.popleft()
+            self.queued -= 1
+            if budget is not None:
+                budget.consume(len(data))
+            result.append((data, endpoint))
+            if queue:
+                self.queues[endpoint] = queue
+        return result
     
     def send_to(self, data: bytes, endpoint: IP_endpoint):
         with self.send_lock:
@@ -58,14 +138,133 @@ class UdpSocket:
             except:
                 return
     
+    # sends the parts as a single packet, without joining them first where sendmsg is available
+    def send_parts_to(self, parts: list[bytes], endpoint: IP_endpoint):
+        with self.send_lock:
+            if self.closed:
+                return
+            try:
+                if hasattr(self.socket, "sendmsg"):
+                    self.socket.sendmsg(parts, [], 0, endpoint)
+                else:
+                    self.socket.sendto(b''.join(parts), endpoint)
+            except:
+                return
+    
+    # sends the parts as a single packet without blocking, returning False if the send buffer is full (or the packet was otherwise not sent)
+    def try_send_parts_to(self, parts: list[bytes], endpoint: IP_endpoint) -> bool:
+        with self.send_lock:
+            if self.closed:
+                return False
+            try:
+                if hasattr(self.socket, "sendmsg"):
+                    self.socket.sendmsg(parts, [], SEND_DONTWAIT, endpoint)
+                else:
+                    self.socket.sendto(b''.join(parts), SEND_DONTWAIT, endpoint)
+                return True
+            except:
+                return False
+    
+    # sends the same data to every endpoint, taking the lock only once
+    def send_to_many(self, data: bytes, endpoints: list[IP_endpoint]):
+        with self.send_lock:
+            if self.closed:
+                return
+            sendto = self.socket.sendto
+            for endpoint in endpoints:
+                try:
+                    sendto(data, endpoint)
+                except:
+                    continue
+    
+    # sends data to every endpoint with a different header in front for each, taking the lock only once
+    def send_to_many_with_headers(self, data: bytes, targets: list[tuple[bytes, IP_endpoint]]):
+        with self.send_lock:
+            if self.closed:
+                return
+            if not hasattr(self.socket, "sendmsg"):
+                for header, endpoint in targets:
+                    try:
+                        self.socket.sendto(header + data, endpoint)
+                    except:
+                        continue
+                return
+            sendmsg = self.socket.sendmsg
+            for header, endpoint in targets:
+                try:
+                    sendmsg([header, data], [], 0, endpoint)
+                except:
+                    continue
+    
+    # sends every datagram to the endpoint, segmented into as few sendmsg calls as possible when use_gso is set
+    def send_all_to(self, datas: list[bytes], endpoint: IP_endpoint):
+        with self.send_lock:
+            if self.closed:
+                return
+            self._send_datagrams(datas, endpoint)
+
+    # sends the datagrams of many endpoints, taking the lock only once
+    def send_batch(self, batch: list[tuple[list[bytes], IP_endpoint]]):
+        with self.send_lock:
+            if self.closed:
+                return
+            for datas, endpoint in batch:
+                self._send_datagrams(datas, endpoint)
+
+    def _send_datagrams(self, datas: list[bytes], endpoint: IP_endpoint):
+        if not self.use_gso:
+            sendto = self.socket.sendto
+            for data in datas:
+                try:
+                    sendto(data, endpoint)
+                except:
+                    continue
+            return
+        start = 0
+        while start < len(datas):
+            end = _segment_run_end(datas, start)
+            if end - start == 1:
+                try:
+                    self.socket.sendto(datas[start], endpoint)
+                except:
+                    pass
+            else:
+                self._send_segmented(datas[start:end], endpoint)
+            start = end
+
+    # sends a run of datagrams (all the same size, except perhaps a shorter last one) in one sendmsg
+    def _send_segmented(self, run: list[bytes], endpoint: IP_endpoint):
+        try:
+            self.socket.sendmsg(run, [(SOL_UDP, UDP_SEGMENT, UDP_SEGMENT_SIZE.pack(len(run[0])))], 0, endpoint)
+            self.gso_sends += 1
+            return
+        except OSError as error:
+            if error.errno in (EIO, ENOPROTOOPT, EOPNOTSUPP):
+                self.use_gso = False # EIO means the device can not offload the checksums
+        except:
+            return
+        # the segmented send failed (e.g. segments larger than the path mtu), so send the run one datagram at a time
+        for data in run:
+            try:
+                self.socket.sendto(data, endpoint)
+            except:
+                continue
+
+    # moves a keep alive target to the endpoint a peer has migrated to
+    def replace_keep_alive_target(self, old_endpoint: IP_endpoint, new_endpoint: IP_endpoint):
+        with self.send_lock:
+            self.keep_alive_targets.discard(old_endpoint)
+            self.keep_alive_targets.add(new_endpoint)
+    
     def add_keep_alive_target(self, endpoint: IP_endpoint):
         with self.send_lock:
             self.keep_alive_targets.add(endpoint)
         self.send_to(b'', endpoint)
 
+    # the target may already be gone (e.g. moved by a migration to an endpoint another connection shared)
     def remove_keep_alive_target(self, endpoint: IP_endpoint):
         with self.send_lock:
-            self.keep_alive_targets.remove(endpoint)
+            self.keep_alive_targets.discard(endpoint)
 
     def keep_alive(self):
         if self.closed:
@@ -88,8 +287,27 @@ class UdpSocket:
             self.keep_alive_timer.cancel()
             self.socket.close()
     
-def create_udp_socket(local_endpoint: IP_endpoint, family: AddressFamily) -> socket:
+# returns the end of the longest run starting at start that can be sent with one UDP_SEGMENT sendmsg
+def _segment_run_end(datas: list[bytes], start: int) -> int:
+    size = len(datas[start])
+    if size == 0:
+        return start + 1
+    limit = min(len(datas), start + UDP_MAX_SEGMENTS, start + UDP_MAX_PAYLOAD // size)
+    end = start + 1
+    while end < limit:
+        length = len(datas[end])
+        if length == size:
+            end += 1
+        elif 0 < length < size:
+            return end + 1 # a shorter datagram can only end the run
+        else:
+            break
+    return end
+
+def create_udp_socket(local_endpoint: IP_endpoint, family: AddressFamily, options: SocketOptions | None = None) -> socket:
     udp_socket = socket(family, SOCK_DGRAM)
     make_socket_reusable(udp_socket)
+    if options is not None:
+        options.apply_udp(udp_socket)
     udp_socket.bind(local_endpoint) # bind the socket
     return udp_socket
\ No newline at end of file